@@ -0,0 +1,56 @@
+# -*- mode: python ; coding: utf-8 -*-
+
+"""PlanMangler.spec: Builds the Plan Mangler GUI as a standalone executable with PyInstaller.
+
+Run from anywhere, with PyInstaller installed alongside the requirements and wxPython:
+
+    pyinstaller Executable/PlanMangler.spec
+
+The executable is written to dist/PlanMangler.
+"""
+
+# Imports
+import os
+
+"""
+Bundling rtpmangle
+------------------
+
+The GUI imports the rtpmangle package from the repository root, given to the analysis as pathex. Most of the
+package's modules are only imported when first used (see rtpmangle/__init__.py), through importlib, which
+PyInstaller cannot follow - so each module of the package is listed as a hidden import. NumPy is optional at
+run time, so is listed too, to be bundled when it is installed.
+
+"""
+
+root = os.path.abspath(os.path.join(SPECPATH, os.pardir))
+package = os.path.join(root, 'rtpmangle')
+hiddenimports = ['rtpmangle.' + os.path.splitext(name)[0] for name in sorted(os.listdir(package))
+                 if name.endswith('.py') and name != '__init__.py'] + ['numpy']
+
+a = Analysis(
+    [os.path.join(SPECPATH, 'UserInterface.py')],
+    pathex=[root],
+    hiddenimports=hiddenimports,
+    excludes=['tkinter'],
+)
+splash = Splash(
+    os.path.join(SPECPATH, 'SplashScreen.PNG'),
+    binaries=a.binaries,
+    datas=a.datas,
+    text_pos=(10, 20),
+    text_size=10,
+)
+pyz = PYZ(a.pure)
+
+# The console is kept for verbose output and profile timings.
+exe = EXE(
+    pyz,
+    a.scripts,
+    splash,
+    splash.binaries,
+    a.binaries,
+    a.datas,
+    name='PlanMangler',
+    console=True,
+)
@@ -1,7 +1,14 @@
 import importlib
+import os
+import sys
 import wx
-import mangleUI
-import pydicom
+import wx.adv
+
+# The engine is the rtpmangle package at the repository root - run from there, as python -m
+# Executable.UserInterface, or build with Executable/PlanMangler.spec, which bundles it.
+from rtpmangle import EditHistory, JobQueue, LoadedPlan, parse
+from rtpmangle.index import planIndex
+from rtpmangle.sweep import expandSweep
 
 class PopUp(wx.Frame):
     def __init__(self, text):
@@ -23,13 +30,25 @@ class MyFrame(wx.Frame):
         self.commandString = ''
         self.outFile = ''
         self.pathname = ''
+        self.plan = None
+        self.history = None
+        self.historyPlan = None
+        # The job applying the last edit added, and the command string to restore if it fails, until it is done.
+        self.pendingEdit = None
+        # The arguments of each job in the queue, by job number, until it finishes.
+        self.jobOutputs = {}
         self.directory = ''
         self.addedInFile = False
         self.addedKeepUid = False 
         self.addedVerbose = False
         self.dark_mode = False
 
-        super().__init__(parent=None, title='Plan Mangler', size = (1500, 650))
+        super().__init__(parent=None, title='Plan Mangler', size = (1500, 850))
+
+        # Perform queues its mangle to run in the background, so the window stays responsive.
+        self.jobs = JobQueue(notify=lambda job: wx.CallAfter(self.OnJobUpdate, job))
+        self.Bind(wx.EVT_CLOSE, self.OnClose)
+        self.CreateStatusBar()
        
         panel = wx.Panel(self)   
 
@@ -38,7 +57,8 @@ class MyFrame(wx.Frame):
         initialOptions = wx.GridSizer(2,9,5,5)
         beamData = wx.GridSizer(9,9,5,5)
         helptext = wx.GridSizer(6,1,5,5,)
-        perform = wx.FlexGridSizer(1,4,5,5)
+        perform = wx.FlexGridSizer(1,6,5,5)
+        queue = wx.BoxSizer(wx.HORIZONTAL)
 
         file_open = wx.Button(panel, label='Input File')
         file_open.Bind(wx.EVT_BUTTON, self.OnOpen)
@@ -46,6 +66,7 @@ class MyFrame(wx.Frame):
 
         self.uid = wx.CheckBox(panel, label = 'Keep SOPInstanceUID' )
         self.verbose = wx.CheckBox(panel, label = 'Verbose Console Output ?')
+        self.profile = wx.CheckBox(panel, label = 'Profile Timings ?')
  
       
 # Filters
@@ -97,6 +118,25 @@ class MyFrame(wx.Frame):
         perform_btn = wx.Button(panel, label='Perform')
         perform_btn.Bind(wx.EVT_BUTTON, self.perform)
 
+        # The queue of jobs started by Perform, with their progress.
+        self.queue_list = wx.ListCtrl(panel, style=wx.LC_REPORT)
+        for column, (heading, width) in enumerate([('#', 40), ('Output File', 700), ('Stage', 200), ('Progress', 100), ('Time', 100)]):
+            self.queue_list.InsertColumn(column, heading, width=width)
+        self.cancel_btn = wx.Button(panel, label='Cancel Selected')
+        self.cancel_btn.Bind(wx.EVT_BUTTON, self.OnCancel)
+
+        # Undo and Redo step through the edits added to the command string, also on Ctrl+Z and Ctrl+Y.
+        self.undo_btn = wx.Button(panel, label='Undo')
+        self.undo_btn.Bind(wx.EVT_BUTTON, self.OnUndo)
+        self.Bind(wx.EVT_MENU, self.OnUndo, id=self.undo_btn.GetId())
+        self.redo_btn = wx.Button(panel, label='Redo')
+        self.redo_btn.Bind(wx.EVT_BUTTON, self.OnRedo)
+        self.Bind(wx.EVT_MENU, self.OnRedo, id=self.redo_btn.GetId())
+        self.SetAcceleratorTable(wx.AcceleratorTable([
+            (wx.ACCEL_CTRL, ord('Z'), self.undo_btn.GetId()),
+            (wx.ACCEL_CTRL, ord('Y'), self.redo_btn.GetId()),
+        ]))
+
         self.AddToCommand = wx.Button(panel, label = 'Add to Command String')
         self.AddToCommand.Bind(wx.EVT_BUTTON, self.on_press)
  
@@ -104,7 +144,7 @@ class MyFrame(wx.Frame):
 
             (file_open, 0, wx.EXPAND, 5),(wx.StaticText(panel , label ='')),(wx.StaticText(panel , label ='')),(wx.StaticText(panel , label ='')),(wx.StaticText(panel , label ='')),(wx.StaticText(panel , label ='')),(wx.StaticText(panel , label ='')),(wx.StaticText(panel , label ='')),(self.darkMode,0,wx.EXPAND,5),
 
-            (self.uid, 0, wx.EXPAND, 5),(wx.StaticText(panel , label ='')),(self.verbose, 0, wx.EXPAND, 5),(wx.StaticText(panel , label ='')),(wx.StaticText(panel, label ='Output File Name:' ),0, wx.ALIGN_CENTER_VERTICAL,5),(self.outputFile,0,wx.EXPAND,5),(wx.StaticText(panel , label ='')),(wx.StaticText(panel , label ='')),(wx.StaticText(panel , label ='')),
+            (self.uid, 0, wx.EXPAND, 5),(wx.StaticText(panel , label ='')),(self.verbose, 0, wx.EXPAND, 5),(self.profile, 0, wx.EXPAND, 5),(wx.StaticText(panel, label ='Output File Name:' ),0, wx.ALIGN_CENTER_VERTICAL,5),(self.outputFile,0,wx.EXPAND,5),(wx.StaticText(panel , label ='')),(wx.StaticText(panel , label ='')),(wx.StaticText(panel , label ='')),
 
 
         ])
@@ -150,7 +190,7 @@ class MyFrame(wx.Frame):
         
         perform.AddMany([
 
-            (self.AddToCommand,0,wx.EXPAND,5),(wx.StaticText(panel , label ='Current Command String :'),0,wx.ALIGN_CENTER_VERTICAL,5),(self.commandString_view, 0, wx.EXPAND, 5),(perform_btn, 0, wx.EXPAND, 5)
+            (self.AddToCommand,0,wx.EXPAND,5),(wx.StaticText(panel , label ='Current Command String :'),0,wx.ALIGN_CENTER_VERTICAL,5),(self.commandString_view, 0, wx.EXPAND, 5),(self.undo_btn, 0, wx.EXPAND, 5),(self.redo_btn, 0, wx.EXPAND, 5),(perform_btn, 0, wx.EXPAND, 5)
 
         ])
 
@@ -160,7 +200,11 @@ class MyFrame(wx.Frame):
         my_sizer.Add(initialOptions, 1, flag = wx.ALL | wx.EXPAND, border = 15)
         my_sizer.Add(beamData, 1, flag = wx.ALL | wx.EXPAND, border = 15)   
         my_sizer.Add(helptext, 1, flag = wx.ALL | wx.EXPAND, border = 15)
-        my_sizer.Add(perform, 1, flag = wx.ALL | wx.EXPAND, border = 15)    
+        my_sizer.Add(perform, 1, flag = wx.ALL | wx.EXPAND, border = 15)
+
+        queue.Add(self.queue_list, 1, flag = wx.EXPAND)
+        queue.Add(self.cancel_btn, 0, flag = wx.LEFT, border = 5)
+        my_sizer.Add(queue, 1, flag = wx.ALL | wx.EXPAND, border = 15)    
 
         panel.SetSizer(my_sizer)      
         
@@ -183,6 +227,7 @@ class MyFrame(wx.Frame):
         self.leaf_relative.Hide()
         self.leaf_position.Hide()
 
+        self.updateHistoryButtons()
 
 
     def on_check(self, event):
@@ -232,6 +277,11 @@ class MyFrame(wx.Frame):
     def on_press(self, event):
         #script_path = mangle.__path__
         
+        # The command string is added to as it stands in the view, which is restored if the command cannot be
+        # applied.
+        self.commandString = self.commandString_view.GetValue()
+        previous = self.commandState()
+
         # In File
         inFile = self.pathname
         if not self.addedInFile:
@@ -315,11 +365,27 @@ class MyFrame(wx.Frame):
         command = beams + ' ' + controlPoints + ' ' + jaw_or_mlc_command + ' ' + mu + ' ' + machine + ' ' + gantry + ' ' + collimator 
         command = ' '.join(command.split())
 
-        self.commandString = self.commandString_view.GetValue()
-
         self.commandString = self.commandString + '"' + command + '"'
         self.commandString = self.commandString.replace(' ""', '')
-        
+
+        # Apply the command to the plan in memory, as a step which can be undone. It runs as a job on the plan's
+        # queue, after any mangles of the plan queued before it, so the window never waits for the plan. Add,
+        # Undo and Redo wait for it to finish.
+        if self.history is not None:
+            history, state, verbose = self.history, self.commandState(), self.verbose.GetValue()
+            commands = [command] if command else []
+
+            def step(timings):
+                history.apply(commands, state, verbose, timings)
+
+            try:
+                job = self.jobs.submit('Edit: ' + command, step, commands, self.historyPlan)
+            except ValueError as e:
+                self.restoreCommandState(previous)
+                frame = PopUp('Error: ' + str(e))
+                return
+            self.pendingEdit = (job, previous)
+            self.updateHistoryButtons()
 
         self.commandString_view.SetValue(self.commandString)
 
@@ -357,22 +423,24 @@ class MyFrame(wx.Frame):
             self.pathname = fileDialog.GetPath()
             self.directory = fileDialog.GetDirectory()
 
-            dicom = pydicom.dcmread(self.pathname)
+            # Keep the plan in memory, so Perform does not need to read it again.
+            self.plan = LoadedPlan(self.pathname)
+            dicom = self.plan.dataset()
             beams = dicom.BeamSequence
             allBeams = ''
             maxPairs = 0
             maxControlPoints = 0
             i = 0
             self.beam.Clear()
+            # The plan's index holds the geometry of each beam - beams may use different MLCs.
+            index = planIndex(dicom)
             for beam in beams:
                 self.beam.Append(str(i) +'- ' + beam.BeamName)
-                blds = beam.BeamLimitingDeviceSequence
-                for bld in blds:
-                    if bld.RTBeamLimitingDeviceType == "MLCX" or bld.RTBeamLimitingDeviceType == "MLCY":
-                            if int(bld.NumberOfLeafJawPairs) > maxPairs:
-                                maxPairs = bld.NumberOfLeafJawPairs
-                if int(beam.NumberOfControlPoints) > maxControlPoints:
-                    maxControlPoints = beam.NumberOfControlPoints
+                mlc = index.geometry(i, beam).mlc()
+                if mlc and mlc.nPairs > maxPairs:
+                    maxPairs = mlc.nPairs
+                if index.nCps[i] > maxControlPoints:
+                    maxControlPoints = index.nCps[i]
                 allBeams = allBeams + str(i) + ','
                 i += 1
             self.beam.Append(allBeams + '- ' + 'All Beams')
@@ -388,8 +456,48 @@ class MyFrame(wx.Frame):
             self.controlPointsTo.Clear()
             self.controlPointsTo.Append(listControlPoints)
 
-            
-      
+            # Each edit added to the command string is kept as a snapshot of the plan, for Undo and Redo. An edit
+            # still being applied to the last plan opened is of no more use.
+            if self.pendingEdit is not None:
+                self.pendingEdit[0].cancel()
+                self.pendingEdit = None
+            self.history = EditHistory(dicom, self.commandState())
+            self.historyPlan = self.plan
+            self.updateHistoryButtons()
+
+    def commandState(self):
+        """The command string, and the options added to it, as restored by Undo and Redo."""
+        return (self.commandString, self.outFile, self.addedInFile, self.addedKeepUid, self.addedVerbose)
+
+    def restoreCommandState(self, state):
+        (self.commandString, self.outFile, self.addedInFile, self.addedKeepUid, self.addedVerbose) = state
+        self.commandString_view.SetValue(self.commandString)
+
+    def updateHistoryButtons(self):
+        waiting = self.pendingEdit is not None
+        self.AddToCommand.Enable(not waiting)
+        self.undo_btn.Enable(not waiting and self.history is not None and self.history.canUndo())
+        self.redo_btn.Enable(not waiting and self.history is not None and self.history.canRedo())
+
+    def editFinished(self, job):
+        previous = self.pendingEdit[1]
+        self.pendingEdit = None
+        if job.stage != 'done':
+            # The edit was not added to the history, so the command string goes back to how it was.
+            self.restoreCommandState(previous)
+            if job.stage == 'failed':
+                frame = PopUp('Error: ' + str(job.error))
+        self.updateHistoryButtons()
+
+    def OnUndo(self, event):
+        if self.pendingEdit is None and self.history is not None and self.history.canUndo():
+            self.restoreCommandState(self.history.undo())
+        self.updateHistoryButtons()
+
+    def OnRedo(self, event):
+        if self.pendingEdit is None and self.history is not None and self.history.canRedo():
+            self.restoreCommandState(self.history.redo())
+        self.updateHistoryButtons()
 
 
     def onToggleDark(self, event):
@@ -402,10 +510,85 @@ class MyFrame(wx.Frame):
     def perform(self, event):
         if not self.commandString_view.GetValue():
             frame = PopUp('Command String is Blank, Please Add To Command String')
+        elif self.plan is None:
+            frame = PopUp('No Plan Is Open, Please Open A Plan First')
         else:
             commandStrings = [item.replace('"', '') for item in self.commandString_view.GetValue().split('" "')]
-            mangleUI.mangle(self.pathname, self.outFile, self.addedKeepUid, self.addedVerbose, commandStrings)
-            frame = PopUp('Output File Created At: ' + self.outFile)
+            plan, history = self.plan, self.history
+            outFile, keepUid, verbose = self.outFile, self.addedKeepUid, self.addedVerbose
+            # If the command string is unchanged since the last edit was added, undone or redone, the plan in
+            # memory already has its edits, and only needs writing - once the last edit is done.
+            snapshot = None
+            if history is not None and self.pendingEdit is None and self.commandString_view.GetValue() == history.state[0]:
+                snapshot = history.dataset
+            try:
+                # Check the command strings compile before queueing them, to be applied to a copy of the plan loaded
+                # by OnOpen. A sweep of a single value is just a command string, but a sweep of many makes a plan of
+                # each, which only mangle.py can write.
+                expanded = expandSweep(commandStrings)
+                if len(expanded) > 1:
+                    raise ValueError('The command strings sweep over ' + str(len(expanded)) + ' plans - run sweeps '
+                                     'with mangle.py from the console instead.')
+                commandStrings = expanded[0][1]
+                commands = [] if snapshot is not None else [parse(cmdStr) for cmdStr in commandStrings]
+            except ValueError as e:
+                frame = PopUp('Error: ' + str(e))
+                return
+
+            def run(timings):
+                if snapshot is not None and plan.dataset(timings) is history.base:
+                    return history.write(outFile, keepUid, timings, snapshot)
+                return plan.mangle(outFile, commandStrings, keepUid, verbose, timings)
+
+            # The mangle runs in the background, and the queue shows its progress until it finishes.
+            job = self.jobs.submit(outFile, run, commands, plan)
+            self.jobOutputs[job.number] = (outFile, sys.stdout if self.profile.GetValue() else None)
+
+    def OnJobUpdate(self, job):
+        # Updates may arrive after the window has closed.
+        if not self:
+            return
+        row = job.number
+        if row >= self.queue_list.GetItemCount():
+            self.queue_list.InsertItem(row, str(row + 1))
+            self.queue_list.SetItem(row, 1, job.description)
+        stage = job.stage
+        if stage == 'apply' and job.total:
+            stage = 'apply ' + str(min(job.applied, job.total)) + '/' + str(job.total)
+        self.queue_list.SetItem(row, 2, stage)
+        self.queue_list.SetItem(row, 3, format(100 * job.progress(), '.0f') + '%')
+        self.queue_list.SetItem(row, 4, format(job.elapsed(), '.1f') + ' s')
+        if job.isFinished and job.number in self.jobOutputs:
+            self.jobFinished(job)
+        if job.isFinished and self.pendingEdit is not None and job is self.pendingEdit[0]:
+            self.editFinished(job)
+
+    def jobFinished(self, job):
+        outFile, profileFile = self.jobOutputs.pop(job.number)
+        if job.stage == 'done':
+            print("Output File " + outFile + " created.")
+            message = 'Output File Created At: ' + outFile
+            if profileFile is not None:
+                # The breakdown goes to the console, and the total to the notification.
+                job.timings.dump(profileFile)
+                message = message + '\nTook ' + format(1000 * job.elapsed(), '.0f') + ' ms'
+        elif job.stage == 'failed':
+            message = 'Error: ' + str(job.error)
+        else:
+            message = 'Cancelled: ' + outFile
+        self.SetStatusText(message.replace('\n', ' - '))
+        wx.adv.NotificationMessage('Plan Mangler', message, parent=self).Show()
+
+    def OnCancel(self, event):
+        row = self.queue_list.GetFirstSelected()
+        while row != -1:
+            self.jobs.jobs[row].cancel()
+            row = self.queue_list.GetNextSelected(row)
+
+    def OnClose(self, event):
+        # Jobs still queued are cancelled, and those running stop at their next command string.
+        self.jobs.shutdown()
+        event.Skip()
 
     def OnJawChoice(self, event):
         if self.jaw.GetValue().split('-')[0] == '0':
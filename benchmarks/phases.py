@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+"""phases.py: Times each phase of mangling synthetic plans, and records the results as JSON."""
+
+# Imports
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+import pydicom
+
+from rtpmangle import mangleDataset, readPlan, writePlan
+from rtpmangle.command import parse
+from rtpmangle.engine import applyCommand, select
+from synthetic import PRESETS, writeSynthetic
+
+"""
+Phase Benchmark
+---------------
+
+Each plan is generated with synthetic.py, then every phase of a mangle.py run is timed on its own:
+
+    read        - readPlan() of the file.
+    parse       - Compiling the command strings, bypassing the cache of compiled commands.
+    filter      - Selecting beams and control points by index and by value (engine.select).
+    mu, machine, gantry, collimator, jaw, mlc
+                - Applying a command using each type of setter to a freshly read plan.
+    write       - Writing a mangled plan, copying the elements that were not edited.
+    write-full  - Writing the same plan with every element encoded again, as ds.save_as() does.
+    mangle      - Read, mangle and write in one go, as mangle.py does.
+    cli         - mangle.py itself, run in a new interpreter.
+
+Each phase is run --repeat times, and the median and fastest times recorded. Its peak memory is the most
+Python memory (as traced by tracemalloc) allocated during one further run - memory mapped files are not
+included. Only the time of the cli phase is recorded - the peak resident size the operating system reports
+for a child process includes that of the benchmark itself.
+
+Results are written as JSON with -o. Given a --baseline from an earlier run, any phase whose median time has
+grown by more than --max-ratio is reported, and the script exits with an error.
+
+"""
+
+PARSE_COMMANDS = ["b0 mu=+10", "b1 cp1-3 g=+5", "lb1 lp6 pa=-40", "j0 jb1 pr=+2", "m='Linac 2'", "c=-5",
+                  "lb0 lp2-4 pr=-10%", "cp0 j1 pa=7", "ga90-180,270-300 lb0 lp10-40 pr=+1", "cw0.2-0.5 mu=-3%"]
+FILTER_COMMANDS = ["b0 cp10-100", "ga90-180,270-300", "b1 cw0.2-0.5 ca350-10"]
+SETTER_COMMANDS = {
+    "mu": "mu=+2%",
+    "machine": "m='Linac 2'",
+    "gantry": "g=+5",
+    "collimator": "c=-5",
+    "jaw": "j0 jb1 pr=+2",
+    "mlc": "lb1 lp6-20 pr=-10%",
+}
+MANGLE_COMMANDS = ["b0 mu=+10", "b1 cp1-3 g=+5", "lb1 lp6 pa=-40", "j0 jb1 pr=+2", "m='Linac 2'", "c=-5"]
+
+parser = argparse.ArgumentParser(description='Benchmark each phase of mangling synthetic RT Plans.')
+parser.add_argument('-p', '--preset',
+    action='append',
+    choices=sorted(PRESETS),
+    help='Plan shape to benchmark, may be given more than once. Defaults to all of them.')
+parser.add_argument('--file',
+    action='append',
+    default=[],
+    help='Also benchmark an existing plan file.')
+parser.add_argument('-n', '--repeat',
+    type=int,
+    default=5,
+    help='Number of times to run each phase.')
+parser.add_argument('--no-cli',
+    action='store_true',
+    help='Skip running mangle.py in a new interpreter.')
+parser.add_argument('-o', '--output',
+    help='Write the results to this JSON file.')
+parser.add_argument('--baseline',
+    help='JSON results of an earlier run to compare against.')
+parser.add_argument('--max-ratio',
+    type=float,
+    default=1.5,
+    help='Fail if a phase takes longer than this multiple of its baseline time.')
+
+
+def measure(run, setup=lambda: None, repeat=5):
+    """Time run(setup()) repeatedly, only timing run. Returns the phase's result as a dict."""
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            state = setup()
+            start = time.perf_counter()
+            run(state)
+            times.append(time.perf_counter() - start)
+
+        state = setup()
+        tracemalloc.start()
+        run(state)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {"median_ms": round(1000 * statistics.median(times), 3), "min_ms": round(1000 * min(times), 3),
+            "peak_kb": round(peak / 1024, 1), "runs": repeat}
+
+
+def measureCli(path, outFile, repeat):
+    """Time mangle.py in a new interpreter."""
+    command = [sys.executable, os.path.join(ROOT, "mangle.py"), path, "-o", outFile] + MANGLE_COMMANDS
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return {"median_ms": round(1000 * statistics.median(times), 3), "min_ms": round(1000 * min(times), 3),
+            "runs": repeat}
+
+
+def mangled(path):
+    ds = readPlan(path)
+    mangleDataset(ds, MANGLE_COMMANDS)
+    return ds
+
+
+def benchmarkPlan(path, workDir, repeat, cli=True):
+    """Run every phase against the plan at path. Returns {phase: result}."""
+    outFile = os.path.join(workDir, "out.dcm")
+    filters = [parse(c) for c in FILTER_COMMANDS]
+    results = {}
+
+    results["read"] = measure(lambda state: readPlan(path), repeat=repeat)
+    results["parse"] = measure(lambda state: [parse.__wrapped__(c) for c in PARSE_COMMANDS], repeat=repeat)
+    results["filter"] = measure(lambda ds: [select(ds, cmd) for cmd in filters], lambda: readPlan(path), repeat)
+    for name, cmdStr in SETTER_COMMANDS.items():
+        cmd = parse(cmdStr)
+        results[name] = measure(lambda ds: applyCommand(ds, cmd), lambda: readPlan(path), repeat)
+    results["write"] = measure(lambda ds: writePlan(ds, outFile), lambda: mangled(path), repeat)
+    results["write-full"] = measure(lambda ds: writePlan(ds, outFile, delta=False), lambda: mangled(path), repeat)
+    results["mangle"] = measure(lambda state: writePlan(mangled(path), outFile), repeat=repeat)
+    if cli:
+        results["cli"] = measureCli(path, outFile, repeat)
+    return results
+
+
+def compare(results, baseline, maxRatio):
+    """Return a message for each phase which has slowed by more than maxRatio since the baseline."""
+    slower = []
+    for plan, phases in results.items():
+        for phase, result in phases.items():
+            before = baseline.get(plan, {}).get(phase)
+            if before and before["median_ms"] and result["median_ms"] > before["median_ms"] * maxRatio:
+                slower.append(plan + " " + phase + ": " + format(result["median_ms"], ".1f") + " ms, was "
+                              + format(before["median_ms"], ".1f") + " ms")
+    return slower
+
+
+def numpyVersion():
+    """The version of NumPy, which changes the path the position setters take, or None if it is not installed."""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy.__version__
+
+
+def main():
+    args = parser.parse_args()
+    presets = args.preset or sorted(PRESETS)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as workDir:
+        plans = [(name, writeSynthetic(os.path.join(workDir, name + ".dcm"), name)) for name in presets]
+        plans += [(os.path.basename(path), path) for path in args.file]
+
+        for name, path in plans:
+            print(name + " (" + format(os.path.getsize(path) / 1024, ".0f") + " KB)")
+            results[name] = benchmarkPlan(path, workDir, args.repeat, not args.no_cli)
+            for phase, result in results[name].items():
+                peak = result.get("peak_kb")
+                print("    " + format(phase, "12") + format(result["median_ms"], "10.2f") + " ms"
+                      + ("" if peak is None else format(peak, "12.0f") + " KB"))
+
+    report = {
+        "python": platform.python_version(),
+        "pydicom": pydicom.__version__,
+        "numpy": numpyVersion(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "repeat": args.repeat,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f)["results"], args.max_ratio)
+        for message in slower:
+            print("SLOWER - " + message)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""startup.py: Measures how long the mangle.py command line takes to start, and fails if it regresses."""
+
+# Imports
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+"""
+Startup Benchmark
+-----------------
+
+mangle.py is called from other tools many times a day, so --help and rejected arguments must return
+without loading pydicom or NumPy. Each case is run repeatedly in a fresh interpreter, and the median time
+beyond that of an empty interpreter is compared against a limit.
+
+"""
+
+CASES = {
+    "python": [sys.executable, "-c", "pass"],
+    "help": [sys.executable, "mangle.py", "-h"],
+    "invalid command": [sys.executable, "mangle.py", "plan.dcm", "b0 g=five"],
+    "import": [sys.executable, "-c",
+               "import sys, rtpmangle; rtpmangle.parse('b0 lb1 lp3 pr=+2%'); "
+               "sys.exit('pydicom' in sys.modules or 'numpy' in sys.modules)"],
+}
+
+parser = argparse.ArgumentParser(description='Benchmark the start up time of the mangle.py command line.')
+parser.add_argument('-n', '--repeat',
+    type=int,
+    default=20,
+    help='Number of times to run each case.')
+parser.add_argument('--max-ms',
+    type=float,
+    default=100,
+    help='Fail if any case takes longer than this beyond an empty interpreter, in milliseconds.')
+
+
+def timeCase(command, repeat):
+    """Return the median wall time of a command, in milliseconds, and the exit code of its last run."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        returncode = subprocess.run(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+        times.append(time.perf_counter() - start)
+    return 1000 * statistics.median(times), returncode
+
+
+def main():
+    args = parser.parse_args()
+
+    baseline, _ = timeCase(CASES["python"], args.repeat)
+    print(format("python", "16") + format(baseline, "8.1f") + " ms")
+
+    failed = False
+    for name, command in CASES.items():
+        if name == "python":
+            continue
+        median, returncode = timeCase(command, args.repeat)
+        overhead = median - baseline
+        status = "OK" if overhead <= args.max_ms else "SLOW"
+        if name == "import" and returncode:
+            status = "FAILED - pydicom or NumPy imported by parse()"
+        failed = failed or status != "OK"
+        print(format(name, "16") + format(median, "8.1f") + " ms  (+" + format(overhead, ".1f") + " ms)  " + status)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
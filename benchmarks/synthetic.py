@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""synthetic.py: Generates synthetic RT Plans, shaped like real treatments, for benchmarking and testing."""
+
+# Imports
+import argparse
+import math
+import random
+
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian, generate_uid
+
+RT_PLAN_STORAGE = "1.2.840.10008.5.1.4.1.1.481.5"
+
+"""
+Synthetic Plans
+---------------
+
+Plans are generated from a few shape parameters, so benchmarks can be run without patient data:
+
+    beams       - Number of beams (or arcs).
+    cps         - Control points per beam.
+    pairs       - MLC leaf pairs per bank, or 0 for a plan collimated by the jaws alone.
+    arc         - Rotate the gantry through each beam, alternating direction, as a VMAT arc does. Otherwise
+                  each beam is static at its own gantry angle, delivered step and shoot.
+    sparse      - Only give values in the control points where they change, as DICOM allows, rather than
+                  repeating them in every control point.
+    privateKB   - Size of a vendor private sequence, of undefined length, added to the plan.
+    implicit    - Write the plan in Implicit VR Little Endian, rather than Explicit.
+
+Leaf positions are random but repeatable, as each plan is generated from a fixed seed.
+
+"""
+
+# Named plan shapes. Varian's 120 leaf MLC has 60 leaf pairs.
+PRESETS = {
+    "imrt":        {"beams": 7, "cps": 20,  "pairs": 60, "arc": False, "sparse": True},
+    "vmat":        {"beams": 4, "cps": 178, "pairs": 60, "arc": True,  "sparse": False},
+    "vmat-vendor": {"beams": 4, "cps": 178, "pairs": 60, "arc": True,  "sparse": False, "privateKB": 4096},
+    "degenerate":  {"beams": 1, "cps": 2,   "pairs": 0,  "arc": False, "sparse": True},
+    "implicit":    {"beams": 2, "cps": 50,  "pairs": 60, "arc": True,  "sparse": True,  "implicit": True},
+}
+
+parser = argparse.ArgumentParser(description='Generate a synthetic RT Plan.')
+parser.add_argument('outFile',
+    help='Path of the plan to write.')
+parser.add_argument('-p', '--preset',
+    choices=sorted(PRESETS),
+    default="vmat",
+    help='Shape of plan to generate. The options below override it.')
+parser.add_argument('--beams', type=int, help='Number of beams.')
+parser.add_argument('--cps', type=int, help='Control points per beam.')
+parser.add_argument('--pairs', type=int, help='MLC leaf pairs per bank, 0 for no MLC.')
+parser.add_argument('--private-kb', dest='privateKB', type=int, help='Size of a vendor private sequence, in KB.')
+parser.add_argument('--seed', type=int, default=1, help='Random seed for the leaf positions.')
+
+
+def deviceItem(deviceType, positions):
+    item = Dataset()
+    item.RTBeamLimitingDeviceType = deviceType
+    item.LeafJawPositions = positions
+    return item
+
+
+def makeBeam(number, cps, pairs, arc, sparse, rng):
+    """Return a beam, with its control points."""
+    beam = Dataset()
+    beam.BeamNumber = number
+    beam.BeamName = ("Arc" if arc else "Field") + str(number)
+    beam.BeamType = "DYNAMIC" if arc else "STATIC"
+    beam.RadiationType = "PHOTON"
+    beam.TreatmentMachineName = "Linac 1"
+    beam.PrimaryDosimeterUnit = "MU"
+
+    devices = []
+    for deviceType in ("ASYMX", "ASYMY"):
+        device = Dataset()
+        device.RTBeamLimitingDeviceType = deviceType
+        device.NumberOfLeafJawPairs = 1
+        devices.append(device)
+    if pairs:
+        device = Dataset()
+        device.RTBeamLimitingDeviceType = "MLCX"
+        device.NumberOfLeafJawPairs = pairs
+        device.LeafPositionBoundaries = [round(-200 + i * 400 / pairs, 2) for i in range(pairs + 1)]
+        devices.append(device)
+    beam.BeamLimitingDeviceSequence = Sequence(devices)
+
+    # Arcs alternate direction, starting opposite 180. Static beams are spread evenly around the patient.
+    clockwise = number % 2 == 1
+    start = 181.0 if clockwise else 179.0
+    step = (358.0 / max(cps - 1, 1)) * (1 if clockwise else -1)
+    staticAngle = (number - 1) * 360.0 / 7 % 360
+
+    beam.NumberOfControlPoints = cps
+    controlPoints = []
+    for i in range(cps):
+        cp = Dataset()
+        cp.ControlPointIndex = i
+        cp.CumulativeMetersetWeight = round(i / max(cps - 1, 1), 6)
+        if arc:
+            cp.GantryAngle = round((start + i * step) % 360, 2)
+            cp.GantryRotationDirection = ("CW" if clockwise else "CC") if i < cps - 1 else "NONE"
+        elif i == 0 or not sparse:
+            cp.GantryAngle = round(staticAngle, 2)
+            cp.GantryRotationDirection = "NONE"
+        if i == 0 or not sparse:
+            cp.BeamLimitingDeviceAngle = 0.0 if arc else 10.0
+            cp.PatientSupportAngle = 0.0
+
+        positions = []
+        if i == 0 or not sparse:
+            positions.append(deviceItem("ASYMX", [-60.0, 60.0]))
+            positions.append(deviceItem("ASYMY", [-80.0, 80.0]))
+        if pairs:
+            centre = [math.sin((i + p) / 9.0) * 20 for p in range(pairs)]
+            widths = [rng.uniform(0.5, 40.0) for p in range(pairs)]
+            positions.append(deviceItem("MLCX", [round(c - w / 2, 2) for c, w in zip(centre, widths)]
+                                                + [round(c + w / 2, 2) for c, w in zip(centre, widths)]))
+        if positions:
+            cp.BeamLimitingDevicePositionSequence = Sequence(positions)
+        controlPoints.append(cp)
+    beam.ControlPointSequence = Sequence(controlPoints)
+    return beam
+
+
+def makePlan(beams=4, cps=178, pairs=60, arc=True, sparse=False, privateKB=0, implicit=False, seed=1):
+    """Return a synthetic RT Plan as a FileDataset, ready to be saved."""
+    rng = random.Random(seed)
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = RT_PLAN_STORAGE
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ImplicitVRLittleEndian if implicit else ExplicitVRLittleEndian
+
+    ds = FileDataset(None, {}, file_meta=meta, preamble=b"\0" * 128)
+    ds.SOPClassUID = RT_PLAN_STORAGE
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Modality = "RTPLAN"
+    ds.PatientName = "Synthetic^Phantom"
+    ds.PatientID = "SYNTH" + str(seed)
+    ds.RTPlanLabel = "Synthetic"
+    ds.RTPlanGeometry = "PATIENT"
+
+    ds.BeamSequence = Sequence([makeBeam(b + 1, cps, pairs, arc, sparse, rng) for b in range(beams)])
+
+    fractionGroup = Dataset()
+    fractionGroup.FractionGroupNumber = 1
+    fractionGroup.NumberOfFractionsPlanned = 30
+    fractionGroup.NumberOfBeams = beams
+    referenced = []
+    for b in range(beams):
+        item = Dataset()
+        item.ReferencedBeamNumber = b + 1
+        item.BeamMeterset = round(rng.uniform(80, 300), 3)
+        referenced.append(item)
+    fractionGroup.ReferencedBeamSequence = Sequence(referenced)
+    ds.FractionGroupSequence = Sequence([fractionGroup])
+
+    if privateKB:
+        # A vendor's private sequence of undefined length - the kind of payload the mangler should pass over.
+        items = []
+        for k in range(max(privateKB // 64, 1)):
+            item = Dataset()
+            item.private_block(0x0099, "SYNTHETIC VENDOR", create=True).add_new(0x01, "OB", rng.randbytes(64 * 1024))
+            items.append(item)
+        block = ds.private_block(0x0099, "SYNTHETIC VENDOR", create=True)
+        block.add_new(0x02, "SQ", Sequence(items))
+        block[0x02].is_undefined_length = True
+    return ds
+
+
+def writeSynthetic(path, preset="vmat", seed=1, **overrides):
+    """Generate a plan from a preset, with any of its parameters overridden, and save it to path."""
+    shape = dict(PRESETS[preset])
+    shape.update({k: v for k, v in overrides.items() if v is not None})
+    makePlan(seed=seed, **shape).save_as(path, enforce_file_format=True)
+    return path
+
+
+def main():
+    args = parser.parse_args()
+    writeSynthetic(args.outFile, args.preset, args.seed,
+                   beams=args.beams, cps=args.cps, pairs=args.pairs, privateKB=args.privateKB)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,10 +4,15 @@
 
 # Imports
 import argparse
-import shlex
-import re
-import pydicom
-from pydicom.uid import generate_uid
+import contextlib
+import sys
+from rtpmangle import CommandError
+from rtpmangle.command import readCommandFile
+from rtpmangle.sweep import expandVariants, runVariants
+from rtpmangle.timing import NO_TIMINGS, Timings
+
+# pydicom is only imported once the arguments have been checked, so --help and mistakes are reported
+# without waiting for it to load.
 
 """
 Parse Command Line Arguments
@@ -20,7 +25,7 @@ Uses argparse - https://docs.python.org/3/library/argparse.html
 parser = argparse.ArgumentParser(description='Modify a DICOM-RT Plan File to Add Delivery Errors.')
 parser.add_argument('inFile',                   # Use strings for filenames rather than file objects,
     type=str,                                   # allows pydicom to handle the file operations.
-    help='DICOM-RT Plan to Modify.')
+    help='DICOM-RT Plan to Modify. Use - to read the plan from stdin.')
 parser.add_argument("-v", "--verbose",
     help="increase output verbosity",
     action="store_true")
@@ -30,13 +35,51 @@ parser.add_argument("-k", "--keep_uid",
 parser.add_argument('-o', '--outFile',
     type=str,
     default="out.dcm",
-    help='Output File to create.',
+    help='Output File to create. Use - to write the plan to stdout.',
     nargs='?',)
+parser.add_argument('-f', '--file',
+    type=str,
+    action='append',
+    default=[],
+    metavar='FILE',
+    help='Read command strings from FILE, one per line, after those given on the command line. '
+         'May be given more than once.')
+parser.add_argument('-V', '--variants',
+    type=str,
+    help='File listing variants to create from the one input plan, one per line: '
+         'the output file followed by its command strings.')
+parser.add_argument('-j', '--jobs',
+    type=int,
+    default=None,
+    help='Number of worker processes used to generate variants and sweeps. Defaults to the number of CPUs.')
+parser.add_argument('--patch',
+    help='Write a compact patch against the input plan (out.rtpatch for out.dcm) in place of each output '
+         'plan. mangleMaterialize.py turns it back into the plan.',
+    action='store_true')
+parser.add_argument('--cache',
+    type=str,
+    metavar='DIR',
+    help='Reuse outputs made before from the same plan and command strings, kept in the cache directory DIR. '
+         'New SOPInstanceUIDs are derived from the plan and command strings, so outputs are reproducible.')
+parser.add_argument('--cache_mb',
+    type=float,
+    default=1024,
+    help='Size of the output cache, in MB (default 1024). The least recently used outputs are removed.')
+parser.add_argument('-P', '--profile',
+    help='Print a JSON breakdown of where the time went to stderr.',
+    action='store_true')
+parser.add_argument('--profile-file',
+    type=str,
+    metavar='FILE',
+    help='Write the JSON timing breakdown to FILE instead of stderr.')
+parser.add_argument('--cprofile',
+    type=str,
+    metavar='FILE',
+    help='Also write cProfile statistics of the run to FILE, to be read with pstats.')
 parser.add_argument('commandString',
     type=str,
     help='A Mangle command string describing how to alter the file. See documentation for details.',
-    nargs='+',)
-args = parser.parse_args()
+    nargs='*',)
 
 
 """
@@ -46,9 +89,8 @@ Parse the Command Strings
 See wiki documentation for full instructions. The command strings instruct the script on how to
 edit the RTPlan. They consist of two types: filters and setters.
 
-Filters specify what needs to be edited; the specific beams and control points within the file. The
-intention is to ultimately be able to finely filter, by gantry angle for example, or CPs with less than
-a certain MU.
+Filters specify what needs to be edited; the specific beams and control points within the file. Control
+points can also be chosen finely by value - by gantry or collimator angle, or by cumulative meterset weight.
 
 Setters are the methods through which we change the file. Parameters can either be specified exactly,
 or they can be relative, such as +x% or +y units.
@@ -58,294 +100,139 @@ using the filters.
 
 """
 
-# Open DICOM File in pydicom and retrieve a dataset:
-ds = pydicom.dcmread(args.inFile)
-
-# Unless Instructed, change the file's UID to prevent duplicates. 
-if not args.keep_uid:
-    ds.SOPInstanceUID = generate_uid()
-
-# Parse Command Strings
-if args.verbose:
-    print("Found " + str(len(args.commandString)) + " command string(s)." )
-
-for cmdStr in args.commandString:
-    if args.verbose:
-        print("\nProcessing Command String: " + cmdStr + "\n" )
-    
-    # Prevent Simultaneous Jaw and MLC editing.
-    if "lp" in cmdStr or "lb" in cmdStr:
-        if "jb" in cmdStr or "j" in cmdStr:
-            print("ERROR: Cannot Edit Leaf and Jaw positions in the same command.\n")
-            raise ValueError
-
-    # Prevent Simultaneous Relative and Absoulte edits.
-    if "pr=" in cmdStr and "pa=" in cmdStr:
-        print("ERROR: Cannot Edit Relative and Absolute positions in the same command.\n")
-        raise ValueError
-
-    cmds = shlex.split(cmdStr)
-
-    filters = []
-    beams = []
-    cps = []
-    pairs = []
-
-    filters.append({"name": "beam",        "key": "b",   "default": "*", "matches": ""})
-    filters.append({"name": "control pt",  "key": "cp",  "default": "*", "matches": ""})
-    filters.append({"name": "jaw",         "key": "j",   "default": "*", "matches": ""})
-    filters.append({"name": "jaw bank",    "key": "jb",  "default": "*", "matches": ""})
-    filters.append({"name": "leaf pair",   "key": "lp",  "default": "*", "matches": ""})
-    filters.append({"name": "leaf bank",   "key": "lb",  "default": "*", "matches": ""})
-
-    for f in filters:
-        
-        r = re.compile("(^" + f["key"] + "\d+)")
-        reArgs = list(filter(r.match, cmds))
-
-        if len(reArgs) > 1:
-            # More than one fstring.
-            print("ERROR: More than one " + f["name"] + " filter found.\n")
-            raise ValueError
-        elif len(reArgs) < 1:
-            reArgs = [f['key'] + f["default"]]
-
-        # Remove the key from the command
-        reArgs = reArgs[0][len(f["key"]):]
-                
-        if args.verbose and reArgs != f["default"]:
-            print("Found " + f["name"] + " filter - Value: " + reArgs)
-
-        # Handle Multiple Specified Values
-        reArgs = reArgs.split(",")
-
-        # Handle Range of Values
-        for i in reArgs:
-            if "-" in i:
-                reArgs.remove(i)
-                for j in range(int(i.split("-")[0]), int(i.split("-")[1])+1):
-                    reArgs.append(str(j))
-
-        f["matches"] = reArgs
-
-        # Gather the data to act upon
-        if f["name"] == "beam": # Build the Beam list.
-            if f["matches"][0] == "*":
-                beams = ds.BeamSequence
-            else:
-                for i in f["matches"]:
-                    try:
-                        beams.append(ds.BeamSequence[int(i)])
-                    except IndexError:
-                        print("WARNING: Beam Index Out of Plan Range - Ignoring beam " + i + ".\n")
-        elif f["name"] == "control pt": # Build the CP list.
-            if f["matches"][0] == "*":
-                for beam in beams:
-                    for cp in beam.ControlPointSequence:
-                        cps.append(cp)
-            else:
-                for beam in beams:
-                    for i in f["matches"]:
-                        try:
-                            cps.append(beam.ControlPointSequence[int(i)])
-                        except IndexError:
-                            print("WARNING: Control Point Index Out of Beam Range - Ignoring CP " + i + ".\n")
-        elif f["name"] == "jaw" or f["name"] == "jaw bank" or f["name"] == "leaf bank":
-            if f["matches"][0] == "*":
-                f["matches"] = list(range(0, 2))
-
-        elif f["name"] == "leaf pair":
-                maxPairs = 0
-                for bld in beams[0].BeamLimitingDeviceSequence:
-                    if bld.RTBeamLimitingDeviceType == "MLCX" or bld.RTBeamLimitingDeviceType == "MLCY":
-                        if int(bld.NumberOfLeafJawPairs) > maxPairs:
-                            maxPairs = bld.NumberOfLeafJawPairs
-                if f["matches"][0] == "*":
-                    f["matches"] = list(range(0, maxPairs))
 
+def main():
+    args = parser.parse_intermixed_args()
+
+    try:
+        for path in args.file:
+            args.commandString += readCommandFile(path)
+    except OSError as e:
+        parser.error(str(e))
+    if not args.commandString and not args.variants:
+        parser.error("at least one command string, a command file (-f) or a variants file (-V), is required")
+    timings = Timings() if args.profile or args.profile_file else NO_TIMINGS
+
+    # Gather the variants to create - command strings given on the command line are applied before those
+    # of each variant. Sweeps are expanded into one variant per combination of their values, and every
+    # command string is compiled before opening the plan, so mistakes are reported immediately.
+    try:
+        if args.variants:
+            from rtpmangle.variants import readVariantFile
+            variants = [(outFile, args.commandString + cmdStrs) for outFile, cmdStrs in readVariantFile(args.variants)]
+        else:
+            variants = [(args.outFile, args.commandString)]
+        variants = expandVariants(variants)
+        with timings.phase("parse"):
+            for outFile, cmdStrs in variants:
+                for cmdStr in cmdStrs:
+                    timings.parse(cmdStr)
+    except (CommandError, ValueError, OSError) as e:
+        parser.error(str(e))
+    if args.outFile == "-" and (args.variants or len(variants) > 1):
+        parser.error("only a single plan can be written to stdout (-o -)")
+    if args.patch and "-" in (args.inFile, args.outFile):
+        parser.error("--patch needs the input plan and the output file to be files")
+    if args.patch and args.cache:
+        parser.error("--cache holds output plans, so cannot be used with --patch")
+    if timings is not NO_TIMINGS and len(variants) > 1:
+        parser.error("--profile times a single plan, so cannot be used with variants or sweeps")
+
+    if args.cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            run(args, variants, timings)
+        finally:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
+    else:
+        run(args, variants, timings)
+
+    if args.profile_file:
+        timings.dump(args.profile_file)
+    elif args.profile:
+        timings.dump(sys.stderr)
+
+
+def run(args, variants, timings):
+    """Read the plan, mangle it and write the output files."""
+
+    # A plan read from stdin is read once here, and its bytes used in place of the file.
+    source = sys.stdin.buffer.read() if args.inFile == "-" else args.inFile
+    cache = None
+    if args.cache:
+        from rtpmangle.cache import OutputCache, cacheKey, fileHash, keyUID
+        cache = OutputCache(args.cache, int(args.cache_mb * 1024 * 1024))
+
+    if len(variants) > 1:
+        # Each worker reads the plan once, and each variant copies only what its own edits touch.
+        for outFile in runVariants(source, variants, args.keep_uid, args.verbose, args.jobs, args.patch, cache):
+            print("Output File " + outFile + " created.")
+        return
+
+    # When the plan is written to stdout, any messages go to stderr instead so they are kept out of it.
+    outFile, cmdStrs = variants[0]
+    destination = sys.stdout.buffer if outFile == "-" else outFile
+    uid = None
+    if cache is not None:
+        # An output made before is copied from the cache, without importing pydicom or reading the plan.
+        with timings.phase("cache"):
+            key = cacheKey(fileHash(source)[0], cmdStrs, args.keep_uid)
+            if cache.fetch(key, destination):
+                if outFile == "-":
+                    sys.stdout.buffer.flush()
+                else:
+                    print("Output File " + outFile + " created from the cache.")
+                return
+        uid = None if args.keep_uid else keyUID(key)
 
-    """
-    Perform the edits
+    with timings.phase("import"):
+        from rtpmangle import mangleDataset, planBytes, readPlan, writePlan
 
-    Now we have gathered the items to be edited, we can start looking at the setters.
+    with contextlib.redirect_stdout(sys.stderr if outFile == "-" else sys.stdout):
 
-    """
+        # Open DICOM File and retrieve a dataset, decoding only the beams and fraction groups:
+        with timings.phase("read"):
+            ds = readPlan(source)
 
-    # Perform Edits
-    setters = []
-    setters.append({"name": "MU",                  "type": "int",   "key": "mu="})
-    setters.append({"name": "Machine",             "type": "str",   "key": "m="})
-    setters.append({"name": "Gantry",              "type": "int",   "key": "g=",     "attr": "GantryAngle"})
-    setters.append({"name": "Collimator",          "type": "int",   "key": "c=",     "attr": "BeamLimitingDeviceAngle"})
-    setters.append({"name": "Position Absolute",   "type": "int",   "key": "pa=",    "attr": "BeamLimitingDevicePositionSequence"})
-    setters.append({"name": "Position Relative",   "type": "int",   "key": "pr=",    "attr": "BeamLimitingDevicePositionSequence"})
-    
-    for s in setters:
-
-        if s["type"] == "int":
-            r = re.compile("(" + s["key"] + "[+-]?\d+%?)")
+        # Perform the edits, changing the file's UID unless instructed otherwise. A patch is made against
+        # the original plan, so it is left unchanged and the edits are made to a variant of it.
+        if args.patch:
+            from rtpmangle.variants import mangleVariant
+            variant = mangleVariant(ds, cmdStrs, args.keep_uid, args.verbose, timings=timings)
         else:
-            r = re.compile("(" + s["key"] + "[\']?[a-zA-Z0-9\ ]+[\']?)")
-            
-        reArgs = list(filter(r.match, cmds))
-
-        if len(reArgs) > 1:
-            # More than one fstring.
-            print("ERROR: More than one " + s["name"] + " set command found.\n")
-            raise ValueError
-        elif len(reArgs) != 1:
-            continue
-
-        # Remove the key from the command
-        reArg = reArgs[0][len(s["key"]):]
-        
-        if args.verbose:
-            print("Found " + s["name"] + " setter - Value: " + reArg)
-
-        if s["name"] == "MU":
-            for beam in beams:
-                cmdArg = reArg
-                meterset = ds.FractionGroupSequence[0].ReferencedBeamSequence[beam.BeamNumber - 1].BeamMeterset
-                if cmdArg[0] == "+":
-                    cmdArg = cmdArg[1:]
-                    if cmdArg[-1] == "%":
-                        cmdArg = cmdArg[:-1]
-                        ds.FractionGroupSequence[0].ReferencedBeamSequence[beam.BeamNumber - 1].BeamMeterset = meterset * (1+(float(cmdArg)/100))
-                    else:
-                        ds.FractionGroupSequence[0].ReferencedBeamSequence[beam.BeamNumber - 1].BeamMeterset = meterset + float(cmdArg)
-
-                elif cmdArg[0] == "-":
-                    cmdArg = cmdArg[1:]
-                    if cmdArg[-1] == "%":
-                        cmdArg = cmdArg[:-1]
-                        ds.FractionGroupSequence[0].ReferencedBeamSequence[beam.BeamNumber - 1].BeamMeterset = meterset * (1-(float(cmdArg)/100))
-                    else:
-                        ds.FractionGroupSequence[0].ReferencedBeamSequence[beam.BeamNumber - 1].BeamMeterset = meterset - float(cmdArg)
-                else:
-                     meterset = cmdArg
-        elif s["name"] == "Machine":
-            for beam in beams:
-                cmdArg = reArg
-                beam.TreatmentMachineName = cmdArg
+            mangleDataset(ds, cmdStrs, args.keep_uid, args.verbose, timings=timings, uid=uid)
+
+    """
+    Write the output file.
+    """
+
+    if args.patch:
+        from rtpmangle.patch import fileHash, makePatch, patchName, writePatch
+        with timings.phase("write"):
+            patch = makePatch(ds, variant, cmdStrs, args.keep_uid, fileHash(source), source)
+            writePatch(patch, patchName(outFile))
+        print("Patch File " + patchName(outFile) + " created.")
+        return
+
+    with timings.phase("write"):
+        if outFile != "-":
+            writePlan(ds, outFile)
+            data = outFile
+        elif cache is not None:
+            data = planBytes(ds)
+            sys.stdout.buffer.write(data)
         else:
-            for cp in cps:
-                cmdArg = reArg
-                if hasattr(cp, s["attr"]):
-                    # Handle Jaw/MLC Changes
-                    if s['name'] == "Position Absolute" or s['name'] == "Position Relative":
-                        if "lp" in cmdStr or "lb" in cmdStr:
-                            # MLCs
-                            
-                            # Collect the list of Leaf Banks and Leaf Pairs that must be edited.
-                            lb = [lb["matches"] for lb in filters if lb['name'] == 'leaf bank'][0]
-                            lp = [lp["matches"] for lp in filters if lp['name'] == 'leaf pair'][0]
-                            lb = [int(i) for i in lb] 
-                            lp = [int(i) for i in lp] 
-
-                            # Cycle Through the BLD Sequences in the control point. Look for "MLCX" or "MLCY" - Note that futuristic machines with both MLCX and MLCY won't work!
-                            for bld in cp.BeamLimitingDevicePositionSequence:
-                                if bld.RTBeamLimitingDeviceType == "MLCX" or bld.RTBeamLimitingDeviceType == "MLCY":
-                                    # Split the Banks up - DICOM stores the MLCs in one long list. 
-                                    banks = []
-                                    banks.append(bld.LeafJawPositions[:maxPairs])
-                                    banks.append(bld.LeafJawPositions[maxPairs:])
-                                    
-                                    # For each bank
-                                    for bank in lb:
-                                        bank = int(bank)
-                                        if s['name'] == "Position Absolute":
-                                            for pair in lp:
-                                                # Absolute Position Specified. Set each of the pairs to modify in this bank to that value. 
-                                                banks[bank][pair] = cmdArg
-                                        elif s['name'] == "Position Relative":
-                                            if cmdArg[0] == "-":
-                                                cmdArgV = cmdArg[1:]
-                                                if cmdArg[-1] == "%":
-                                                    cmdArgV = cmdArgV[:-1]
-                                                    for pair in lp:
-                                                        # Negative Percentage Relative Edit. Decrement the existing value by x%.
-                                                        banks[bank][pair] = float(banks[bank][pair]) * (1 - (float(cmdArgV)/100))
-                                                else:
-                                                    for pair in lp:
-                                                        # Negative Relative Edit. Decrease the exisiting value.
-                                                        banks[bank][pair] = float(banks[bank][pair]) - float(cmdArgV)
-                                            else:
-                                                cmdArgV = cmdArg
-                                                if cmdArg[0] == "+":
-                                                    cmdArgV = cmdArg[1:]
-                                                if cmdArg[-1] == "%":
-                                                    cmdArgV = cmdArgV[:-1]
-                                                    for pair in lp:
-                                                        # Positive Percentage Relative Edit. Increment the existing value by x%.
-                                                        banks[bank][pair] = float(banks[bank][pair]) * (1 + (float(cmdArgV)/100))
-                                                else:
-                                                    for pair in lp:
-                                                        # Positive Relative Edit. Increase the exisiting value.
-                                                        banks[bank][pair] = float(banks[bank][pair]) + float(cmdArgV)
-                                            
-
-                                    bld.LeafJawPositions = banks[0] + banks[1]
-
-                        elif "jb" in cmdStr or "j" in cmdStr:
-                            # Jaws
-                            jb = [jb["matches"] for jb in filters if jb['name'] == 'jaw bank'][0]
-                            j =  [j["matches"]  for j  in filters if j['name']  == 'jaw'][0]
-
-                            target = ""
-                            for jaw in j:
-                                if int(jaw) == 0:
-                                    target = "ASYMX"
-                                elif int(jaw) == 1:
-                                    target = "ASYMY"
-
-                                for bld in cp.BeamLimitingDevicePositionSequence:
-                                    if bld.RTBeamLimitingDeviceType == target:
-                                        for bank in jb:
-                                            if s['name'] == "Position Absolute":
-                                                bld.LeafJawPositions[int(bank)] = cmdArg
-                                            elif s['name'] == "Position Relative":
-                                                if cmdArg[0] == "-":
-                                                    cmdArgV = cmdArg[1:]
-                                                    if cmdArg[-1] == "%":
-                                                        cmdArgV = cmdArgV[:-1]
-                                                        # Negative Percentage Relative Edit. Decrement the existing value by x%.
-                                                        bld.LeafJawPositions[int(bank)] = bld.LeafJawPositions[int(bank)] * (1 - (float(cmdArgV)/100))
-                                                    else:
-                                                        # Negative Relative Edit. Increase the exisiting value.
-                                                        bld.LeafJawPositions[int(bank)] = bld.LeafJawPositions[int(bank)] - float(cmdArgV)
-                                                else: 
-                                                    cmdArgV = cmdArg
-                                                    if cmdArg[0] == "+":
-                                                        cmdArgV = cmdArg[1:]                                       
-                                                    if cmdArg[-1] == "%":
-                                                        cmdArgV = cmdArgV[:-1]
-                                                        # Positive Percentage Relative Edit. Increment the existing value by x%.
-                                                        bld.LeafJawPositions[int(bank)] = bld.LeafJawPositions[int(bank)] * (1 + (float(cmdArgV)/100))
-                                                    else:
-                                                        # Positive Relative Edit. Increase the exisiting value.
-                                                        bld.LeafJawPositions[int(bank)] = bld.LeafJawPositions[int(bank)] + float(cmdArgV)
-
-                    # Handle Gantry/Collimator Changes
-                    elif cmdArg[0] == "+":
-                        cmdArg = cmdArg[1:]
-                        if cmdArg[-1] == "%":
-                            cmdArg = cmdArg[:-1]
-                            exec("cp." + s["attr"] + "= (cp." + s["attr"] + " * (1 + (" + cmdArg + "/100))")
-                        else:
-                            exec("cp." + s["attr"] + "= (cp." + s["attr"] + " + " + cmdArg + ")")
-                    elif cmdArg[0] == "-":
-                        cmdArg = cmdArg[1:]
-                        if cmdArg[-1] == "%":
-                            cmdArg = cmdArg[:-1]
-                            exec("cp." + s["attr"] + "= (cp." + s["attr"] + " * (1 - (" + cmdArg + "/100))")
-                        else:
-                            exec("cp." + s["attr"] + "= (cp." + s["attr"] + " - " + cmdArg + ")")
-                    else:
-                        exec("cp." + s["attr"] + "=" + cmdArg)
+            writePlan(ds, sys.stdout.buffer)
+        if outFile == "-":
+            sys.stdout.buffer.flush()
+        if cache is not None:
+            cache.put(key, data)
+    if outFile != "-":
+        print("Output File " + outFile + " created.")
 
-"""
-Write the output file.
-"""
 
-ds.save_as(args.outFile)
-print("Output File " + args.outFile + " created.")
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+"""mangleBatch.py: Applies Mangle command strings to every DICOM-RT Plan in a directory."""
+
+# Imports
+import argparse
+import json
+import sys
+import time
+from rtpmangle import CommandError, parse
+from rtpmangle.batch import findPlans, runBatch
+from rtpmangle.sweep import expandSweep
+
+"""
+Parse Command Line Arguments
+----------------------------
+
+Uses argparse - https://docs.python.org/3/library/argparse.html
+
+"""
+
+parser = argparse.ArgumentParser(description='Apply the same Delivery Errors to a library of DICOM-RT Plans.')
+parser.add_argument('source',
+    type=str,
+    help='Directory of plans (searched recursively for .dcm files), or a quoted glob pattern.')
+parser.add_argument('-o', '--outDir',
+    type=str,
+    default="mangled",
+    help='Output directory. The directory structure of the input plans is mirrored below it.')
+parser.add_argument("-k", "--keep_uid",
+    help="Keep Original Instance UID",
+    action="store_true")
+parser.add_argument('-j', '--jobs',
+    type=int,
+    default=None,
+    help='Number of worker processes. Defaults to the number of CPUs.')
+parser.add_argument('--cache',
+    type=str,
+    metavar='DIR',
+    help='Reuse outputs made before from the same plan and command strings, kept in the cache directory DIR.')
+parser.add_argument('--cache_mb',
+    type=float,
+    default=1024,
+    help='Size of the output cache, in MB (default 1024). The least recently used outputs are removed.')
+parser.add_argument('-s', '--summary',
+    type=str,
+    help='Also write the summary, with the result of every plan, to this JSON file.')
+parser.add_argument('commandString',
+    type=str,
+    help='A Mangle command string describing how to alter the files. See documentation for details.',
+    nargs='+',)
+
+
+def main():
+    args = parser.parse_intermixed_args()
+
+    # Compile every command string before starting, so mistakes are reported immediately.
+    try:
+        for label, cmdStrs in expandSweep(args.commandString):
+            for cmdStr in cmdStrs:
+                parse(cmdStr)
+    except (CommandError, ValueError) as e:
+        parser.error(str(e))
+
+    plans, root = findPlans(args.source)
+    if not plans:
+        parser.error("no plans found in " + args.source)
+
+    cache = None
+    if args.cache:
+        from rtpmangle.cache import OutputCache
+        cache = OutputCache(args.cache, int(args.cache_mb * 1024 * 1024))
+
+    start = time.perf_counter()
+    results = []
+    for plan, outFiles, seconds, error in runBatch(plans, root, args.outDir, args.commandString, args.keep_uid, args.jobs, cache):
+        results.append({"plan": plan, "outFiles": outFiles, "seconds": round(seconds, 4), "error": error})
+        if error:
+            print("FAILED  " + plan + " - " + error)
+        else:
+            print("OK      " + plan + " (" + str(len(outFiles)) + " file(s), " + format(seconds * 1000, ".0f") + " ms)")
+    elapsed = time.perf_counter() - start
+
+    """
+    Summary
+    """
+
+    failed = [r for r in results if r["error"]]
+    times = [r["seconds"] for r in results]
+    print("\n" + str(len(results) - len(failed)) + " succeeded, " + str(len(failed)) + " failed, "
+          + str(sum(len(r["outFiles"]) for r in results)) + " file(s) written in " + format(elapsed, ".2f") + " s.")
+    print("Per plan: mean " + format(1000 * sum(times) / len(times), ".0f") + " ms, max "
+          + format(1000 * max(times), ".0f") + " ms.")
+
+    if args.summary:
+        with open(args.summary, "w") as f:
+            json.dump({"succeeded": len(results) - len(failed), "failed": len(failed),
+                       "seconds": round(elapsed, 4), "plans": results}, f, indent=2)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
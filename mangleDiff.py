@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""mangleDiff.py: Reports what changed between an original DICOM-RT Plan and its mangled variants."""
+
+# Imports
+import argparse
+import json
+import sys
+import time
+from rtpmangle import readPlan
+
+"""
+Parse Command Line Arguments
+----------------------------
+
+Uses argparse - https://docs.python.org/3/library/argparse.html
+
+"""
+
+parser = argparse.ArgumentParser(description='Compare DICOM-RT Plans beam by beam and control point by control point.')
+parser.add_argument('original',
+    type=str,
+    help='The plan to compare against.')
+parser.add_argument('variants',
+    type=str,
+    help='Plans to compare with the original.',
+    nargs='+')
+parser.add_argument('-t', '--tolerance',
+    type=float,
+    default=1e-4,
+    help='Ignore differences no larger than this.')
+parser.add_argument('-v', '--verbose',
+    help='List every control point that changed.',
+    action='store_true')
+parser.add_argument('--json',
+    type=str,
+    help='Also write every difference, keyed by variant, to this JSON file.')
+
+
+def main():
+    args = parser.parse_args()
+    try:
+        from rtpmangle.diff import diffPlans, formatDiff, planArrays
+    except ImportError:
+        parser.error("comparing plans requires NumPy")
+
+    # The original is read once, however many variants it is compared with.
+    original = readPlan(args.original)
+    originalArrays = planArrays(original)
+
+    start = time.perf_counter()
+    reports = {}
+    for variant in args.variants:
+        try:
+            reports[variant] = diffPlans(original, readPlan(variant), args.tolerance, arraysA=originalArrays)
+        except Exception as e:
+            reports[variant] = {"error": str(e)}
+            print("FAILED  " + variant + " - " + str(e))
+            continue
+        print(("SAME    " if reports[variant]["identical"] else "CHANGED ") + variant)
+        if not reports[variant]["identical"]:
+            for line in formatDiff(reports[variant], args.verbose):
+                print("    " + line)
+    elapsed = time.perf_counter() - start
+
+    if len(args.variants) > 1:
+        changed = len([r for r in reports.values() if not r.get("identical", False)])
+        print("\n" + str(changed) + " of " + str(len(reports)) + " plan(s) differ, compared in "
+              + format(elapsed, ".2f") + " s.")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"original": args.original, "tolerance": args.tolerance, "variants": reports}, f, indent=2)
+
+    if any(not r.get("identical", False) for r in reports.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
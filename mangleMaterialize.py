@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+"""mangleMaterialize.py: Turns patches written by mangle.py --patch back into DICOM-RT Plan files."""
+
+# Imports
+import argparse
+import os
+import sys
+import time
+
+"""
+Parse Command Line Arguments
+----------------------------
+
+Uses argparse - https://docs.python.org/3/library/argparse.html
+
+"""
+
+parser = argparse.ArgumentParser(description='Rebuild mangled DICOM-RT Plans from their patches.')
+parser.add_argument('patches',
+    type=str,
+    help='Patch files (.rtpatch) to rebuild.',
+    nargs='+')
+parser.add_argument('-b', '--base',
+    type=str,
+    help='The plan the patches were made from. Defaults to the path recorded in each patch.')
+parser.add_argument('-o', '--outFile',
+    type=str,
+    help='Output file, when rebuilding a single patch. Defaults to the patch name ending in .dcm.')
+parser.add_argument('-d', '--outDir',
+    type=str,
+    help='Write the plans to this directory, rather than beside their patches.')
+
+
+def outputName(patchFile, outDir=None):
+    """The plan rebuilt from patchFile - out.rtpatch gives out.dcm, in outDir if given."""
+    name = os.path.splitext(patchFile[:-3] if patchFile.endswith(".gz") else patchFile)[0] + ".dcm"
+    return os.path.join(outDir, os.path.basename(name)) if outDir else name
+
+
+def main():
+    args = parser.parse_args()
+    if args.outFile and len(args.patches) > 1:
+        parser.error("-o can only be used with a single patch - use -d for several")
+
+    from rtpmangle import writePlan
+    from rtpmangle.patch import PatchBases, materialize, readPatch
+
+    if args.outDir:
+        os.makedirs(args.outDir, exist_ok=True)
+
+    # Each base plan is read and hashed once, however many of the patches were made from it.
+    bases = PatchBases()
+    start = time.perf_counter()
+    failed = 0
+    for patchFile in args.patches:
+        outFile = args.outFile or outputName(patchFile, args.outDir)
+        try:
+            writePlan(materialize(readPatch(patchFile), args.base, bases), outFile)
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            print("FAILED  " + patchFile + " - " + str(e))
+            failed += 1
+            continue
+        print("Output File " + outFile + " created.")
+
+    if len(args.patches) > 1:
+        print("\n" + str(len(args.patches) - failed) + " plan(s) rebuilt, " + str(failed) + " failed, in "
+              + format(time.perf_counter() - start, ".2f") + " s.")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""mangleServer.py: Runs Mangle as a long running service, keeping recently used plans in memory."""
+
+# Imports
+import argparse
+
+"""
+Parse Command Line Arguments
+----------------------------
+
+Uses argparse - https://docs.python.org/3/library/argparse.html
+
+"""
+
+parser = argparse.ArgumentParser(description='Serve Mangle requests over HTTP, keeping recently used plans parsed in memory.')
+parser.add_argument('-p', '--port',
+    type=int,
+    default=8765,
+    help='Port to listen on (default 8765).')
+parser.add_argument('--host',
+    type=str,
+    default="127.0.0.1",
+    help='Address to listen on. Defaults to the local machine only.')
+parser.add_argument('-u', '--socket',
+    type=str,
+    help='Listen on this Unix socket instead of a port.')
+parser.add_argument('-r', '--root',
+    type=str,
+    help='Directory requests may read plans from and write output files to, by path. Without it, plans must be uploaded and are returned in the response.')
+parser.add_argument('-m', '--cache_mb',
+    type=float,
+    default=512,
+    help='Total file size of the plans to keep cached, in MB (default 512).')
+
+
+def main():
+    args = parser.parse_args()
+
+    from rtpmangle.server import MangleServer, UnixMangleServer
+
+    cacheBytes = int(args.cache_mb * 1024 * 1024)
+    if args.socket:
+        server = UnixMangleServer(args.socket, cacheBytes, args.root)
+        print("Mangle service listening on " + args.socket)
+    else:
+        server = MangleServer((args.host, args.port), cacheBytes, args.root)
+        print("Mangle service listening on http://" + args.host + ":" + str(server.server_address[1]))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
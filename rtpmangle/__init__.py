@@ -0,0 +1,49 @@
+"""rtpmangle: Modifies DICOM-RT Plan datasets to create intentional delivery errors.
+
+The library takes a pydicom Dataset in and gives a Dataset out:
+
+    ds = readPlan("plan.dcm")
+    mangleDataset(ds, ["b0 g=+5"])              # Edits ds in place, and returns it.
+    variant = mangleVariant(ds, ["mu=+2%"])     # Returns an edited copy, leaving ds unchanged.
+    data = planBytes(variant)                   # Or writePlan(variant, "out.dcm")
+
+readPlan() and writePlan() accept paths or binary file objects, and readPlan() also accepts bytes, so plans
+can be passed between tools without temporary files.
+writePlan() copies the elements which have never been decoded from the original file, and encodes the rest
+(see writer.py).
+
+All state lives in the datasets and compiled commands passed in, so separate datasets may be mangled from
+separate threads. Compiling command strings needs neither pydicom nor NumPy - the modules that do are only
+imported when first used, so tools which just validate command strings start quickly.
+"""
+
+# Imports
+import importlib
+
+from .command import Command, CommandError, Operand, parse
+from .setters import BaseSetter, ControlPointSetter, registerSetter
+
+# Names imported from their modules on first use, as these modules import pydicom.
+_LAZY = {
+    "applyCommand": "engine",
+    "mangleDataset": "engine",
+    "mangleVariant": "variants",
+    "mangleVariants": "variants",
+    "readPlan": "reader",
+    "readPlanBytes": "reader",
+    "writePlan": "writer",
+    "planBytes": "writer",
+    "markModified": "writer",
+    "LoadedPlan": "session",
+    "EditHistory": "session",
+    "JobQueue": "jobs",
+    "diffPlans": "diff",
+    "makePatch": "patch",
+    "applyPatch": "patch",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        return getattr(importlib.import_module("." + _LAZY[name], __name__), name)
+    raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
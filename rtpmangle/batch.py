@@ -0,0 +1,66 @@
+"""batch.py: Applies the same command strings to a whole library of plans on a pool of worker processes."""
+
+# Imports
+import glob
+import os
+import time
+
+from .sweep import expandSweep, labelledName, writeVariants
+
+
+def findPlans(source):
+    """Return the plans in a directory (searched recursively for .dcm files) or matching a glob pattern,
+    along with the root directory their output paths are mirrored from."""
+    if os.path.isdir(source):
+        plans = []
+        for directory, subdirectories, files in os.walk(source):
+            subdirectories.sort()
+            plans += [os.path.join(directory, f) for f in sorted(files) if f.lower().endswith(".dcm")]
+        return plans, source
+
+    plans = sorted(p for p in glob.glob(source, recursive=True) if os.path.isfile(p))
+    if not plans:
+        return [], ""
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in plans])
+    return plans, root
+
+
+def outputVariants(plan, root, outDir, commandStrings):
+    """The (outFile, commandStrings) variants of a plan, mirroring its path below root into outDir."""
+    outFile = os.path.join(outDir, os.path.relpath(os.path.abspath(plan), os.path.abspath(root)))
+    return [(labelledName(outFile, label), cmdStrs) for label, cmdStrs in expandSweep(commandStrings)]
+
+
+def mangleFile(plan, variants, keep_uid=False, cache=None):
+    """Write the variants of one plan. Returns (plan, outFiles, seconds, error) - failures are reported
+    rather than raised, so one bad plan does not stop the batch."""
+    start = time.perf_counter()
+    try:
+        for outFile, cmdStrs in variants:
+            os.makedirs(os.path.dirname(outFile) or ".", exist_ok=True)
+        outFiles = writeVariants(plan, variants, keep_uid, cache=cache)
+        return plan, outFiles, time.perf_counter() - start, None
+    except Exception as e:
+        return plan, [], time.perf_counter() - start, type(e).__name__ + ": " + str(e)
+
+
+def runBatch(plans, root, outDir, commandStrings, keep_uid=False, jobs=None, cache=None):
+    """Apply the command strings to every plan, using up to jobs processes, reusing the outputs held in a
+    cache.OutputCache if one is given.
+
+    Yields the (plan, outFiles, seconds, error) result of each plan as it completes.
+    """
+    jobs = min(jobs or os.cpu_count() or 1, len(plans))
+    work = [(plan, outputVariants(plan, root, outDir, commandStrings)) for plan in plans]
+
+    if jobs <= 1:
+        for plan, variants in work:
+            yield mangleFile(plan, variants, keep_uid, cache)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(mangleFile, plan, variants, keep_uid, cache) for plan, variants in work]
+        for future in as_completed(futures):
+            yield future.result()
@@ -0,0 +1,142 @@
+"""cache.py: A cache of mangled plan files on disk, keyed by the plan and the commands they were made with."""
+
+# Imports
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from .command import parse
+
+"""
+Output Cache
+------------
+
+Regenerating the same variants of the same plans, as nightly jobs do, need not mangle them again. Each output
+is stored under a key hashed from:
+
+    - The SHA-256 hash of the input plan's bytes.
+    - Its command strings, normalised, so "b0  mu=+10.0" and "b0 mu=+10" share an output. Values are kept to
+      full precision, so "mu=123.4567" and "mu=123.4571" do not.
+    - Whether the original SOPInstanceUID was kept.
+
+Checking the cache needs neither pydicom nor the plan to be parsed, so a cached output is returned as quickly
+as the input can be hashed and the output copied. Unless the UID is kept, the new SOPInstanceUID of a cached
+output is derived from its key rather than generated at random, so an output is the same whether it came from
+the cache or not.
+
+The cache is a directory of files named by key. Using an output touches its modification time, and once the
+files exceed the size limit the least recently used are removed, down to LOW_WATER of the limit so the
+directory is not scanned again on every addition. Files are added by renaming a complete temporary file into
+place, so several processes may share a cache.
+
+"""
+
+CACHE_VERSION = 2
+LOW_WATER = 0.9
+
+
+def fileHash(source):
+    """Return the SHA-256 hex digest and size of a plan, given as a path or as bytes."""
+    sha = hashlib.sha256()
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        sha.update(source)
+        return sha.hexdigest(), len(source)
+    size = 0
+    with open(source, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+            size += len(chunk)
+    return sha.hexdigest(), size
+
+
+def cacheKey(planHash, commandStrings, keep_uid=False):
+    """Return the cache key of the output of a plan, given by its SHA-256 hash, and its command strings."""
+    commands = [str(parse(c)) if isinstance(c, str) else str(c) for c in commandStrings]
+    text = json.dumps({"version": CACHE_VERSION, "plan": planHash, "commands": commands, "keep_uid": bool(keep_uid)})
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def keyUID(key):
+    """The SOPInstanceUID given to the output with a cache key."""
+    from pydicom.uid import generate_uid
+    return generate_uid(entropy_srcs=["rtpmangle", key])
+
+
+class OutputCache:
+    """A directory of mangled plans, bounded in size by evicting the least recently used."""
+
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self._size = None
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".dcm")
+
+    def fetch(self, key, destination):
+        """Copy the output cached under key to destination, a path or binary file object. Returns False if
+        there is none."""
+        path = self.path(key)
+        try:
+            os.utime(path)
+            if hasattr(destination, "write"):
+                with open(path, "rb") as f:
+                    shutil.copyfileobj(f, destination)
+            else:
+                shutil.copyfile(path, destination)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key, source):
+        """Add an output to the cache, from a path or bytes, and evict the least recently used if it is full."""
+        fd, temp = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if isinstance(source, (bytes, bytearray, memoryview)):
+                    f.write(source)
+                else:
+                    with open(source, "rb") as src:
+                        shutil.copyfileobj(src, f)
+                nBytes = f.tell()
+            os.replace(temp, self.path(key))
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+        if self._size is None:
+            self._size = sum(size for path, used, size in self.entries())
+        else:
+            self._size += nBytes
+        if self._size > self.maxBytes:
+            self.evict(int(self.maxBytes * LOW_WATER))
+
+    def entries(self):
+        """Return (path, last used, size) of each cached output."""
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".dcm"):
+                    try:
+                        info = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((entry.path, info.st_mtime_ns, info.st_size))
+        return entries
+
+    def evict(self, maxBytes):
+        """Remove the least recently used outputs until the cache is no larger than maxBytes."""
+        entries = sorted(self.entries(), key=lambda entry: entry[1])
+        size = sum(entry[2] for entry in entries)
+        for path, used, nBytes in entries:
+            if size <= maxBytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            size -= nBytes
+        self._size = size
@@ -0,0 +1,399 @@
+"""command.py: Compiles Mangle command strings into reusable operation objects."""
+
+# Imports
+import functools
+import re
+from dataclasses import dataclass
+from decimal import Decimal
+
+"""
+Command String Grammar
+----------------------
+
+A command string is a whitespace separated list of tokens. Quotes (single or double) may be used to
+include spaces within a token, as with the machine name setter: m='Linac 2'.
+
+    filter  := key indices            e.g. b0   cp12-16   lp1,3,5-7
+             | key ranges             e.g. ga90-180   cw0.2-0.5   ca350-10
+    setter  := key "=" operand        e.g. mu=100   g=+5   c=-5%   pa=-5.2   m='Linac 2'
+    indices := span ("," span)*
+    span    := int | int "-" int
+    ranges  := range ("," range)*
+    range   := number | number "-" number
+
+Index filters select beams, control points, jaws and leaves by number. Range filters select the control
+points whose value of an attribute lies within any of the ranges, including both ends. Angle ranges may
+pass through zero - ga350-10 selects gantry angles from 350 up to 360 and from 0 to 10.
+
+Each command string is compiled exactly once into a Command object. Commands are immutable, so the same
+object can be cached and applied to any number of plans.
+
+"""
+
+# Operand modes.
+ABSOLUTE = "absolute"
+RELATIVE = "relative"
+PERCENT = "percent"
+TEXT = "text"
+CHAIN = "chain"     # A tuple of operands, applied in turn - see coalesce().
+
+# Available filters. The device entry prevents jaw and MLC filters being mixed in a single command. Range
+# filters select control points by the value of their attr, which wraps through zero if angle is set.
+FILTERS = {
+    "b":  {"name": "beam"},
+    "cp": {"name": "control pt"},
+    "j":  {"name": "jaw",       "device": "jaw"},
+    "jb": {"name": "jaw bank",  "device": "jaw"},
+    "lp": {"name": "leaf pair", "device": "mlc"},
+    "lb": {"name": "leaf bank", "device": "mlc"},
+    "ga": {"name": "gantry angle",     "attr": "GantryAngle",              "angle": True},
+    "ca": {"name": "collimator angle", "attr": "BeamLimitingDeviceAngle",  "angle": True},
+    "cw": {"name": "meterset weight",  "attr": "CumulativeMetersetWeight", "angle": False},
+}
+
+# Available setters, keyed by the text before the "=". Populated by setters.registerSetter(). Each
+# setter's type controls how its operand is read:
+#   number   - Absolute value, or a relative change if signed (+x, -x, +x%, -x%).
+#   absolute - Always an absolute value, may be negative.
+#   relative - Always a relative change, the sign is optional.
+#   str      - Free text.
+SETTERS = {}
+
+_TOKEN = re.compile(r"([a-z]+)(=?)(.*)\Z", re.DOTALL)
+_SPAN = re.compile(r"(\d+)(?:-(\d+))?\Z")
+_RANGE = re.compile(r"(\d+\.?\d*|\.\d+)(?:-(\d+\.?\d*|\.\d+))?\Z")
+_NUMBER = re.compile(r"([+-]?)(\d+\.?\d*|\.\d+)(%?)\Z")
+
+
+def _number(value):
+    """Format a number as the shortest text which compiles back to exactly the same value, e.g. 10.0 as "10"
+    and 123.4567 as "123.4567", never in exponent form."""
+    text = format(Decimal(repr(float(value))), "f")
+    return text[:-2] if text.endswith(".0") else text
+
+
+class CommandError(ValueError):
+    """A command string could not be compiled. Records the character position of the fault."""
+
+    def __init__(self, message, cmdStr="", position=None):
+        self.message = message
+        self.cmdStr = cmdStr
+        self.position = position
+        super().__init__(message)
+
+    def __str__(self):
+        if self.position is None:
+            return self.message
+        return (self.message + " (position " + str(self.position) + ")\n"
+                + "    " + self.cmdStr + "\n"
+                + "    " + " " * self.position + "^")
+
+
+@dataclass(frozen=True)
+class Operand:
+    """The value given to a setter, and how it should be combined with the existing value."""
+    mode: str
+    value: object
+
+    def apply(self, old):
+        """Return the new value for an existing value of old."""
+        if self.mode == CHAIN:
+            for step in self.value:
+                old = step.apply(old)
+            return old
+        if self.mode == RELATIVE:
+            return float(old) + self.value
+        elif self.mode == PERCENT:
+            return float(old) * (1 + self.value / 100)
+        return self.value
+
+    def __str__(self):
+        if self.mode == CHAIN:
+            return ";".join(str(step) for step in self.value)
+        if self.mode == TEXT:
+            return "'" + self.value + "'" if " " in self.value else self.value
+        text = _number(self.value)
+        if self.mode != ABSOLUTE and not text.startswith("-"):
+            text = "+" + text
+        return text + "%" if self.mode == PERCENT else text
+
+
+@dataclass(frozen=True)
+class Filter:
+    """A filter restricting a command to a set of indices, or for range filters a set of (low, high) ranges."""
+    key: str
+    values: tuple
+    position: int = 0
+
+    def __str__(self):
+        if "attr" in FILTERS[self.key]:
+            return self.key + ",".join(_number(low) if low == high else _number(low) + "-" + _number(high)
+                                       for low, high in self.values)
+        return self.key + ",".join(str(v) for v in self.values)
+
+
+@dataclass(frozen=True)
+class Setter:
+    """A setter and its operand."""
+    key: str
+    operand: Operand
+    position: int = 0
+
+    def __str__(self):
+        return self.key + "=" + str(self.operand)
+
+
+@dataclass(frozen=True)
+class Command:
+    """A compiled command string - the filters selecting what to edit, and the setters to apply."""
+    text: str
+    filters: tuple
+    setters: tuple
+
+    def filter(self, key):
+        """Return the indices (or ranges) given for the filter key, or None if the filter was not used."""
+        for f in self.filters:
+            if f.key == key:
+                return f.values
+        return None
+
+    def setter(self, key):
+        """Return the Setter for key, or None if it was not used."""
+        for s in self.setters:
+            if s.key == key:
+                return s
+        return None
+
+    @property
+    def device(self):
+        """The beam limiting device targeted by the filters - "jaw", "mlc" or None."""
+        for f in self.filters:
+            if "device" in FILTERS[f.key]:
+                return FILTERS[f.key]["device"]
+        return None
+
+    def __str__(self):
+        return " ".join(str(t) for t in self.filters + self.setters)
+
+
+def tokenize(cmdStr):
+    """Split a command string on whitespace, honouring quotes. Returns a list of (token, position) tuples."""
+    tokens = []
+    i = 0
+    n = len(cmdStr)
+    while i < n:
+        if cmdStr[i].isspace():
+            i += 1
+            continue
+        start = i
+        quote = None
+        text = []
+        while i < n and (quote or not cmdStr[i].isspace()):
+            ch = cmdStr[i]
+            if quote:
+                if ch == quote:
+                    quote = None
+                else:
+                    text.append(ch)
+            elif ch in "'\"":
+                quote = ch
+                quoteStart = i
+            else:
+                text.append(ch)
+            i += 1
+        if quote:
+            raise CommandError("Unterminated quote.", cmdStr, quoteStart)
+        tokens.append(("".join(text), start))
+    return tokens
+
+
+def _parseIndices(text, cmdStr, position):
+    """Expand an index list such as 1,3,5-7 into a tuple of unique ints, preserving order."""
+    values = []
+    offset = position
+    for span in text.split(","):
+        m = _SPAN.match(span)
+        if not m:
+            raise CommandError("Invalid index '" + span + "'.", cmdStr, offset)
+        first = int(m.group(1))
+        last = int(m.group(2)) if m.group(2) is not None else first
+        if last < first:
+            raise CommandError("Index range '" + span + "' is reversed.", cmdStr, offset)
+        for v in range(first, last + 1):
+            if v not in values:
+                values.append(v)
+        offset += len(span) + 1
+    return tuple(values)
+
+
+def _parseRanges(text, cmdStr, position, angle):
+    """Read a range list such as 90-180,270 into a tuple of (low, high) tuples."""
+    values = []
+    offset = position
+    for span in text.split(","):
+        m = _RANGE.match(span)
+        if not m:
+            raise CommandError("Invalid range '" + span + "'.", cmdStr, offset)
+        low = float(m.group(1))
+        high = float(m.group(2)) if m.group(2) is not None else low
+        if high < low and not angle:
+            raise CommandError("Range '" + span + "' is reversed.", cmdStr, offset)
+        values.append((low, high))
+        offset += len(span) + 1
+    return tuple(values)
+
+
+def _parseOperand(setterType, text, cmdStr, position):
+    """Read a setter operand according to the setter's type."""
+    if setterType == "str":
+        if not text:
+            raise CommandError("Missing value.", cmdStr, position)
+        return Operand(TEXT, text)
+
+    m = _NUMBER.match(text)
+    if not m:
+        raise CommandError("Invalid number '" + text + "'.", cmdStr, position)
+    sign, digits, percent = m.groups()
+    value = float(sign + digits)
+
+    if setterType == "absolute":
+        if percent:
+            raise CommandError("Absolute positions cannot be a percentage.", cmdStr, position)
+        return Operand(ABSOLUTE, value)
+    if setterType == "relative":
+        return Operand(PERCENT if percent else RELATIVE, value)
+
+    # Number - a sign marks a relative edit.
+    if not sign:
+        if percent:
+            raise CommandError("Percentage edits must be signed, e.g. +5% or -5%.", cmdStr, position)
+        return Operand(ABSOLUTE, value)
+    return Operand(PERCENT if percent else RELATIVE, value)
+
+
+@functools.lru_cache(maxsize=4096)
+def parse(cmdStr):
+    """Compile a command string into a Command. Raises CommandError if it is invalid."""
+    filters = []
+    setters = []
+
+    for token, position in tokenize(cmdStr):
+        m = _TOKEN.match(token)
+        if not m:
+            raise CommandError("Unrecognised token '" + token + "'.", cmdStr, position)
+        key, equals, rest = m.groups()
+        valuePosition = position + len(key) + len(equals)
+
+        if equals:
+            if key not in SETTERS:
+                raise CommandError("Unknown setter '" + key + "='.", cmdStr, position)
+            if any(s.key == key for s in setters):
+                raise CommandError("More than one " + SETTERS[key].name + " set command found.", cmdStr, position)
+            operand = _parseOperand(SETTERS[key].type, rest, cmdStr, valuePosition)
+            setters.append(Setter(key, operand, position))
+        else:
+            if key not in FILTERS:
+                raise CommandError("Unknown filter '" + key + "'.", cmdStr, position)
+            if any(f.key == key for f in filters):
+                raise CommandError("More than one " + FILTERS[key]["name"] + " filter found.", cmdStr, position)
+            if not rest:
+                raise CommandError("Missing index for " + FILTERS[key]["name"] + " filter.", cmdStr, valuePosition)
+            if "attr" in FILTERS[key]:
+                values = _parseRanges(rest, cmdStr, valuePosition, FILTERS[key]["angle"])
+            else:
+                values = _parseIndices(rest, cmdStr, valuePosition)
+            filters.append(Filter(key, values, position))
+
+    # Prevent Simultaneous Jaw and MLC editing.
+    devices = [f for f in filters if "device" in FILTERS[f.key]]
+    for f in devices:
+        if FILTERS[f.key]["device"] != FILTERS[devices[0].key]["device"]:
+            raise CommandError("Cannot Edit Leaf and Jaw positions in the same command.", cmdStr, f.position)
+
+    # Prevent Simultaneous Relative and Absolute edits, and position edits with no device to act upon.
+    positions = [s for s in setters if SETTERS[s.key].position]
+    if len(positions) > 1:
+        raise CommandError("Cannot Edit Relative and Absolute positions in the same command.", cmdStr, positions[1].position)
+    if positions and not devices:
+        raise CommandError("Position setters require a jaw (j, jb) or leaf (lb, lp) filter.", cmdStr, positions[0].position)
+
+    return Command(cmdStr, tuple(filters), tuple(setters))
+
+
+"""
+Command Files and Coalescing
+----------------------------
+
+Long scripts of command strings can be read from a file with readCommandFile(). Each command re-selects its
+control points and walks every one of them, so before they are applied, coalesce() merges each command into
+the one before it when both:
+
+    - Have the same filters, so select the same beams, control points, jaws and leaves, and the first does
+      not edit an attribute the filters select by (g= with ga, c= with ca).
+    - Only use setters which accept a chain of operands (BaseSetter.chains).
+
+The setters of the merged command edit each field once, applying the operands of both commands in turn, so
+consecutive shifts of the same leaves become a single pass over the plan. An absolute value replaces any
+edit before it. The merged plan has the same values as applying the commands one by one, though values a
+control point would have repeated from the one before it may be left out.
+
+"""
+
+
+def readCommandFile(path):
+    """Read a file of command strings, one per line. Blank lines and lines starting with # are ignored."""
+    commandStrings = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                commandStrings.append(line)
+    return commandStrings
+
+
+def chainOperands(first, second):
+    """Return the operand equivalent to applying first, then second."""
+    if second.mode in (ABSOLUTE, TEXT):
+        return second
+    steps = first.value if first.mode == CHAIN else (first,)
+    return Operand(CHAIN, steps + (second,))
+
+
+def _field(key):
+    """The field a setter writes to - the position setters all write to the positions."""
+    return "position" if SETTERS[key].position else key
+
+
+def canCoalesce(first, second):
+    """Return True if second can be merged into first, the command applied before it."""
+    if {(f.key, f.values) for f in first.filters} != {(f.key, f.values) for f in second.filters}:
+        return False
+    if not all(SETTERS[s.key].chains for s in first.setters + second.setters):
+        return False
+    written = {getattr(SETTERS[s.key], "attr", None) for s in first.setters} - {None}
+    return not any(FILTERS[f.key].get("attr") in written for f in second.filters)
+
+
+def mergeCommands(first, second):
+    """Return the command equivalent to applying first, then second, which must share its filters."""
+    setters = list(first.setters)
+    for s in second.setters:
+        for k, t in enumerate(setters):
+            if _field(t.key) == _field(s.key):
+                operand = chainOperands(t.operand, s.operand)
+                setters[k] = Setter(s.key if operand is s.operand else t.key, operand, t.position)
+                break
+        else:
+            setters.append(s)
+    return Command(first.text + "; " + second.text, first.filters, tuple(setters))
+
+
+def coalesce(commands):
+    """Merge consecutive commands which edit the same selection, returning the shorter list of commands."""
+    merged = []
+    for cmd in commands:
+        if merged and canCoalesce(merged[-1], cmd):
+            merged[-1] = mergeCommands(merged[-1], cmd)
+        else:
+            merged.append(cmd)
+    return merged
@@ -0,0 +1,266 @@
+"""diff.py: Compares two RT Plans beam by beam and control point by control point, as arrays."""
+
+# Imports
+import numpy as np
+from pydicom.dataelem import RawDataElement
+from pydicom.tag import Tag
+
+from .index import BLD_POSITION_SEQUENCE, DEVICE_TYPE, planIndex
+from .positions import LEAF_JAW_POSITIONS, parsePositions, readPositions
+from .reader import UNDEFINED, scanElements, sequenceItems
+
+"""
+Plan Diff
+---------
+
+Each beam is loaded into arrays - one value per control point for each attribute, and an (n_cp, n_values)
+array of positions for each beam limiting device - with inherited values filled in, as DICOM only requires a
+value where it changes. Two plans are then compared a whole array at a time.
+
+Control point sequences are normally still encoded when a plan has been read by readPlan(), so their values
+are picked straight out of the encoded bytes, using the same scanner as the reader, rather than decoding
+every control point into pydicom datasets. Sequences that have already been decoded are read from the
+datasets instead.
+
+Beams are matched by BeamNumber. Angles are compared the short way round, so 359 to 1 is a change of +2.
+Differences within the tolerance are ignored, as Decimal Strings may be rounded when they are written.
+
+"""
+
+ATTRIBUTES = ["GantryAngle", "BeamLimitingDeviceAngle", "PatientSupportAngle", "CumulativeMetersetWeight"]
+ANGLES = {"GantryAngle", "BeamLimitingDeviceAngle", "PatientSupportAngle"}
+CONTROL_POINT_SEQUENCE = Tag("ControlPointSequence")
+# Plain ints, as comparing pydicom Tags is slow in a loop over every element of every control point.
+_ATTRIBUTE_TAGS = {int(Tag(attr)): attr for attr in ATTRIBUTES}
+_POSITION_SEQUENCE, _DEVICE_TYPE, _POSITIONS = int(BLD_POSITION_SEQUENCE), int(DEVICE_TYPE), int(LEAF_JAW_POSITIONS)
+
+
+def _encodedControlPoints(raw):
+    """Yield (values, positions) for each control point of an encoded ControlPointSequence."""
+    data = memoryview(raw.value)
+    implicit, little = raw.is_implicit_VR, raw.is_little_endian
+    endian = "<" if little else ">"
+    for start, end in sequenceItems(data, implicit, endian):
+        cp = data[start:end]
+        values = {}
+        positions = {}
+        for tag, vr, length, valueStart, valueEnd, _ in scanElements(cp, 0, implicit, little):
+            if tag in _ATTRIBUTE_TAGS:
+                text = bytes(cp[valueStart:valueEnd]).strip(b" \0")
+                if text:
+                    values[_ATTRIBUTE_TAGS[tag]] = float(text)
+            elif tag == _POSITION_SEQUENCE:
+                sequence = cp[valueStart:valueEnd]
+                for itemStart, itemEnd in sequenceItems(sequence, implicit, endian):
+                    item = sequence[itemStart:itemEnd]
+                    deviceType = found = None
+                    for t, v, n, s, e, _ in scanElements(item, 0, implicit, little):
+                        if t == _DEVICE_TYPE:
+                            deviceType = bytes(item[s:e]).decode("ascii").strip(" \0")
+                        elif t == _POSITIONS:
+                            found = parsePositions(item[s:e])
+                    if deviceType and found is not None:
+                        positions[deviceType] = found
+        yield values, positions
+
+
+def _decodedControlPoints(cps):
+    """Yield (values, positions) for each control point of a decoded ControlPointSequence."""
+    for cp in cps:
+        values = {}
+        for attr in ATTRIBUTES:
+            value = cp.get(attr)
+            if value is not None and value != "":
+                values[attr] = float(value)
+        positions = {}
+        elem = cp.get(BLD_POSITION_SEQUENCE)
+        for item in elem.value if elem is not None else []:
+            found = readPositions(item)
+            if found is not None:
+                positions[item[DEVICE_TYPE].value] = found
+        yield values, positions
+
+
+class BeamArrays:
+    """The control point values and device positions of a beam, with inherited values filled in.
+
+    values[attr] holds one value per control point, NaN before the first. positions[type] is an
+    (n_cp, n_values) array, NaN in the control points before the device first appears.
+    """
+
+    def __init__(self, beam):
+        elem = beam.get_item(CONTROL_POINT_SEQUENCE)
+        if isinstance(elem, RawDataElement) and elem.length != UNDEFINED and elem.VR in ("SQ", None):
+            controlPoints = list(_encodedControlPoints(elem))
+        else:
+            controlPoints = list(_decodedControlPoints(beam.get("ControlPointSequence") or []))
+        self.nCps = len(controlPoints)
+
+        self.values = {}
+        for attr in ATTRIBUTES:
+            column = np.full(self.nCps, np.nan)
+            value = np.nan
+            for i, (values, positions) in enumerate(controlPoints):
+                value = values.get(attr, value)
+                column[i] = value
+            self.values[attr] = column
+
+        self.positions = {}
+        deviceTypes = {deviceType for values, positions in controlPoints for deviceType in positions}
+        for deviceType in sorted(deviceTypes):
+            width = max(len(positions[deviceType]) for values, positions in controlPoints if deviceType in positions)
+            rows = np.full((self.nCps, width), np.nan)
+            row = None
+            for i, (values, positions) in enumerate(controlPoints):
+                found = positions.get(deviceType)
+                if found is not None:
+                    if len(found) != width:
+                        raise ValueError("Control point " + str(i) + " has " + str(len(found)) + " " + deviceType
+                                         + " positions, expected " + str(width) + ".")
+                    row = found
+                if row is not None:
+                    rows[i] = row
+            self.positions[deviceType] = rows
+
+
+def planArrays(ds):
+    """Return {beam number: (beam index, beam, BeamArrays)} for every beam of a plan."""
+    index = planIndex(ds)
+    return {number: (b, beam, BeamArrays(beam))
+            for b, (number, beam) in enumerate(zip(index.beamNumbers, ds.BeamSequence))}
+
+
+def _compare(a, b, tolerance, angle=False):
+    """Compare two equally shaped arrays. Returns (changed, delta) - a mask of the values that differ by more
+    than the tolerance (or are missing from one only), and b - a."""
+    delta = b - a
+    if angle:
+        delta = (delta + 180) % 360 - 180
+    missing = np.isnan(a) != np.isnan(b)
+    with np.errstate(invalid="ignore"):
+        changed = missing | (np.abs(delta) > tolerance)
+    return changed, delta
+
+
+def _summary(changed, delta):
+    """The count, largest and mean absolute change of the changed values."""
+    deltas = np.abs(delta[changed & ~np.isnan(delta)])
+    return {"values": int(changed.sum()),
+            "max": round(float(deltas.max()), 6) if deltas.size else None,
+            "mean": round(float(deltas.mean()), 6) if deltas.size else None}
+
+
+def _metersets(ds, number):
+    index = planIndex(ds)
+    return [float(referenced.BeamMeterset) for referenced in index.referencedBeams(ds, number)
+            if referenced.get("BeamMeterset") is not None]
+
+
+def diffBeam(a, b, tolerance):
+    """Compare the BeamArrays of two beams. Returns {"attributes", "devices", "controlPoints"}, giving the
+    changes to each attribute and device, and to each control point that changed."""
+    nCps = min(a.nCps, b.nCps)
+    perCp = {}
+    attributes = {}
+    for attr in ATTRIBUTES:
+        changed, delta = _compare(a.values[attr][:nCps], b.values[attr][:nCps], tolerance, attr in ANGLES)
+        if changed.any():
+            summary = _summary(changed, delta)
+            summary["controlPoints"] = summary.pop("values")
+            attributes[attr] = summary
+            for i in np.flatnonzero(changed):
+                perCp.setdefault(int(i), {})[attr] = None if np.isnan(delta[i]) else round(float(delta[i]), 6)
+
+    devices = {}
+    for deviceType in sorted(set(a.positions) | set(b.positions)):
+        before = a.positions.get(deviceType)
+        after = b.positions.get(deviceType)
+        if before is None or after is None or before.shape[1] != after.shape[1]:
+            devices[deviceType] = {"error": "device added, removed or resized"}
+            continue
+        changed, delta = _compare(before[:nCps], after[:nCps], tolerance)
+        if changed.any():
+            summary = _summary(changed, delta)
+            cpChanged = changed.any(axis=1)
+            summary["controlPoints"] = int(cpChanged.sum())
+            # Positions are stored bank by bank, so a pair changed if either of its leaves did.
+            nPairs = changed.shape[1] // 2 or 1
+            pairs = changed[:, :nPairs * 2].reshape(changed.shape[0], -1, nPairs).any(axis=(0, 1))
+            summary["pairs"] = [int(p) for p in np.flatnonzero(pairs)]
+            devices[deviceType] = summary
+            absDelta = np.where(changed, np.abs(np.nan_to_num(delta)), 0).max(axis=1)
+            for i in np.flatnonzero(cpChanged):
+                perCp.setdefault(int(i), {})[deviceType] = round(float(absDelta[i]), 6)
+
+    return {"attributes": attributes, "devices": devices,
+            "controlPoints": [dict(cp=i, **perCp[i]) for i in sorted(perCp)]}
+
+
+def diffPlans(a, b, tolerance=1e-4, arraysA=None, arraysB=None):
+    """Compare two plans, returning the differences as a dict ready to be saved as JSON. The planArrays() of
+    either plan may be passed in, so a plan compared many times is only loaded once."""
+    arraysA = planArrays(a) if arraysA is None else arraysA
+    arraysB = planArrays(b) if arraysB is None else arraysB
+    report = {"sopInstanceUID": {"a": a.get("SOPInstanceUID"), "b": b.get("SOPInstanceUID")},
+              "addedBeams": sorted(set(arraysB) - set(arraysA)),
+              "removedBeams": sorted(set(arraysA) - set(arraysB)),
+              "beams": []}
+
+    for number in sorted(set(arraysA) & set(arraysB)):
+        indexA, beamA, beamArraysA = arraysA[number]
+        indexB, beamB, beamArraysB = arraysB[number]
+        beam = {"beam": indexA, "number": number, "name": beamA.get("BeamName")}
+
+        before, after = _metersets(a, number), _metersets(b, number)
+        if len(before) != len(after) or any(abs(x - y) > tolerance for x, y in zip(before, after)):
+            beam["meterset"] = {"a": before, "b": after}
+        if beamA.get("TreatmentMachineName") != beamB.get("TreatmentMachineName"):
+            beam["machine"] = {"a": beamA.get("TreatmentMachineName"), "b": beamB.get("TreatmentMachineName")}
+        if beamArraysA.nCps != beamArraysB.nCps:
+            beam["numberOfControlPoints"] = {"a": beamArraysA.nCps, "b": beamArraysB.nCps}
+
+        changes = diffBeam(beamArraysA, beamArraysB, tolerance)
+        if any(changes.values()):
+            beam.update(changes)
+        if len(beam) > 3:
+            report["beams"].append(beam)
+
+    report["identical"] = not (report["beams"] or report["addedBeams"] or report["removedBeams"])
+    return report
+
+
+def formatDiff(report, verbose=False):
+    """Return a diff report as lines of text. With verbose, every changed control point is listed."""
+    if report["identical"]:
+        return ["No differences."]
+    lines = []
+    for number in report["addedBeams"]:
+        lines.append("Beam number " + str(number) + " added.")
+    for number in report["removedBeams"]:
+        lines.append("Beam number " + str(number) + " removed.")
+    for beam in report["beams"]:
+        lines.append("Beam " + str(beam["beam"]) + " (" + str(beam["name"]) + "):")
+        if "meterset" in beam:
+            lines.append("    Meterset: " + ", ".join(format(v, "g") for v in beam["meterset"]["a"]) + " -> "
+                         + ", ".join(format(v, "g") for v in beam["meterset"]["b"]))
+        if "machine" in beam:
+            lines.append("    Machine: " + str(beam["machine"]["a"]) + " -> " + str(beam["machine"]["b"]))
+        if "numberOfControlPoints" in beam:
+            lines.append("    Control points: " + str(beam["numberOfControlPoints"]["a"]) + " -> "
+                         + str(beam["numberOfControlPoints"]["b"]))
+        for name, summary in list(beam.get("attributes", {}).items()) + list(beam.get("devices", {}).items()):
+            if "error" in summary:
+                lines.append("    " + name + ": " + summary["error"])
+                continue
+            text = "    " + name + ": " + str(summary["controlPoints"]) + " control point(s)"
+            if "pairs" in summary:
+                text += ", " + str(summary["values"]) + " position(s) in " + str(len(summary["pairs"])) + " pair(s)"
+            if summary["max"] is not None:
+                text += ", max " + format(summary["max"], "g") + ", mean " + format(summary["mean"], "g")
+            lines.append(text)
+        if verbose:
+            for cp in beam.get("controlPoints", []):
+                lines.append("        cp" + str(cp["cp"]) + ": " + ", ".join(
+                    name + " " + ("missing" if delta is None else format(delta, "+g"))
+                    for name, delta in cp.items() if name != "cp"))
+    return lines
@@ -0,0 +1,134 @@
+"""engine.py: Applies compiled Mangle commands to a DICOM-RT Plan dataset."""
+
+# Imports
+from pydicom.uid import generate_uid
+
+from .command import FILTERS, SETTERS, coalesce
+from .index import planIndex
+from .timing import NO_TIMINGS
+from .writer import markModified
+
+"""
+Filtering
+---------
+
+The filters of a command select the beams and control points to act upon. The device filters (jaw, jaw
+bank, leaf pair and leaf bank) are only meaningful to the position setters, so are resolved there.
+
+"""
+
+# The top level sequence each setter scope writes to, so the writer knows to encode it again. Setters with
+# the "plan" scope could write anywhere.
+SCOPE_ELEMENTS = {
+    "fraction": "FractionGroupSequence",
+    "beam": "BeamSequence",
+    "controlpoint": "BeamSequence",
+}
+
+
+def select(ds, cmd):
+    """Gather the items chosen by the beam and control point filters of a command.
+
+    Returns a list of (beamIndex, beam, cpIndices) tuples.
+    """
+    selection = []
+    beamSequence = ds.BeamSequence
+    index = planIndex(ds)
+
+    beamIndices = cmd.filter("b")
+    if beamIndices is None:
+        beamIndices = range(index.nBeams)
+
+    for b in beamIndices:
+        if b >= index.nBeams:
+            print("WARNING: Beam Index Out of Plan Range - Ignoring beam " + str(b) + ".\n")
+            continue
+        beam = beamSequence[b]
+        nCps = index.nCps[b]
+
+        cpIndices = cmd.filter("cp")
+        if cpIndices is None:
+            cpIndices = list(range(nCps))
+        else:
+            for i in cpIndices:
+                if i >= nCps:
+                    print("WARNING: Control Point Index Out of Beam Range - Ignoring CP " + str(i) + ".\n")
+            cpIndices = [i for i in cpIndices if i < nCps]
+
+        # Range filters are answered from the index, which holds each beam's control points sorted by value.
+        for f in cmd.filters:
+            spec = FILTERS[f.key]
+            if "attr" in spec:
+                matched = set()
+                for low, high in f.values:
+                    matched |= index.controlPointsBetween(b, beam, spec["attr"], low, high, spec["angle"])
+                cpIndices = [i for i in cpIndices if i in matched]
+
+        selection.append((b, beam, cpIndices))
+
+    if any("attr" in FILTERS[f.key] for f in cmd.filters) and not any(cps for b, beam, cps in selection):
+        print("WARNING: No Control Points Match the Filters - Nothing to Edit.\n")
+    return selection
+
+
+"""
+Perform the edits
+-----------------
+"""
+
+
+def applyCommand(ds, cmd, verbose=False, prepare=None, timings=NO_TIMINGS):
+    """Apply a single command (a string or a compiled Command) to the dataset in place.
+
+    If given, prepare(cmd, selection) is called before the setters run and returns the selection to use.
+    Each step is timed by timings (see timing.py).
+    """
+    if isinstance(cmd, str):
+        cmd = timings.parse(cmd)
+    record = timings.command(cmd)
+
+    if verbose:
+        print("\nProcessing Command String: " + cmd.text + "\n")
+        for f in cmd.filters:
+            print("Found filter - " + str(f))
+
+    with timings.phase("filter_ms", record):
+        selection = select(ds, cmd)
+    if prepare is not None:
+        with timings.phase("copy_ms", record):
+            selection = prepare(cmd, selection)
+    timings.count(record, ds, cmd, selection)
+
+    for s in cmd.setters:
+        if verbose:
+            print("Found " + SETTERS[s.key].name + " setter - Value: " + str(s.operand))
+        scope = SETTERS[s.key].scope
+        markModified(ds, [SCOPE_ELEMENTS[scope]] if scope in SCOPE_ELEMENTS else None)
+        with timings.phase(s.key, None if record is None else record["apply_ms"]):
+            edited = SETTERS[s.key].apply(ds, cmd, selection, s.operand)
+        timings.countPositions(record, edited)
+
+
+def mangleDataset(ds, commandStrings, keep_uid=False, verbose=False, prepare=None, timings=NO_TIMINGS, uid=None):
+    """Apply a list of command strings (or compiled Commands) to the dataset in place, and return it. Pass a
+    timing.Timings as timings to record where the time goes, and a uid to use as the new SOPInstanceUID
+    rather than one generated at random."""
+    commands = [timings.parse(c) if isinstance(c, str) else c for c in commandStrings]
+
+    # Unless Instructed, change the file's UID to prevent duplicates.
+    if not keep_uid:
+        with timings.phase("uid"):
+            ds.SOPInstanceUID = uid or generate_uid()
+
+    if verbose:
+        print("Found " + str(len(commands)) + " command string(s).")
+
+    # Consecutive commands editing the same selection are merged, so each is applied in a single pass.
+    merged = coalesce(commands)
+    if verbose and len(merged) < len(commands):
+        print("Merged into " + str(len(merged)) + " pass(es) over the plan.")
+
+    for cmd in merged:
+        applyCommand(ds, cmd, verbose, prepare, timings)
+
+    return ds
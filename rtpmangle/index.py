@@ -0,0 +1,185 @@
+"""index.py: Lookups built once per plan, and shared by every command applied to it."""
+
+# Imports
+import bisect
+from dataclasses import dataclass
+
+from pydicom.tag import Tag
+
+from .reader import sequenceItems
+
+BLD_POSITION_SEQUENCE = Tag("BeamLimitingDevicePositionSequence")
+CONTROL_POINT_SEQUENCE = Tag("ControlPointSequence")
+DEVICE_TYPE = Tag("RTBeamLimitingDeviceType")
+
+"""
+Plan Index
+----------
+
+Rather than each command string searching the plan's sequences again, the index is built once per plan:
+
+    beam number -> beam
+    beam number -> the ReferencedBeamSequence items holding its meterset, in every fraction group
+    (beam, control point, device type) -> beam limiting device position item
+    beam -> the geometry of its beam limiting devices (see BeamGeometry)
+    (beam, attribute) -> the control points of the beam, sorted by the attribute's value
+
+Beams are matched to their metersets by number, so plans whose beams are not numbered 1, 2, 3... are
+edited correctly. Each beam has its own geometry, so plans that mix machines or MLC models are too.
+
+The number of control points of each beam is counted from its ControlPointSequence - from the encoded items,
+if the sequence has not been decoded - rather than taken from NumberOfControlPoints, which may disagree.
+
+The index holds indices - positions within the plan's sequences - rather than the items themselves. A
+variant's beams and control points are copies at the same positions (see variants.py), so the index of
+a plan is equally valid for every variant of it, and is shared with them. Position items are only
+indexed as control points are first edited, so control points that are never edited stay encoded.
+
+The sorted control point values answer the range filters (ga, ca, cw) by bisection. DICOM only requires
+a control point to hold a value when it changes, so control points without one take the value of the
+control point before. Unlike the rest of the index, sorted values depend on the values themselves, so they
+are kept with the control point sequence they were read from and sorted again once it is edited or when
+asked about a variant's copy.
+
+"""
+
+
+@dataclass(frozen=True)
+class DeviceGeometry:
+    """A beam limiting device - its type, number of leaf or jaw pairs, and leaf boundaries (None for jaws)."""
+    deviceType: str
+    nPairs: int
+    boundaries: tuple = None
+
+    def offsets(self, banks, pairs):
+        """Indices within LeafJawPositions of the given banks and pairs - each bank holds nPairs values."""
+        return [bank * self.nPairs + pair for bank in banks for pair in pairs]
+
+
+class BeamGeometry:
+    """The beam limiting devices of a beam, from its BeamLimitingDeviceSequence."""
+
+    def __init__(self, beam):
+        self.devices = {}
+        for bld in beam.get("BeamLimitingDeviceSequence") or []:
+            boundaries = bld.get("LeafPositionBoundaries")
+            self.devices[bld.RTBeamLimitingDeviceType] = DeviceGeometry(
+                bld.RTBeamLimitingDeviceType, int(bld.NumberOfLeafJawPairs),
+                tuple(float(v) for v in boundaries) if boundaries else None)
+
+    def nPairs(self, deviceType):
+        """The number of pairs of a device type, or None if the beam does not define it."""
+        device = self.devices.get(deviceType)
+        return device.nPairs if device else None
+
+    def mlc(self):
+        """The beam's MLC, or None if it has none."""
+        return self.devices.get("MLCX") or self.devices.get("MLCY")
+
+
+def countControlPoints(b, beam):
+    """Return the number of control points in beam b's ControlPointSequence, without decoding it."""
+    elem = beam.get_item(CONTROL_POINT_SEQUENCE)
+    if elem is None or elem.value is None:
+        nCps = 0
+    elif elem.is_raw:
+        endian = "<" if elem.is_little_endian else ">"
+        nCps = sum(1 for item in sequenceItems(memoryview(elem.value), elem.is_implicit_VR, endian))
+    else:
+        nCps = len(elem.value)
+    declared = beam.get("NumberOfControlPoints")
+    if declared is not None and declared != "" and int(declared) != nCps:
+        print("WARNING: Beam " + str(b) + " declares " + str(int(declared)) + " control points but holds "
+              + str(nCps) + " - using " + str(nCps) + ".\n")
+    return nCps
+
+
+class PlanIndex:
+    """Index of the beams, metersets and beam limiting device positions of a plan."""
+
+    def __init__(self, ds):
+        beams = ds.BeamSequence
+        self.nBeams = len(beams)
+        self.beamNumbers = [int(beam.BeamNumber) for beam in beams]
+        self.nCps = [countControlPoints(b, beam) for b, beam in enumerate(beams)]
+        self.beamIndices = {number: b for b, number in enumerate(self.beamNumbers)}
+
+        self.metersets = {}
+        for f, fractionGroup in enumerate(ds.get("FractionGroupSequence") or []):
+            for r, referenced in enumerate(fractionGroup.get("ReferencedBeamSequence") or []):
+                self.metersets.setdefault(int(referenced.ReferencedBeamNumber), []).append((f, r))
+
+        self._positions = {}
+        self._geometry = {}
+        self._sorted = {}
+
+    def beam(self, ds, number):
+        """Return the beam with the given BeamNumber."""
+        return ds.BeamSequence[self.beamIndices[number]]
+
+    def referencedBeams(self, ds, number):
+        """Return the ReferencedBeamSequence items giving the meterset of the beam with the given number."""
+        fractionGroups = ds.FractionGroupSequence
+        return [fractionGroups[f].ReferencedBeamSequence[r] for f, r in self.metersets.get(number, [])]
+
+    def geometry(self, b, beam):
+        """Return the BeamGeometry of beam b, where beam is that beam."""
+        geometry = self._geometry.get(b)
+        if geometry is None:
+            geometry = self._geometry[b] = BeamGeometry(beam)
+        return geometry
+
+    def sortedValues(self, b, beam, attr):
+        """Return (values, cpIndices) for beam b - the value of attr in each control point, with inherited values
+        filled in, in ascending order, and the control point holding each. Control points before the first
+        value are left out."""
+        cps = beam.ControlPointSequence
+        found = self._sorted.get((b, attr))
+        if found is None or found[0] is not cps:
+            rows = []
+            value = None
+            for i, cp in enumerate(cps):
+                current = cp.get(attr)
+                if current is not None and current != "":
+                    value = float(current)
+                if value is not None:
+                    rows.append((value, i))
+            rows.sort()
+            found = self._sorted[(b, attr)] = (cps, [value for value, i in rows], [i for value, i in rows])
+        return found[1], found[2]
+
+    def invalidate(self, b, attr):
+        """Forget the sorted values of attr in beam b, after they have been edited."""
+        self._sorted.pop((b, attr), None)
+
+    def controlPointsBetween(self, b, beam, attr, low, high, angle=False):
+        """Return the set of control points of beam b whose value of attr lies from low to high, inclusive.
+        For angles, a range with low above high passes through zero."""
+        values, cpIndices = self.sortedValues(b, beam, attr)
+        if angle and high < low:
+            return (set(cpIndices[bisect.bisect_left(values, low):])
+                    | set(cpIndices[:bisect.bisect_right(values, high)]))
+        return set(cpIndices[bisect.bisect_left(values, low):bisect.bisect_right(values, high)])
+
+    def positionItems(self, b, i, cp):
+        """Return {device type: position item} for control point i of beam b, where cp is that control point."""
+        found = self._positions.get((b, i))
+        if found is None:
+            found = {}
+            elem = cp.get(BLD_POSITION_SEQUENCE)
+            for k, item in enumerate(elem.value if elem is not None else []):
+                found[item[DEVICE_TYPE].value] = k
+            self._positions[(b, i)] = found
+        if not found:
+            return {}
+        items = cp[BLD_POSITION_SEQUENCE].value
+        return {deviceType: items[k] for deviceType, k in found.items()}
+
+
+def planIndex(ds):
+    """Return the index of a plan, building it the first time. The index is kept on the dataset."""
+    index = getattr(ds, "_planIndex", None)
+    if index is None or index.nBeams != len(ds.BeamSequence):
+        index = PlanIndex(ds)
+        ds._planIndex = index
+    return index
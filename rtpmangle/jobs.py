@@ -0,0 +1,244 @@
+"""jobs.py: Runs mangles in the background, reporting their progress, for interactive use such as the GUI."""
+
+# Imports
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from .command import coalesce, parse
+from .timing import Timings
+
+"""
+Background Jobs
+---------------
+
+A JobQueue runs mangles on a pool of worker threads, so the caller - the GUI's event loop - is never kept
+waiting. Each job is a function given a Timings to pass down through the mangle (see timing.py), and the
+Timings of a job, a JobTimings, is how its progress is followed: it records which stage the job has reached
+as the mangle enters its phases, and counts the command strings applied.
+
+    queued    - Waiting for a worker, or for an earlier job on the same plan to finish.
+    read      - Reading the plan.
+    apply     - Applying the command strings.
+    write     - Writing the output file.
+    done, failed, cancelled
+
+A job is cancelled between phases and between command strings - a plan half way through a setter is never
+left behind, and an output file is either written in full or not at all. Mangles only ever edit variants of
+a loaded plan, so a cancelled job leaves the plan as it was.
+
+Jobs on the same plan take turns, as variants share the decoded sequences and index of their base plan, while
+jobs on different plans run at once. Each plan - each key given to submit() - has its own queue, and only the
+job at its head is handed to a worker; the next is handed over once it finishes. So jobs waiting on a busy
+plan never hold up a worker, and a job on another plan starts as soon as a worker is free. Anything else
+which reads or edits a plan while its jobs may be running should be submitted as a job on the same key.
+
+The notify function given to the queue is called, from the worker thread, whenever a job changes, and should
+hand the job over to the caller's own thread (e.g. wx.CallAfter).
+
+"""
+
+FINISHED = ("done", "failed", "cancelled")
+
+
+class Cancelled(Exception):
+    """Raised within a job once it has been cancelled."""
+
+
+class JobTimings(Timings):
+    """The Timings of a job, which report its progress and stop it once it has been cancelled."""
+
+    def __init__(self, job):
+        super().__init__()
+        self.job = job
+
+    @contextmanager
+    def phase(self, name, record=None):
+        # Only the phases of the whole mangle mark a stage - the filters and setters are timed within a command.
+        if record is None:
+            self.job._stage("apply" if name == "uid" else name)
+        with super().phase(name, record):
+            yield
+
+    def command(self, cmd):
+        self.job._command()
+        return super().command(cmd)
+
+
+class Job:
+    """A mangle running in the background. Its attributes are only written by the worker running it."""
+
+    def __init__(self, number, description, run, commandStrings, key, queue):
+        self.number = number
+        self.description = description
+        self.run = run
+        self.key = key
+        self.stage = "queued"
+        self.applied = 0
+        # Consecutive commands are merged before they are applied, so progress counts the merged passes.
+        self.total = len(coalesce([parse(c) if isinstance(c, str) else c for c in commandStrings]))
+        self.error = None
+        self.timings = JobTimings(self)
+        self.started = None
+        self.finished = None
+        self._cancelled = False
+        self._future = None
+        self._queue = queue
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    @property
+    def isFinished(self):
+        return self.stage in FINISHED
+
+    def progress(self):
+        """The fraction of the job completed, from 0 to 1. Reading and writing each count for a tenth."""
+        if self.stage == "done":
+            return 1.0
+        if self.stage == "write":
+            return 0.9
+        if self.stage == "apply":
+            return 0.1 + 0.8 * min(self.applied, self.total) / self.total if self.total else 0.5
+        if self.stage == "read":
+            return 0.05
+        return 0.0
+
+    def elapsed(self):
+        """Seconds the job has been running, or ran for."""
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.perf_counter()) - self.started
+
+    def cancel(self):
+        """Cancel the job - at once if it has not started, otherwise at its next phase or command string."""
+        if self.isFinished:
+            return
+        self._cancelled = True
+        if self._queue._withdraw(self):
+            self._finish("cancelled")
+
+    def _check(self):
+        if self._cancelled:
+            raise Cancelled()
+
+    def _stage(self, stage):
+        self._check()
+        if stage != self.stage:
+            self.stage = stage
+            self._queue.notify(self)
+
+    def _command(self):
+        self._check()
+        self.stage = "apply"
+        self.applied += 1
+        self._queue.notify(self)
+
+    def _finish(self, stage):
+        # A finished job stays in the queue's list, so it lets go of the plan and anything else its run holds.
+        self.run = None
+        self.key = None
+        self.stage = stage
+        self.finished = time.perf_counter()
+        self._queue.notify(self)
+
+
+class JobQueue:
+    """A pool of worker threads running mangles, with notify(job) called whenever a job changes."""
+
+    def __init__(self, workers=None, notify=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers or min(4, os.cpu_count() or 1),
+                                           thread_name_prefix="rtpmangle-job")
+        self.notify = notify or (lambda job: None)
+        self.jobs = []
+        # The jobs waiting behind the one running on each key. A key is only held while it has jobs to run.
+        self._waiting = {}
+        self._lock = threading.Lock()
+
+    def submit(self, description, run, commandStrings=(), key=None):
+        """Queue run(timings), which mangles a plan passing the timings down, and return its Job.
+
+        commandStrings are those the job applies, so its progress can be followed, and jobs with the same key -
+        usually the plan they mangle - are run one at a time, in the order they were submitted. Keys may be any
+        hashable object, such as a LoadedPlan or a path. Raises CommandError if a command string is invalid, or
+        TypeError if the key cannot be hashed, before anything is queued.
+        """
+        if key is not None:
+            try:
+                hash(key)
+            except TypeError:
+                raise TypeError("Job keys must be hashable, such as a LoadedPlan or a path - not "
+                                + type(key).__name__ + ".") from None
+        with self._lock:
+            job = Job(len(self.jobs), description, run, commandStrings, key, self)
+            self.jobs.append(job)
+            waiting = self._waiting.get(key) if key is not None else None
+            if waiting is not None:
+                waiting.append(job)
+            elif key is not None:
+                self._waiting[key] = deque()
+        self.notify(job)
+        if waiting is None:
+            self._start(job)
+        return job
+
+    def _start(self, job):
+        job._future = self.executor.submit(self._run, job)
+
+    def _next(self, key):
+        """Start the next job waiting on a key, once the one before it has finished."""
+        if key is None:
+            return
+        with self._lock:
+            waiting = self._waiting[key]
+            if not waiting:
+                del self._waiting[key]
+                return
+            job = waiting.popleft()
+        self._start(job)
+
+    def _withdraw(self, job):
+        """Take a job which has not started off the queue. Returns True if it had not started."""
+        with self._lock:
+            waiting = self._waiting.get(job.key) if job.key is not None else None
+            if waiting is not None and job in waiting:
+                waiting.remove(job)
+                return True
+        if job._future is not None and job._future.cancel():
+            # The job held its key's turn, so hand it to the next.
+            self._next(job.key)
+            return True
+        return False
+
+    def _run(self, job):
+        key = job.key
+        try:
+            if job.cancelled:
+                job._finish("cancelled")
+                return
+            job.started = time.perf_counter()
+            job.run(job.timings)
+        except Cancelled:
+            job._finish("cancelled")
+        except Exception as e:
+            job.error = e
+            job._finish("failed")
+        else:
+            job._finish("done")
+        finally:
+            self._next(key)
+
+    def running(self):
+        """The jobs which have not yet finished."""
+        return [job for job in self.jobs if not job.isFinished]
+
+    def shutdown(self, cancel=True):
+        """Stop the workers once their current jobs end, cancelling the rest unless cancel is False."""
+        if cancel:
+            for job in self.running():
+                job.cancel()
+        self.executor.shutdown(wait=False)
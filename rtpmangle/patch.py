@@ -0,0 +1,287 @@
+"""patch.py: Stores a mangled plan as a compact patch against the plan it was made from."""
+
+# Imports
+import base64
+import gzip
+import json
+import os
+
+from pydicom.charset import default_encoding
+from pydicom.dataelem import DataElement, RawDataElement
+from pydicom.datadict import dictionary_VR, keyword_for_tag
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_data_element
+from pydicom.sequence import Sequence
+from pydicom.tag import Tag
+
+from .cache import fileHash
+from .reader import UNDEFINED, _header, readPlan, readPlanBytes
+from .variants import shallowCopy
+from .writer import markModified
+
+"""
+Plan Patches
+------------
+
+A campaign of variants of one plan need not be stored as full copies of it. A patch records:
+
+    base      - The SHA-256 hash, size and path of the plan the variant was made from.
+    commands  - The variant's command strings, exactly as they were given.
+    keep_uid  - Whether the original SOPInstanceUID was kept.
+    elements  - Each element whose value differs from the base plan, by its path from the top of the plan,
+                e.g. ["BeamSequence", 0, "ControlPointSequence", 3, "GantryAngle"]. Text values are stored
+                as text, anything else in base64. Of a multi-valued text element, such as LeafJawPositions,
+                only the values that changed are stored, by their index. Elements the variant no longer has
+                are marked deleted, and sequences whose number of items has changed are stored whole.
+
+Values are stored exactly as they are encoded, so applyPatch() followed by writePlan() reproduces the
+variant's file byte for byte, without running the commands again - only the sequences the patch touches are
+decoded, and everything else is copied from the base file.
+
+Patches are saved as JSON, compressed with gzip unless the file name ends in .json.
+
+A campaign's patches are usually all made from the same plan. Given a PatchBases, materialize() reads and
+hashes each base plan only once, and applies each patch to a variant of it (see patchVariant()), which copies
+only the sequence items along the paths the patch changes - the base plan itself is never modified.
+
+"""
+
+FORMAT = "rtpmangle-patch"
+VERSION = 1
+_TEXT_VRS = {"AE", "AS", "CS", "DA", "DS", "DT", "IS", "LO", "LT", "PN", "SH", "ST", "TM", "UC", "UI", "UR", "UT"}
+
+
+def _name(tag):
+    return keyword_for_tag(tag) or "0x%08X" % tag
+
+
+def _vr(elem):
+    if elem.VR:
+        return elem.VR
+    try:
+        return dictionary_VR(elem.tag)
+    except KeyError:
+        return "UN"
+
+
+def _encode(elem, implicit, little, encodings):
+    """Return (undefined, value bytes) of an element as it would be written."""
+    if elem.is_raw:
+        return elem.length == UNDEFINED, bytes(elem.value)
+    buffer = DicomBytesIO()
+    buffer.is_implicit_VR, buffer.is_little_endian = implicit, little
+    write_data_element(buffer, elem, encodings)
+    data = buffer.getvalue()
+    tag, vr, length, start = _header(data, 0, implicit, "<" if little else ">")
+    if length == UNDEFINED:
+        return True, data[start:-8]
+    return False, data[start:start + length]
+
+
+def _changedValues(old, new):
+    """Return [index, text] for each value of a multi-valued text element that differs, or None if the number
+    of values has changed or the whole value would be shorter."""
+    oldValues, newValues = old.split(b"\\"), new.split(b"\\")
+    if len(oldValues) != len(newValues) or len(newValues) < 2:
+        return None
+    changed = [[i, v.decode("ascii")] for i, (u, v) in enumerate(zip(oldValues, newValues)) if u != v]
+    if sum(len(text) + 8 for i, text in changed) >= len(new):
+        return None
+    return changed
+
+
+class _Differ:
+    """Walks a variant and its base plan together, collecting the elements that differ."""
+
+    def __init__(self, ds):
+        self.implicit, self.little = ds.original_encoding
+        self.encodings = ds.get("SpecificCharacterSet", default_encoding)
+        self.entries = []
+
+    def encode(self, elem):
+        return _encode(elem, self.implicit, self.little, self.encodings)
+
+    def entry(self, path, elem, encoded=None, baseEncoded=None):
+        undefined, value = encoded or self.encode(elem)
+        entry = {"path": path, "vr": _vr(elem)}
+        if undefined:
+            entry["undefined"] = True
+        if entry["vr"] in _TEXT_VRS and value.isascii():
+            values = _changedValues(baseEncoded[1], value) if baseEncoded and baseEncoded[0] == undefined else None
+            if values is not None:
+                entry["values"] = values
+            else:
+                entry["value"] = value.decode("ascii")
+        else:
+            entry["base64"] = base64.b64encode(value).decode("ascii")
+        self.entries.append(entry)
+
+    def dataset(self, base, ds, path):
+        for tag in sorted(set(base.keys()) | set(ds.keys())):
+            before, after = base.get_item(tag), ds.get_item(tag)
+            elemPath = path + [_name(tag)]
+            if after is None:
+                self.entries.append({"path": elemPath, "deleted": True})
+            elif before is None:
+                self.entry(elemPath, after)
+            elif before is not after and not (isinstance(before, DataElement) and isinstance(after, DataElement)
+                                               and before.value is after.value):
+                self.element(base, ds, tag, elemPath)
+
+    def element(self, base, ds, tag, path):
+        before, after = base.get_item(tag), ds.get_item(tag)
+        if _vr(before) == "SQ" and _vr(after) == "SQ":
+            items, newItems = base[tag].value, ds[tag].value
+            if len(items) == len(newItems):
+                for i, (item, newItem) in enumerate(zip(items, newItems)):
+                    if item is not newItem:
+                        self.dataset(item, newItem, path + [i])
+                return
+        else:
+            encoded, baseEncoded = self.encode(after), self.encode(before)
+            if encoded != baseEncoded:
+                self.entry(path, after, encoded, baseEncoded)
+            return
+        self.entry(path, after)
+
+
+def makePatch(base, ds, commandStrings=(), keep_uid=False, baseHash=None, basePath=None):
+    """Return the patch which turns base into ds, a mangled variant of it, as a dict.
+
+    baseHash is the (sha256, size) of the base plan's file, from fileHash(). The patch is quickest to make for
+    variants from mangleVariant(), which share everything they have not edited with their base.
+    """
+    differ = _Differ(ds)
+    differ.dataset(base, ds, [])
+    sha, size = baseHash or (None, None)
+    return {
+        "format": FORMAT,
+        "version": VERSION,
+        "base": {"sha256": sha, "size": size, "path": os.path.abspath(basePath) if basePath else None},
+        "commands": [c if isinstance(c, str) else c.text for c in commandStrings],
+        "keep_uid": keep_uid,
+        "elements": differ.entries,
+    }
+
+
+def writePatch(patch, path):
+    """Save a patch, as gzip compressed JSON unless the path ends in .json."""
+    data = json.dumps(patch, separators=(",", ":")).encode("utf-8")
+    if not path.endswith(".json"):
+        data = gzip.compress(data, mtime=0)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def readPatch(path):
+    """Load a patch saved by writePatch()."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:2] == b"\x1f\x8b":
+        data = gzip.decompress(data)
+    patch = json.loads(data)
+    if patch.get("format") != FORMAT:
+        raise ValueError(path + " is not a plan patch.")
+    if patch.get("version", 0) > VERSION:
+        raise ValueError(path + " is a newer version of patch than this version of rtpmangle can read.")
+    return patch
+
+
+def patchName(outFile):
+    """The name of the patch standing in for an output file, e.g. out.dcm gives out.rtpatch."""
+    return os.path.splitext(outFile)[0] + ".rtpatch"
+
+
+def applyPatch(ds, patch, copied=None):
+    """Apply a patch to its base plan, read by readPlan(), in place. Returns the plan, ready for writePlan().
+
+    If copied is given, it is the set of ids of the datasets which belong to ds alone, and any other dataset
+    along a patch's path is copied before it is changed (see patchVariant()).
+    """
+    implicit, little = ds.original_encoding
+    encodings = ds.get("SpecificCharacterSet", default_encoding)
+    modified = set()
+    for entry in patch["elements"]:
+        path = entry["path"]
+        dataset = ds
+        for name, index in zip(path[:-1:2], path[1:-1:2]):
+            if copied is None:
+                dataset = dataset[Tag(name)].value[index]
+                continue
+            elem = dataset[Tag(name)]
+            if id(elem.value) not in copied:
+                elem.value = Sequence(elem.value)
+                copied.add(id(elem.value))
+            if id(elem.value[index]) not in copied:
+                elem.value[index] = shallowCopy(elem.value[index])
+                copied.add(id(elem.value[index]))
+            dataset = elem.value[index]
+        tag = Tag(path[-1])
+        modified.add(Tag(path[0]))
+
+        if entry.get("deleted"):
+            del dataset[tag]
+            continue
+        if "values" in entry:
+            values = _encode(dataset.get_item(tag), implicit, little, encodings)[1].split(b"\\")
+            for i, text in entry["values"]:
+                values[i] = text.encode("ascii")
+            value = b"\\".join(values)
+        elif "value" in entry:
+            value = entry["value"].encode("ascii")
+        else:
+            value = base64.b64decode(entry["base64"])
+        length = UNDEFINED if entry.get("undefined") else len(value)
+        dataset[tag] = RawDataElement(tag, entry["vr"], length, value, 0, implicit, little)
+
+    markModified(ds, modified)
+    return ds
+
+
+def patchVariant(base, patch):
+    """Return a variant of a base plan, read by readPlan(), with a patch applied. The base is left unchanged, so
+    may be patched again and again."""
+    variant = shallowCopy(base)
+    if getattr(base, "_modified", None) is not None:
+        # The record of edited elements is the variant's own (see writer.py).
+        variant._modified = set(base._modified)
+    return applyPatch(variant, patch, {id(variant)})
+
+
+class PatchBases:
+    """The base plans of a campaign of patches, each read and hashed only once."""
+
+    def __init__(self):
+        self._plans = {}
+
+    def __len__(self):
+        return len(self._plans)
+
+    def plan(self, path):
+        """Return the SHA-256 hex digest of the base plan at path, and the plan, read by readPlan()."""
+        key = os.path.realpath(path)
+        found = self._plans.get(key)
+        if found is None:
+            with open(path, "rb") as f:
+                data = f.read()
+            found = self._plans[key] = (fileHash(data)[0], readPlanBytes(data, path))
+        return found
+
+
+def materialize(patch, base=None, bases=None):
+    """Return the plan a patch describes. base is the path or bytes of its base plan, by default the path the
+    patch was made from. If bases, a PatchBases, is given, a base plan given by path is only read the first
+    time, and the patch is applied to a variant of it. Raises ValueError if the base plan is not the one the
+    patch was made from."""
+    base = patch["base"]["path"] if base is None else base
+    if base is None:
+        raise ValueError("The patch does not record the path of its base plan - give the base plan.")
+    sha = patch["base"].get("sha256")
+    if bases is not None and isinstance(base, str):
+        baseHash, plan = bases.plan(base)
+        if sha is not None and baseHash != sha:
+            raise ValueError("The base plan is not the one the patch was made from (SHA-256 " + sha + ").")
+        return patchVariant(plan, patch)
+    if sha is not None and fileHash(base)[0] != sha:
+        raise ValueError("The base plan is not the one the patch was made from (SHA-256 " + sha + ").")
+    return applyPatch(readPlan(base), patch)
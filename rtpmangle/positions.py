@@ -0,0 +1,246 @@
+"""positions.py: Holds the jaw and leaf positions of a beam as NumPy arrays for vectorised editing."""
+
+# Imports
+import numpy as np
+from pydicom.dataelem import RawDataElement
+from pydicom.multival import MultiValue
+from pydicom.tag import Tag
+
+from .command import ABSOLUTE, CHAIN, PERCENT, RELATIVE
+from .index import BLD_POSITION_SEQUENCE, CONTROL_POINT_SEQUENCE, DEVICE_TYPE
+from .reader import UNDEFINED, scanElements, sequenceItems
+
+LEAF_JAW_POSITIONS = Tag("LeafJawPositions")
+
+"""
+Encoded Control Points
+----------------------
+
+Decoding a beam's ControlPointSequence decodes every one of its items, and writing the plan then encodes
+every one of them again - for a VMAT beam of 178 control points, even if a command only moves the leaves of
+one. While a beam's control points are still encoded, BeamPositions instead scans only the items of the
+control points it selects for their LeafJawPositions (see EncodedControlPoints), and writes back a copy of
+the encoded sequence with just those values replaced, and the lengths of the items holding them corrected.
+Nothing is decoded, and the sequence stays encoded, so writePlan() copies it as it is.
+
+"""
+
+
+def parsePositions(data):
+    """Return the positions encoded in a LeafJawPositions value as a float array, or None if it is empty."""
+    data = bytes(data).strip(b" \0")
+    if not data:
+        return None
+    return np.array(data.split(b"\\"), dtype=float)
+
+
+def readPositions(item):
+    """Return the LeafJawPositions of a position item as a float array, decoding the raw bytes if possible.
+    Returns None if the item has no positions, or an empty value."""
+    elem = item.get_item(LEAF_JAW_POSITIONS)
+    if elem is None:
+        return None
+    if elem.is_raw and isinstance(elem.value, bytes):
+        return parsePositions(elem.value)
+    values = item[LEAF_JAW_POSITIONS].value
+    if values is None or values == "":
+        return None
+    return np.array([float(v) for v in (values if isinstance(values, MultiValue) else [values])], dtype=float)
+
+
+def encodePositions(values):
+    """Encode positions as the bytes of a Decimal String value, padded to an even length."""
+    text = "\\".join([("%.6f" % v).rstrip("0").rstrip(".") for v in values.tolist()])
+    if len(text) % 2:
+        text += " "
+    return text.encode("ascii")
+
+
+class EncodedControlPoints:
+    """The LeafJawPositions of the items of an encoded ControlPointSequence, found without decoding them.
+
+    positions(i) scans control point i for its position items. Each value is returned with its span - its
+    start and end in the sequence, and the length fields of the elements and items enclosing it, as
+    (position, size, length) - so encode() can replace it and correct the lengths around it.
+    """
+
+    def __init__(self, elem):
+        self.data = memoryview(elem.value)
+        self.implicit, self.little = elem.is_implicit_VR, elem.is_little_endian
+        self.endian = "<" if self.little else ">"
+        self.items = list(sequenceItems(self.data, self.implicit, self.endian))
+
+    @staticmethod
+    def encoded(elem):
+        """Return True if elem is a ControlPointSequence still holding its encoded items."""
+        return (isinstance(elem, RawDataElement) and elem.length != UNDEFINED and elem.VR in ("SQ", None)
+                and isinstance(elem.value, (bytes, memoryview)))
+
+    def __len__(self):
+        return len(self.items)
+
+    def _length(self, valueStart, size):
+        """The length field of size bytes just before valueStart, as (position, size, length)."""
+        position = valueStart - size
+        return position, size, int.from_bytes(self.data[position:valueStart], "little" if self.little else "big")
+
+    def positions(self, i):
+        """Return {device type: (span, values)} for the position items of control point i."""
+        found = {}
+        start, end = self.items[i]
+        cp = self._length(start, 4)
+        # LeafJawPositions is a Decimal String, whose explicit VR length field is 2 bytes long.
+        size = 4 if self.implicit else 2
+        for tag, vr, length, valueStart, valueEnd, _ in scanElements(self.data[start:end], 0, self.implicit,
+                                                                       self.little):
+            if tag != BLD_POSITION_SEQUENCE:
+                continue
+            sequence = self._length(start + valueStart, 4)
+            offset = start + valueStart
+            for itemStart, itemEnd in sequenceItems(self.data[offset:start + valueEnd], self.implicit, self.endian):
+                item = self._length(offset + itemStart, 4)
+                deviceType = span = None
+                for t, v, n, s, e, _ in scanElements(self.data[offset + itemStart:offset + itemEnd], 0,
+                                                     self.implicit, self.little):
+                    s, e = s + offset + itemStart, e + offset + itemStart
+                    if t == DEVICE_TYPE:
+                        deviceType = bytes(self.data[s:e]).decode("ascii").strip(" \0")
+                    elif t == LEAF_JAW_POSITIONS:
+                        span = (s, e, (cp, sequence, item, self._length(s, size)))
+                if deviceType and span is not None:
+                    values = parsePositions(self.data[span[0]:span[1]])
+                    if values is not None:
+                        found[deviceType] = (span, values)
+        return found
+
+    def encode(self, edits):
+        """Return the ControlPointSequence as a RawDataElement, with the values of edits - a list of
+        (span, bytes) - replaced."""
+        deltas = {}
+        replacements = []
+        for (start, end, lengths), value in edits:
+            replacements.append((start, end, value))
+            for field in lengths:
+                if field[2] != UNDEFINED:
+                    deltas[field] = deltas.get(field, 0) + len(value) - (end - start)
+        for (position, size, length), delta in deltas.items():
+            replacements.append((position, position + size,
+                                 (length + delta).to_bytes(size, "little" if self.little else "big")))
+
+        pieces = []
+        copied = 0
+        for start, end, value in sorted(replacements, key=lambda replacement: replacement[0]):
+            pieces += [self.data[copied:start], value]
+            copied = end
+        pieces.append(self.data[copied:])
+        value = b"".join(pieces)
+        return RawDataElement(CONTROL_POINT_SEQUENCE, "SQ", len(value), value, 0, self.implicit, self.little)
+
+
+class BeamPositions:
+    """The positions of the beam limiting devices of every control point in a beam.
+
+    For each device type, arrays[type] is an (n_cp, 2, n_pairs) float array - jaws are devices with a single
+    pair. DICOM only requires positions in control points where they change, so present[type] marks the
+    control points that actually carry the device. Only those are ever edited or written back.
+
+    If cpIndices is given, only those control points are loaded - the rest are left encoded, and so is the
+    ControlPointSequence itself if it has not been decoded already. If the plan's index (see index.py) and the
+    beam's index b within it are given, position items are found through it, and the number of pairs of each
+    device is taken from the beam's geometry.
+    """
+
+    def __init__(self, beam, deviceTypes, cpIndices=None, index=None, b=None):
+        self.beam = beam
+        elem = beam.get_item(CONTROL_POINT_SEQUENCE)
+        if EncodedControlPoints.encoded(elem):
+            cps = self._encoded = EncodedControlPoints(elem)
+        else:
+            cps = beam.ControlPointSequence
+            self._encoded = None
+        self.nCps = len(cps)
+        self.arrays = {}
+        self.present = {}
+        self._items = {}
+        self._dirty = {}
+
+        if cpIndices is None:
+            cpIndices = range(self.nCps)
+
+        rows = {}
+        for i in cpIndices:
+            if self._encoded is not None:
+                found = self._encoded.positions(i)
+            else:
+                if index is not None:
+                    items = index.positionItems(b, i, cps[i])
+                else:
+                    elem = cps[i].get(BLD_POSITION_SEQUENCE)
+                    items = {item[DEVICE_TYPE].value: item for item in (elem.value if elem is not None else [])}
+                found = {deviceType: (item, readPositions(item)) for deviceType, item in items.items()}
+            for deviceType, (item, values) in found.items():
+                if deviceType not in deviceTypes or values is None:
+                    continue
+                rows.setdefault(deviceType, []).append((i, item, values))
+
+        geometry = index.geometry(b, beam) if index is not None else None
+        for deviceType, found in rows.items():
+            nPairs = geometry.nPairs(deviceType) if geometry is not None else None
+            if nPairs is None:
+                nPairs = len(found[0][2]) // 2
+            array = np.full((self.nCps, 2, nPairs), np.nan)
+            present = np.zeros(self.nCps, dtype=bool)
+            items = [None] * self.nCps
+            for i, item, values in found:
+                if len(values) != 2 * nPairs:
+                    raise ValueError("Control point " + str(i) + " has " + str(len(values)) + " " + deviceType
+                                     + " positions, expected " + str(2 * nPairs) + ".")
+                array[i] = values.reshape(2, nPairs)
+                present[i] = True
+                items[i] = item
+            self.arrays[deviceType] = array
+            self.present[deviceType] = present
+            self._items[deviceType] = items
+            self._dirty[deviceType] = np.zeros(self.nCps, dtype=bool)
+
+    def nPairs(self, deviceType):
+        return self.arrays[deviceType].shape[2]
+
+    def edit(self, deviceType, cpIndices, banks, pairs, operand):
+        """Apply an operand to the given banks and pairs of the selected control points. Returns the number of
+        positions edited."""
+        array = self.arrays[deviceType]
+        rows = np.asarray(cpIndices, dtype=int)
+        rows = rows[self.present[deviceType][rows]]
+        if not len(rows) or not len(banks) or not len(pairs):
+            return 0
+
+        index = np.ix_(rows, banks, pairs)
+        for step in operand.value if operand.mode == CHAIN else (operand,):
+            if step.mode == ABSOLUTE:
+                array[index] = step.value
+            elif step.mode == RELATIVE:
+                array[index] = np.round(array[index] + step.value, 6)
+            elif step.mode == PERCENT:
+                array[index] = np.round(array[index] * (1 + step.value / 100), 6)
+        self._dirty[deviceType][rows] = True
+        return len(rows) * len(banks) * len(pairs)
+
+    def writeBack(self):
+        """Write the edited control points back to the dataset, once per position item, once editing is
+        finished. Control points still encoded are written back in a single new encoding of the beam's
+        ControlPointSequence."""
+        edits = []
+        for deviceType, dirty in self._dirty.items():
+            array = self.arrays[deviceType]
+            items = self._items[deviceType]
+            for i in np.flatnonzero(dirty):
+                value = encodePositions(array[i].ravel())
+                if self._encoded is not None:
+                    edits.append((items[i], value))
+                else:
+                    items[i][LEAF_JAW_POSITIONS] = RawDataElement(
+                        LEAF_JAW_POSITIONS, "DS", len(value), value, 0, False, True)
+            dirty[:] = False
+        if edits:
+            self.beam[CONTROL_POINT_SEQUENCE] = self._encoded.encode(edits)
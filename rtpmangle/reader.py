@@ -0,0 +1,231 @@
+"""reader.py: Reads RT Plans, decoding only the elements the mangler edits."""
+
+# Imports
+import mmap
+import os
+from io import BytesIO
+from struct import error as StructError, unpack_from
+
+import pydicom
+from pydicom.dataelem import RawDataElement
+from pydicom.dataset import Dataset, FileDataset
+from pydicom.filereader import _read_file_meta_info, read_preamble
+from pydicom.tag import Tag
+from pydicom.uid import ExplicitVRBigEndian, ExplicitVRLittleEndian, ImplicitVRLittleEndian
+
+"""
+Selective Reading
+-----------------
+
+pydicom.dcmread() walks every element of a file, and fully parses any sequence of undefined length -
+vendor private sequences included - whether or not it is ever used. readPlan() instead scans only the
+element headers of the top level of the dataset, skipping over the contents of sequences without
+decoding them. Every top level element is kept as its raw bytes, and only the elements the mangler
+needs are decoded. Elements which are never accessed are written back out unchanged by save_as().
+
+The original bytes of each top level element are kept with the plan as its source (see sourceElements()),
+so writePlan() can copy the elements that were not edited rather than encoding them again (see writer.py).
+
+Files of MAP_BYTES or more are memory mapped rather than read. The large binary and sequence values of a
+mapped file - such as vendor private payloads - are kept as views of the map, and so are served straight
+from the operating system's page cache, without being copied into memory. Variants share the views of their
+base plan, and every process mapping the same file, such as the workers of a sweep, shares the same pages.
+A mapped file must not be truncated or rewritten in place while its plan is in use - reading a page of the
+map beyond the end of a truncated file kills the process with SIGBUS. writePlan() replaces the file instead
+if asked to overwrite the plan's own source, and before reading the map checks the file has not been
+rewritten in place since it was read, raising ValueError if it has (see writer.py). Plans held for a long
+time, such as those cached by the mangle service or loaded in the GUI, are read with mapped=False, so they
+are copied into memory and never depend on the file. Windows will not let mapped files be replaced, so
+files are only mapped on other systems.
+
+Files that cannot be scanned this way, such as deflated transfer syntaxes, are read with dcmread().
+
+"""
+
+# Top level elements decoded as soon as the plan is read. Machine names are held within the beams.
+EAGER = [Tag("SOPInstanceUID"), Tag("BeamSequence"), Tag("FractionGroupSequence")]
+
+UNDEFINED = 0xFFFFFFFF
+ITEM = 0xFFFEE000
+ITEM_DELIMITER = 0xFFFEE00D
+SEQUENCE_DELIMITER = 0xFFFEE0DD
+PIXEL_DATA = 0x7FE00010
+
+# Files of this size or more are memory mapped, other than on Windows.
+MAP_BYTES = 1 << 20
+MAP_FILES = os.name != "nt"
+
+# Values of these VRs, of this size or more, are kept as views of a mapped file. pydicom decodes them from
+# any buffer, whereas text values must be bytes.
+VIEW_BYTES = 4096
+_VIEW_VRS = {"OB", "OW", "UN", "SQ"}
+
+# Explicit VRs with a 4 byte length, after 2 reserved bytes.
+_LONG_VRS = {b"OB", b"OD", b"OF", b"OL", b"OV", b"OW", b"SQ", b"SV", b"UC", b"UN", b"UR", b"UT", b"UV"}
+
+_ENCODINGS = {
+    ImplicitVRLittleEndian: (True, True),
+    ExplicitVRLittleEndian: (False, True),
+    ExplicitVRBigEndian: (False, False),
+}
+
+
+def _header(data, pos, implicit, endian):
+    """Read the element header at pos. Returns (tag, vr, length, valueStart)."""
+    group, element, = unpack_from(endian + "HH", data, pos)
+    tag = group << 16 | element
+    if implicit or group == 0xFFFE:
+        # Items and delimiters never have a VR.
+        return tag, None, unpack_from(endian + "L", data, pos + 4)[0], pos + 8
+    vr = bytes(data[pos + 4:pos + 6])
+    if vr in _LONG_VRS:
+        return tag, vr, unpack_from(endian + "L", data, pos + 8)[0], pos + 12
+    return tag, vr, unpack_from(endian + "H", data, pos + 6)[0], pos + 8
+
+
+def _skipUndefined(data, pos, implicit, endian, delimiter):
+    """Step over the contents of an undefined length sequence or item, which start at pos.
+
+    Returns (valueEnd, end) - the positions of the delimiter and of the first byte after it.
+    """
+    while True:
+        if pos + 8 > len(data):
+            raise ValueError("Missing delimiter - the file is truncated.")
+        tag, vr, length, valueStart = _header(data, pos, implicit, endian)
+        if tag == delimiter:
+            return pos, valueStart
+        if length == UNDEFINED:
+            # Sequences hold items, and items hold elements. Undefined length UN is encoded as implicit VR.
+            inner = ITEM_DELIMITER if tag == ITEM else SEQUENCE_DELIMITER
+            pos = _skipUndefined(data, valueStart, implicit or vr == b"UN", endian, inner)[1]
+        else:
+            pos = valueStart + length
+
+
+def sequenceItems(data, implicit, endian):
+    """Yield the (start, end) of the contents of each item in an encoded sequence value."""
+    pos = 0
+    while pos + 8 <= len(data):
+        tag, vr, length, start = _header(data, pos, implicit, endian)
+        if tag == SEQUENCE_DELIMITER:
+            return
+        if length == UNDEFINED:
+            end, pos = _skipUndefined(data, start, implicit, endian, ITEM_DELIMITER)
+        else:
+            end = pos = start + length
+        yield start, end
+
+
+def scanElements(data, pos, implicit, little):
+    """Scan the top level elements of a dataset encoded in data from pos onwards, without decoding them.
+
+    Returns a list of (tag, vr, length, valueStart, valueEnd, end) tuples. For elements of undefined length,
+    valueEnd is the position of the sequence delimiter.
+    """
+    endian = "<" if little else ">"
+    elements = []
+    while pos < len(data):
+        tag, vr, length, valueStart = _header(data, pos, implicit, endian)
+        if length == UNDEFINED:
+            valueEnd, end = _skipUndefined(data, valueStart, implicit or vr == b"UN", endian, SEQUENCE_DELIMITER)
+        else:
+            valueEnd = end = valueStart + length
+            if end > len(data):
+                raise ValueError("Element " + str(Tag(tag)) + " runs past the end of the file.")
+        elements.append((tag, vr, length, valueStart, valueEnd, end))
+        pos = end
+    return elements
+
+
+def rawElements(data, elements, implicit, little, views=False):
+    """Build a RawDataElement for each scanned element, holding its undecoded value bytes. If views is set, large
+    binary and sequence values are views of data rather than copies."""
+    raw = {}
+    view = memoryview(data) if views else None
+    for tag, vr, length, valueStart, valueEnd, end in elements:
+        if vr is not None:
+            vr = vr.decode("ascii")
+        elif length == UNDEFINED:
+            # Only sequences (and encapsulated pixel data) may have an undefined length.
+            vr = "OB" if tag == PIXEL_DATA else "SQ"
+        if views and vr in _VIEW_VRS and valueEnd - valueStart >= VIEW_BYTES:
+            value = view[valueStart:valueEnd]
+        else:
+            value = data[valueStart:valueEnd]
+        raw[Tag(tag)] = RawDataElement(Tag(tag), vr, length, value, valueStart, implicit, little)
+    return raw
+
+
+def sourceElements(data, elements, start, raw):
+    """Record the original encoding of each top level element, as {tag: (raw, header, trailer)} - the element's
+    RawDataElement, and the bytes before and after its value. The trailer holds the sequence delimiter of an
+    undefined length element, and is otherwise empty."""
+    source = {}
+    for tag, vr, length, valueStart, valueEnd, end in elements:
+        source[Tag(tag)] = (raw[Tag(tag)], data[start:valueStart], data[valueEnd:end])
+        start = end
+    return source
+
+
+def readPlan(source, lazy=True, mapped=None):
+    """Read an RT Plan, decoding only the elements the mangler needs. Set lazy to False to read the whole file
+    with pydicom.dcmread().
+
+    The source may be a path, the bytes of a DICOM file, or a binary file object such as sys.stdin.buffer or a
+    BytesIO. A path is memory mapped if mapped is True, or by default if the file is MAP_BYTES or more. Pass
+    mapped=False for plans kept for longer than a single run, which must not depend on the file.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        data, filename = bytes(source), None
+    elif hasattr(source, "read"):
+        data, filename = source.read(), getattr(source, "name", None)
+    elif not lazy:
+        return pydicom.dcmread(source)
+    else:
+        with open(source, "rb") as f:
+            info = os.fstat(f.fileno())
+            if info.st_size and (mapped if mapped is not None else MAP_FILES and info.st_size >= MAP_BYTES):
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = f.read()
+        ds = readPlanBytes(data, source)
+        if getattr(ds, "_mapped", False):
+            # The file as it was mapped, so the writer can tell if it has since been rewritten in place.
+            ds._mapStat = (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns)
+        return ds
+
+    if not lazy:
+        return pydicom.dcmread(BytesIO(data))
+    return readPlanBytes(data, filename if isinstance(filename, str) else None)
+
+
+def readPlanBytes(data, filename=None):
+    """Read an RT Plan from the bytes of a DICOM file, decoding only the elements the mangler needs. The data may
+    also be a read only mmap of the file."""
+    mapped = isinstance(data, mmap.mmap)
+    try:
+        # A mmap is itself a file object, so the file meta information is read without copying the file.
+        fp = data if mapped else BytesIO(data)
+        fp.seek(0)
+        preamble = read_preamble(fp, False)
+        fileMeta = _read_file_meta_info(fp)
+        implicit, little = _ENCODINGS[fileMeta.TransferSyntaxUID]
+        start = fp.tell()
+        elements = scanElements(data, start, implicit, little)
+    except (KeyError, AttributeError, ValueError, StructError, pydicom.errors.InvalidDicomError):
+        # Not a simple transfer syntax, or not something the scanner can follow - leave it to pydicom.
+        ds = pydicom.dcmread(BytesIO(data))
+        ds.filename = filename
+        return ds
+
+    raw = rawElements(data, elements, implicit, little, views=mapped)
+    ds = FileDataset(filename, Dataset(raw), preamble, fileMeta, implicit, little)
+    ds.set_original_encoding(implicit, little, ds._character_set)
+    ds._source = sourceElements(data, elements, start, raw)
+    ds._modified = set()
+    ds._mapped = mapped
+
+    for tag in EAGER:
+        if tag in ds:
+            ds[tag]
+    return ds
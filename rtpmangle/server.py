@@ -0,0 +1,253 @@
+"""server.py: A long running mangle service, which keeps recently used plans parsed in memory."""
+
+# Imports
+import hashlib
+import json
+import os
+import socketserver
+import stat
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from pydicom.errors import InvalidDicomError
+
+from .command import CommandError, parse
+from .reader import readPlan, readPlanBytes
+from .variants import mangleVariant
+from .writer import planBytes, writePlan
+
+"""
+Mangle Service
+--------------
+
+The service listens on a local HTTP port or a Unix socket, so each request avoids the cost of starting an
+interpreter, importing pydicom and reading the plan. Requests are handled on their own threads:
+
+    GET  /status    The plan cache statistics, as JSON.
+
+    POST /mangle    With a JSON body (Content-Type: application/json) giving the plan by path:
+                        {"path": "plan.dcm", "commands": ["b0 g=+5"], "keep_uid": false, "outFile": "out.dcm"}
+                    Or with the plan's bytes uploaded as the body (Content-Type: application/dicom), and the
+                    options given in the query string:
+                        /mangle?command=b0+g%3D%2B5&command=mu%3D%2B2%25&keep_uid=1
+
+If an outFile is given the variant is written there and its path returned as JSON, otherwise the response
+is the DICOM file itself. Errors are returned as JSON {"error": "..."} with a 4xx status - or 500 for an
+unexpected failure, so every request gets a response.
+
+Any web page the user visits may POST to a local port, but only with a "simple" content type such as
+text/plain unless the server agrees to more - which this one never does. So only the JSON and DICOM content
+types are accepted, and anything else is refused with 415. Plans and output files may only be given by path
+if the service is started with a root directory, and must then lie within it (after following symbolic
+links), so a request can never read or write files elsewhere. Relative paths are taken from the root.
+
+Plans are cached by path (along with the file's modification time and size, so an edited file is read again)
+or by the SHA-256 hash of uploaded bytes. Each request mangles a copy on write variant of the cached plan
+(see variants.py), so the cached dataset is never modified.
+
+"""
+
+
+class PlanCache:
+    """A least recently used cache of parsed plans, bounded by the total size of their files.
+
+    Each plan is charged at the size of its file, which bounds the number of plans kept rather than the memory
+    they use. Plans are read selectively (see reader.py), so a plan starts out close to the size of its file,
+    but the sequences requests decode stay decoded in the cached plan - the beams on every request, and the
+    control points of each beam a range filter (ga, ca, cw) searches - and decoded control points take several
+    times the memory of their encoded bytes.
+    """
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._plans)
+
+    def get(self, key, load):
+        """Return the plan cached under key. If there is none, load() - which returns (dataset, nBytes) - is
+        called to read it, and the least recently used plans are evicted to make room."""
+        with self._lock:
+            entry = self._plans.get(key)
+            if entry is not None:
+                self._plans.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        # Read outside the lock, so other requests are not held up.
+        dataset, nBytes = load()
+
+        with self._lock:
+            if key not in self._plans:
+                self._plans[key] = (dataset, nBytes)
+                self.size += nBytes
+                while self.size > self.maxBytes:
+                    evicted, (ds, n) = self._plans.popitem(last=False)
+                    self.size -= n
+        return dataset
+
+    def status(self):
+        with self._lock:
+            return {"plans": len(self._plans), "bytes": self.size, "maxBytes": self.maxBytes,
+                    "hits": self.hits, "misses": self.misses}
+
+
+class MangleHandler(BaseHTTPRequestHandler):
+    """Handles the requests made to a mangle service."""
+
+    server_version = "rtpmangle"
+
+    def address_string(self):
+        # Unix socket clients have no address.
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def sendJSON(self, status, content):
+        self.sendBytes(status, json.dumps(content).encode("utf-8"), "application/json")
+
+    def sendBytes(self, status, body, contentType):
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlsplit(self.path).path != "/status":
+            self.sendJSON(404, {"error": "Unknown path " + self.path})
+            return
+        self.sendJSON(200, self.server.cache.status())
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != "/mangle":
+            self.sendJSON(404, {"error": "Unknown path " + self.path})
+            return
+
+        contentType = self.headers.get_content_type()
+        if contentType not in ("application/json", "application/dicom"):
+            self.sendJSON(415, {"error": "Send a JSON request (application/json) or a DICOM file "
+                                         "(application/dicom), not " + contentType + "."})
+            return
+
+        try:
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+            except ValueError:
+                raise ValueError("Invalid Content-Length.")
+            if length < 0:
+                raise ValueError("Invalid Content-Length.")
+            body = self.rfile.read(length)
+
+            if contentType == "application/json":
+                request = json.loads(body)
+                if not isinstance(request, dict):
+                    raise ValueError("A JSON request must be an object.")
+                if not isinstance(request.get("path"), str):
+                    raise ValueError("A JSON request must give the plan's path.")
+                plan = self.server.resolve(request["path"])
+            else:
+                query = parse_qs(url.query)
+                request = {"commands": query.get("command", []),
+                           "keep_uid": query.get("keep_uid", ["0"])[0].lower() in ("1", "true", "yes"),
+                           "outFile": query.get("outFile", [None])[0]}
+                plan = body
+
+            start = time.perf_counter()
+            cmdStrs = request.get("commands") or []
+            if not isinstance(cmdStrs, list) or not all(isinstance(cmdStr, str) for cmdStr in cmdStrs):
+                raise ValueError("commands must be a list of command strings.")
+            commands = [parse(cmdStr) for cmdStr in cmdStrs]
+            if not commands:
+                raise ValueError("At least one command string is required.")
+            outFile = request.get("outFile")
+            if outFile:
+                outFile = self.server.resolve(outFile)
+            output = mangleVariant(self.server.plan(plan), commands, bool(request.get("keep_uid")))
+
+            if outFile:
+                writePlan(output, outFile)
+                self.sendJSON(200, {"outFile": outFile, "seconds": round(time.perf_counter() - start, 4)})
+            else:
+                self.sendBytes(200, planBytes(output), "application/dicom")
+        except FileNotFoundError as e:
+            self.sendJSON(404, {"error": str(e)})
+        except PermissionError as e:
+            self.sendJSON(403, {"error": str(e)})
+        except InvalidDicomError as e:
+            self.sendJSON(400, {"error": "The plan is not a DICOM file - " + str(e)})
+        except (CommandError, ValueError, OSError, AttributeError, KeyError, IndexError) as e:
+            # Plans which are DICOM but not RT Plans, or are missing elements, fail as they are read or mangled.
+            self.sendJSON(400, {"error": str(e)})
+        except Exception as e:
+            self.log_error("Request failed: %r", e)
+            self.sendJSON(500, {"error": "Internal error - " + type(e).__name__ + ": " + str(e)})
+
+
+class PlanService:
+    """The plan cache and root directory shared by the HTTP and Unix socket servers."""
+
+    def setUp(self, cacheBytes, root):
+        self.cache = PlanCache(cacheBytes)
+        self.root = None if root is None else os.path.realpath(root)
+
+    def resolve(self, path):
+        """Return the real path of a plan or output file named in a request. Raises PermissionError unless the
+        service has a root directory and the path lies within it."""
+        if self.root is None:
+            raise PermissionError("Plans and output files can only be given by path when the service is started "
+                                  "with a root directory (--root).")
+        if not isinstance(path, str):
+            raise ValueError("Paths must be strings.")
+        real = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath([real, self.root]) != self.root:
+            raise PermissionError(path + " is outside the service's root directory.")
+        return real
+
+    def plan(self, source):
+        """Return the parsed plan for a resolved path or the bytes of a file, from the cache if possible."""
+        if isinstance(source, bytes):
+            key = ("bytes", hashlib.sha256(source).hexdigest())
+            return self.cache.get(key, lambda: (readPlanBytes(source), len(source)))
+
+        path = source
+        info = os.stat(path)
+        key = ("path", path, info.st_mtime_ns, info.st_size)
+        # Cached plans are copied into memory, as their files may be rewritten while they are cached.
+        return self.cache.get(key, lambda: (readPlan(path, mapped=False), info.st_size))
+
+
+class MangleServer(PlanService, ThreadingHTTPServer):
+    """A mangle service listening on a TCP port."""
+
+    daemon_threads = True
+
+    def __init__(self, address, cacheBytes, root=None):
+        super().__init__(address, MangleHandler)
+        self.setUp(cacheBytes, root)
+
+
+class UnixMangleServer(PlanService, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """A mangle service listening on a Unix socket."""
+
+    daemon_threads = True
+
+    def __init__(self, socketPath, cacheBytes, root=None):
+        # Remove the socket left behind by a previous server, but never anything else.
+        if os.path.exists(socketPath) and stat.S_ISSOCK(os.stat(socketPath).st_mode):
+            os.unlink(socketPath)
+        super().__init__(socketPath, MangleHandler)
+        self.setUp(cacheBytes, root)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
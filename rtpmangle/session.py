@@ -0,0 +1,116 @@
+"""session.py: Keeps a plan in memory between edits, for interactive use such as the GUI."""
+
+# Imports
+import os
+
+from .command import parse
+from .reader import readPlan
+from .timing import NO_TIMINGS
+from .variants import mangleVariant
+from .writer import writePlan
+
+
+class LoadedPlan:
+    """A plan which is read once and kept in memory.
+
+    Each call to mangle() applies its command strings to a copy on write variant of the plan (see
+    variants.py), so the loaded dataset is never modified and can be mangled again and again. The file is
+    only read again if its modification time has changed since it was loaded. The plan is copied into memory
+    rather than memory mapped (see reader.py), so the file may be rewritten while it is loaded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self._dataset = None
+
+    def dataset(self, timings=NO_TIMINGS):
+        """Return the plan's dataset, reading it again if the file has changed on disk."""
+        mtime = os.stat(self.path).st_mtime_ns
+        if self._dataset is None or mtime != self.mtime:
+            with timings.phase("read"):
+                self._dataset = readPlan(self.path, mapped=False)
+            self.mtime = mtime
+        return self._dataset
+
+    def mangle(self, outFile, commandStrings, keep_uid=False, verbose=False, timings=NO_TIMINGS):
+        """Write a mangled variant of the plan to outFile, and return its dataset. Pass a timing.Timings as
+        timings to record where the time goes."""
+        output = mangleVariant(self.dataset(timings), commandStrings, keep_uid, verbose, timings)
+        with timings.phase("write"):
+            writePlan(output, outFile)
+        return output
+
+
+class EditHistory:
+    """Undo and redo for a plan which is edited one command string at a time, as in the GUI.
+
+    Each step is a snapshot of the plan after its edits - a copy on write variant of the step before it (see
+    variants.py), so a snapshot holds its own copies of only the beams, control points and fraction groups
+    its edits touched, and shares everything else with the steps before it. Stepping back and forth only
+    moves between snapshots already in memory, and the plan is never read again. Each step also keeps a state,
+    whatever the caller wants restored with it, such as the text of a command string.
+    """
+
+    def __init__(self, base, state=None):
+        self.base = base
+        self.steps = [((), base, state)]
+        self.position = 0
+
+    @property
+    def commands(self):
+        """The normalised command strings applied to reach the current step."""
+        return self.steps[self.position][0]
+
+    @property
+    def dataset(self):
+        """The snapshot of the plan at the current step. It must not be edited."""
+        return self.steps[self.position][1]
+
+    @property
+    def state(self):
+        return self.steps[self.position][2]
+
+    def canUndo(self):
+        return self.position > 0
+
+    def canRedo(self):
+        return self.position < len(self.steps) - 1
+
+    def apply(self, commandStrings, state=None, verbose=False, timings=NO_TIMINGS):
+        """Apply command strings to the current step, as a new step, and return its snapshot. Any steps which
+        had been undone are forgotten. If a command fails the history is left unchanged. Pass a timing.Timings
+        as timings to record where the time goes - or the timings of a job (see jobs.py), to run the step in
+        the background."""
+        commands = [parse(c) if isinstance(c, str) else c for c in commandStrings]
+        # The SOPInstanceUID is only replaced when a step is written.
+        snapshot = mangleVariant(self.dataset, commands, True, verbose, timings)
+        del self.steps[self.position + 1:]
+        self.steps.append((self.commands + tuple(str(cmd) for cmd in commands), snapshot, state))
+        self.position += 1
+        return snapshot
+
+    def undo(self):
+        """Step back, returning the state of the step now current."""
+        if self.canUndo():
+            self.position -= 1
+        return self.state
+
+    def redo(self):
+        """Step forward again after undo(), returning the state of the step now current."""
+        if self.canRedo():
+            self.position += 1
+        return self.state
+
+    def matches(self, commandStrings):
+        """Whether the current step is the result of these command strings. They are compared as compiled, so
+        spacing and trailing zeros do not matter, but every digit of a value does."""
+        return self.commands == tuple(str(parse(c)) if isinstance(c, str) else str(c) for c in commandStrings)
+
+    def write(self, outFile, keep_uid=False, timings=NO_TIMINGS, dataset=None):
+        """Write the current step, or the snapshot dataset of another, to outFile, with a new SOPInstanceUID
+        unless keep_uid, and return its dataset."""
+        output = mangleVariant(self.dataset if dataset is None else dataset, [], keep_uid, timings=timings)
+        with timings.phase("write"):
+            writePlan(output, outFile)
+        return output
@@ -0,0 +1,241 @@
+"""setters.py: The registry of setters that perform the edits selected by a command."""
+
+# Imports
+import functools
+import re
+
+from .command import ABSOLUTE, CHAIN, FILTERS, PERCENT, RELATIVE, SETTERS
+
+"""
+Setters
+-------
+
+A setter is registered against the key used in command strings (the text before the "="). Each setter
+declares how its operand is read - see command.SETTERS - and implements apply(), which receives the
+dataset, the compiled command, the selection made by the filters (a list of (beamIndex, beam, cpIndices)
+tuples, see engine.select) and the operand. Setters which edit leaf or jaw positions return the number of
+positions they edited, for the profile (see timing.py).
+
+Each setter also declares its scope - the part of the plan it writes to: "fraction" (the fraction group
+sequence), "beam" (the selected beams themselves) or "controlpoint" (the selected control points). Variants
+use this to copy only what a command will edit. The default, "plan", makes no promises.
+
+Setters which set chains accept an operand of mode CHAIN - a tuple of operands to apply in turn - which lets
+consecutive commands editing the same selection be merged (see command.coalesce). applyOperand() handles
+chains, so setters built on it need only set chains = True.
+
+Third party setters subclass BaseSetter (or ControlPointSetter for control point attributes) and are made
+available to command strings with registerSetter().
+
+Setters are registered whenever the package is imported, so this module must not import pydicom or NumPy
+at the top level - they are imported when a setter is first applied.
+
+"""
+
+
+def registerSetter(key, setter):
+    """Make a setter available to command strings as key=value."""
+    if not re.fullmatch("[a-z]+", key):
+        raise ValueError("Setter keys must be lower case letters: '" + key + "'")
+    if key in FILTERS:
+        raise ValueError("Setter key '" + key + "' is already used by a filter.")
+    SETTERS[key] = setter
+    return setter
+
+
+def toDS(value):
+    """Round a computed value so it stays within the 16 characters allowed for a Decimal String."""
+    return round(float(value), 6)
+
+
+def applyOperand(operand, values):
+    """Apply a numeric operand to a list of values in a single pass."""
+    v = operand.value
+    if operand.mode == CHAIN:
+        for step in v:
+            values = applyOperand(step, values)
+        return values
+    if operand.mode == ABSOLUTE:
+        return [toDS(v)] * len(values)
+    elif operand.mode == RELATIVE:
+        return [round(float(x) + v, 6) for x in values]
+    elif operand.mode == PERCENT:
+        factor = 1 + v / 100
+        return [round(float(x) * factor, 6) for x in values]
+    return [v] * len(values)
+
+
+class BaseSetter:
+    """Base class for setters."""
+    name = ""
+    type = "number"
+    position = False
+    scope = "plan"
+    chains = False
+
+    def apply(self, ds, cmd, selection, operand):
+        raise NotImplementedError
+
+
+class MUSetter(BaseSetter):
+    """Change the prescribed monitor units of each selected beam."""
+    name = "MU"
+    scope = "fraction"
+    chains = True
+
+    def apply(self, ds, cmd, selection, operand):
+        from .index import planIndex
+        index = planIndex(ds)
+        for b, beam, cpIndices in selection:
+            # Metersets are found by beam number, in every fraction group that references the beam.
+            referencedBeams = index.referencedBeams(ds, index.beamNumbers[b])
+            if not referencedBeams:
+                print("WARNING: No Meterset Found for Beam " + str(b) + " - Ignoring beam.\n")
+            for referenced in referencedBeams:
+                referenced.BeamMeterset = applyOperand(operand, [referenced.BeamMeterset])[0]
+
+
+class MachineSetter(BaseSetter):
+    """Change the treatment machine name of each selected beam."""
+    name = "Machine"
+    type = "str"
+    scope = "beam"
+    chains = True
+
+    def apply(self, ds, cmd, selection, operand):
+        for b, beam, cpIndices in selection:
+            beam.TreatmentMachineName = operand.value
+
+
+class ControlPointSetter(BaseSetter):
+    """Change a numeric attribute of each selected control point.
+
+    Each beam's values are read into a dense view with inherited values filled in (see state.py), the
+    selected control points are edited in one pass, and the changes are written back sparsely.
+    """
+    scope = "controlpoint"
+    chains = True
+
+    def __init__(self, name, attr):
+        self.name = name
+        self.attr = attr
+
+    @functools.cached_property
+    def tag(self):
+        from pydicom.datadict import tag_for_keyword
+        tag = tag_for_keyword(self.attr)
+        if tag is None:
+            raise ValueError("Unknown DICOM keyword '" + self.attr + "'")
+        return tag
+
+    def apply(self, ds, cmd, selection, operand):
+        from .index import planIndex
+        from .state import ControlPointState
+        index = planIndex(ds)
+        for b, beam, cpIndices in selection:
+            state = ControlPointState(beam, self.tag)
+            state.edit(cpIndices, operand)
+            if state.writeBack():
+                # The values have changed, so the range filters must sort them again.
+                index.invalidate(b, self.attr)
+
+
+class PositionSetter(BaseSetter):
+    """Change the position of the jaws or MLC leaves chosen by the device filters.
+
+    When NumPy is available, each beam's positions are loaded once into arrays, edited with vectorised
+    operations and written back once per beam. Otherwise each control point's list is edited in turn. Returns
+    the number of positions edited - those of control points and devices the beams actually hold.
+    """
+    position = True
+    scope = "controlpoint"
+    chains = True
+
+    def __init__(self, name, type):
+        self.name = name
+        self.type = type
+
+    def apply(self, ds, cmd, selection, operand):
+        if not selection:
+            return 0
+
+        if cmd.device == "mlc":
+            targets = ("MLCX", "MLCY")
+            banks = cmd.filter("lb") or (0, 1)
+            pairs = cmd.filter("lp")
+        else:
+            # Jaws - each jaw is a device holding a single pair of positions.
+            targets = []
+            for jaw in (cmd.filter("j") or (0, 1)):
+                if jaw == 0:
+                    targets += ["ASYMX", "X"]
+                elif jaw == 1:
+                    targets += ["ASYMY", "Y"]
+            banks = cmd.filter("jb") or (0, 1)
+            pairs = (0,)
+        banks = [bank for bank in banks if bank < 2]
+
+        from .index import planIndex
+        index = planIndex(ds)
+
+        try:
+            from .positions import BeamPositions
+        except ImportError:
+            # NumPy is optional - without it, positions are edited as lists.
+            return self.applyLists(index, selection, targets, banks, pairs, operand)
+
+        # Every beam is edited against its own geometry, so beams of different machines and MLC models can
+        # be edited by the same command.
+        warned = []
+        edited = 0
+        for b, beam, cpIndices in selection:
+            positions = BeamPositions(beam, targets, cpIndices, index, b)
+            for deviceType in positions.arrays:
+                devicePairs = self.devicePairs(pairs, positions.nPairs(deviceType), warned)
+                edited += positions.edit(deviceType, cpIndices, banks, devicePairs, operand)
+            positions.writeBack()
+        return edited
+
+    def devicePairs(self, pairs, nPairs, warned):
+        """The selected pairs which exist in a device of nPairs pairs. Warns once per command, using the
+        warned list, if any do not."""
+        if pairs is None:
+            return list(range(nPairs))
+        inRange = [p for p in pairs if p < nPairs]
+        if len(inRange) < len(pairs) and not warned:
+            print("WARNING: Leaf Pair Out of MLC Range - Ignoring pairs beyond " + str(nPairs - 1) + ".\n")
+            warned.append(nPairs)
+        return inRange
+
+    def applyLists(self, index, selection, targets, banks, pairs, operand):
+        """Edit the positions of each control point as Python lists. Returns the number of positions edited."""
+        from pydicom.multival import MultiValue
+        from .index import DeviceGeometry
+        warned = []
+        edited = 0
+        for b, beam, cpIndices in selection:
+            # DICOM stores both banks in one long list - the beam's geometry gives the number of pairs to split it.
+            geometry = index.geometry(b, beam)
+            cpSequence = beam.ControlPointSequence
+            for i in cpIndices:
+                for deviceType, bld in index.positionItems(b, i, cpSequence[i]).items():
+                    values = bld.get("LeafJawPositions")
+                    if deviceType in targets and values not in (None, ""):
+                        positions = [float(v) for v in (values if isinstance(values, MultiValue) else [values])]
+                        device = geometry.devices.get(deviceType) or DeviceGeometry(deviceType, len(positions) // 2)
+                        offsets = device.offsets(banks, self.devicePairs(pairs, device.nPairs, warned))
+                        values = applyOperand(operand, [positions[k] for k in offsets])
+                        for k, value in zip(offsets, values):
+                            positions[k] = value
+                        bld.LeafJawPositions = positions
+                        edited += len(offsets)
+        return edited
+
+
+# Built in setters.
+registerSetter("mu", MUSetter())
+registerSetter("m",  MachineSetter())
+registerSetter("g",  ControlPointSetter("Gantry", "GantryAngle"))
+registerSetter("c",  ControlPointSetter("Collimator", "BeamLimitingDeviceAngle"))
+registerSetter("pa", PositionSetter("Position Absolute", "absolute"))
+registerSetter("pr", PositionSetter("Position Relative", "relative"))
@@ -0,0 +1,74 @@
+"""state.py: A dense view of a control point attribute, with inherited values filled in."""
+
+# Imports
+from pydicom.datadict import dictionary_VR
+
+from .setters import applyOperand
+
+"""
+Inherited Values
+----------------
+
+DICOM only requires the first control point of a beam to hold attributes such as GantryAngle and
+BeamLimitingDeviceAngle - later control points leave them out while they are unchanged, and inherit the
+value before. Editing only the control points that hold a value therefore edits the wrong control points,
+or none at all.
+
+ControlPointState reads a beam's values in one pass, filling in the inherited ones, so an edit applies to
+every selected control point. The edited values are written back sparsely:
+
+    - Control points that held a value are updated if it changed.
+    - Control points that inherited a value stay without one, unless their value now differs from the
+      control point before - for example the first control point after an edited range, which must
+      restore the original value.
+
+So editing every control point of a beam writes only the values that were already there, and files
+do not grow.
+
+"""
+
+
+class ControlPointState:
+    """The value of one attribute in every control point of a beam, inherited values included."""
+
+    def __init__(self, beam, tag):
+        self.tag = tag
+        self.cps = beam.ControlPointSequence
+        self.present = []
+        self.original = []
+
+        value = None
+        for cp in self.cps:
+            elem = cp.get(tag)
+            held = elem is not None and elem.value is not None and elem.value != ""
+            if held:
+                value = float(elem.value)
+            self.present.append(held)
+            self.original.append(value)
+        self.values = list(self.original)
+
+    def edit(self, cpIndices, operand):
+        """Apply an operand to the selected control points in a single pass. Control points before the first
+        value in the beam have nothing to edit, and are skipped."""
+        rows = [i for i in cpIndices if self.values[i] is not None]
+        for i, value in zip(rows, applyOperand(operand, [self.values[i] for i in rows])):
+            self.values[i] = value
+
+    def writeBack(self):
+        """Write the edited values back to the control points sparsely. Returns True if anything changed."""
+        changed = False
+        previous = None
+        for i, value in enumerate(self.values):
+            if value is None:
+                continue
+            if self.present[i]:
+                if value != self.original[i]:
+                    self.cps[i][self.tag].value = value
+                    changed = True
+            elif value != previous:
+                self.cps[i].add_new(self.tag, dictionary_VR(self.tag), value)
+                self.present[i] = True
+                changed = True
+            previous = value
+        self.original = list(self.values)
+        return changed
@@ -0,0 +1,205 @@
+"""sweep.py: Expands parameter sweeps in command strings, and generates the variants on a process pool."""
+
+# Imports
+import itertools
+import os
+import re
+from decimal import Decimal, InvalidOperation
+
+
+"""
+Parameter Sweeps
+----------------
+
+Any part of a command string may be replaced by a set of values in braces. Every combination of the
+values, across all of the command strings of a variant, becomes a variant of its own:
+
+    {-3,-2,-1,1,2,3}        A list of values.
+    {-5..5}                 A range, including both ends, in steps of 1.
+    {-5..5 step 0.5}        A range with a given step.
+
+So "b0 g=+{-5..5 step 0.5}" gives 21 variants, and "lb1 lp{10,20} pr={-1,1}" gives 4. When a value is
+substituted directly after a sign, the signs are combined - g=+{-5..5} gives g=-5 through g=+5.
+
+Each variant's output file name is derived from the values used, e.g. out.dcm becomes out_g-5.dcm.
+
+"""
+
+_SWEEP = re.compile(r"\{([^{}]*)\}")
+_RANGE = re.compile(r"\s*([+-]?[\d.]+)\s*\.\.\s*([+-]?[\d.]+)\s*(?:step\s+([+-]?[\d.]+)\s*)?\Z")
+
+
+def expandValues(text):
+    """Return the list of values described by the contents of a pair of braces."""
+    m = _RANGE.match(text)
+    if not m:
+        values = [v.strip() for v in text.split(",")]
+        if not all(values):
+            raise ValueError("Empty value in sweep '{" + text + "}'.")
+        return values
+
+    try:
+        first, last = Decimal(m.group(1)), Decimal(m.group(2))
+        step = Decimal(m.group(3)) if m.group(3) else Decimal(1)
+    except InvalidOperation:
+        raise ValueError("Invalid number in sweep '{" + text + "}'.")
+    if step <= 0:
+        raise ValueError("Sweep step must be positive in '{" + text + "}'.")
+    if last < first:
+        step = -step
+
+    # Decimal arithmetic keeps values such as 0.1 exact, so names and edits are not 0.30000000000000004.
+    values = []
+    value = first
+    while (value <= last) if step > 0 else (value >= last):
+        values.append(format(value.normalize(), "f"))
+        value += step
+    return values
+
+
+def _substitute(cmdStr, spans, values):
+    """Replace each sweep span in the command string with its value, combining any adjacent signs."""
+    parts = []
+    labels = []
+    end = 0
+    for (start, stop, key), value in zip(spans, values):
+        before = cmdStr[end:start]
+        if before and before[-1] in "+-" and value[:1] in "+-":
+            value = ("-" if (before[-1] == "-") != (value[0] == "-") else "+") + value[1:]
+            before = before[:-1]
+        parts += [before, value]
+        labels.append(key + value)
+        end = stop
+    parts.append(cmdStr[end:])
+    return "".join(parts), labels
+
+
+def _spans(cmdStr):
+    """Find the sweeps in a command string. Returns (start, stop, key) and the values of each."""
+    spans = []
+    values = []
+    for m in _SWEEP.finditer(cmdStr):
+        token = re.split(r"\s", cmdStr[:m.start()])[-1]
+        key = re.match("[a-z]*", token).group(0)
+        spans.append((m.start(), m.end(), key))
+        values.append(expandValues(m.group(1)))
+    return spans, values
+
+
+def expandSweep(commandStrings):
+    """Expand the sweeps in a list of command strings.
+
+    Returns a list of (label, commandStrings) tuples, one per combination of values. The label is empty if
+    there were no sweeps.
+    """
+    found = [_spans(cmdStr) for cmdStr in commandStrings]
+    allValues = [v for spans, values in found for v in values]
+
+    expanded = []
+    for combination in itertools.product(*allValues):
+        remaining = iter(combination)
+        cmdStrs = []
+        labels = []
+        for cmdStr, (spans, values) in zip(commandStrings, found):
+            text, used = _substitute(cmdStr, spans, [next(remaining) for _ in spans])
+            cmdStrs.append(text)
+            labels += used
+        expanded.append(("_".join(labels), cmdStrs))
+    return expanded
+
+
+def labelledName(outFile, label):
+    """Add a variant label to an output file name, e.g. out.dcm and g-5 gives out_g-5.dcm."""
+    if not label:
+        return outFile
+    root, ext = os.path.splitext(outFile)
+    return root + "_" + re.sub(r"[^\w.+-]", "", label.replace("%", "pct")) + ext
+
+
+def expandVariants(variants):
+    """Expand the sweeps of a list of (outFile, commandStrings) variants, naming each new variant."""
+    expanded = []
+    for outFile, commandStrings in variants:
+        for label, cmdStrs in expandSweep(commandStrings):
+            expanded.append((labelledName(outFile, label), cmdStrs))
+    return expanded
+
+
+"""
+Parallel Generation
+-------------------
+
+The variants are split into chunks, and each chunk is generated by a worker process which reads the plan
+once and then produces its variants from it by copy on write (see variants.py).
+
+"""
+
+
+def writeVariants(inFile, variants, keep_uid=False, verbose=False, patch=False, cache=None):
+    """Read inFile - a path or the bytes of a plan - once and write each of a list of (outFile, commandStrings)
+    variants of it. With patch, a patch against inFile is written in place of each plan (see patch.py). With
+    a cache.OutputCache, variants already in the cache are copied from it, and the plan is only read if some
+    are not."""
+    written = []
+    if cache is not None:
+        from .cache import cacheKey, fileHash
+        planHash = fileHash(inFile)[0]
+        missing = []
+        for outFile, cmds in variants:
+            key = cacheKey(planHash, cmds, keep_uid)
+            if cache.fetch(key, outFile):
+                written.append(outFile)
+            else:
+                missing.append((outFile, cmds, key))
+        if not missing:
+            return written
+
+    from .reader import readPlan
+    from .variants import mangleVariants
+    from .writer import writePlan
+
+    ds = readPlan(inFile)
+    if cache is not None:
+        from .cache import keyUID
+        from .variants import mangleVariant
+        for outFile, cmds, key in missing:
+            output = mangleVariant(ds, cmds, keep_uid, verbose, uid=None if keep_uid else keyUID(key))
+            writePlan(output, outFile)
+            cache.put(key, outFile)
+            written.append(outFile)
+        return written
+
+    outputs = mangleVariants(ds, [cmds for outFile, cmds in variants], keep_uid, verbose)
+    if not patch:
+        for (outFile, cmds), output in zip(variants, outputs):
+            writePlan(output, outFile)
+        return [outFile for outFile, cmds in variants]
+
+    from .patch import fileHash, makePatch, patchName, writePatch
+    baseHash = fileHash(inFile)
+    basePath = inFile if isinstance(inFile, str) else None
+    for (outFile, cmds), output in zip(variants, outputs):
+        writePatch(makePatch(ds, output, cmds, keep_uid, baseHash, basePath), patchName(outFile))
+    return [patchName(outFile) for outFile, cmds in variants]
+
+
+def runVariants(inFile, variants, keep_uid=False, verbose=False, jobs=None, patch=False, cache=None):
+    """Write each of a list of (outFile, commandStrings) variants of inFile, using up to jobs processes.
+
+    Yields the name of each output file as its chunk completes.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    jobs = min(jobs, len(variants))
+    if jobs <= 1:
+        yield from writeVariants(inFile, variants, keep_uid, verbose, patch, cache)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    # A few chunks per worker keeps them all busy until the end.
+    size = -(-len(variants) // (jobs * 4))
+    chunks = [variants[i:i + size] for i in range(0, len(variants), size)]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(writeVariants, inFile, chunk, keep_uid, verbose, patch, cache) for chunk in chunks]
+        for future in futures:
+            yield from future.result()
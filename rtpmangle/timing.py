@@ -0,0 +1,118 @@
+"""timing.py: Records where the time of a mangle goes, for mangle.py --profile."""
+
+# Imports
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+from .command import parse
+
+"""
+Profiling
+---------
+
+A Timings object is passed down through mangleDataset() (and mangleVariant() and LoadedPlan.mangle()), and
+times each phase of the run:
+
+    parse     - Compiling each command string.
+    cache     - Hashing the plan and looking for its output in the output cache, with mangle.py --cache.
+    read      - Reading the plan.
+    uid       - Generating the new SOP Instance UID.
+    commands  - For each command string: the time taken by the filters, by copying the parts of a variant it
+                edits, and by each setter, along with the number of beams and control points it selected,
+                and the number of leaf or jaw positions its setters edited.
+    write     - Writing the output file.
+
+Only a few timestamps and counts are taken per command, never per control point, so profiling barely slows
+the run it measures. report() returns the results as a dict, ready to be saved as JSON. When no Timings are
+given, NO_TIMINGS stands in, and records nothing.
+
+"""
+
+
+def ms(seconds):
+    return round(1000 * seconds, 3)
+
+
+class Timings:
+    """The times and counts of a single mangle."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.parsed = {}
+        self.commands = []
+
+    @contextmanager
+    def phase(self, name, record=None):
+        """Time the body of a with statement, adding it to the name entry of record (by default, the phases)."""
+        record = self.phases if record is None else record
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record[name] = record.get(name, 0) + ms(time.perf_counter() - start)
+
+    def parse(self, cmdStr):
+        """Compile a command string, timing it the first time it is seen."""
+        if cmdStr in self.parsed:
+            return parse(cmdStr)
+        start = time.perf_counter()
+        cmd = parse(cmdStr)
+        self.parsed[cmdStr] = ms(time.perf_counter() - start)
+        return cmd
+
+    def command(self, cmd):
+        """Start the record of a command as it is applied."""
+        record = {"command": cmd.text, "parse_ms": self.parsed.get(cmd.text, 0), "filter_ms": 0,
+                  "copy_ms": 0, "apply_ms": {}}
+        self.commands.append(record)
+        return record
+
+    def count(self, record, ds, cmd, selection):
+        """Record the number of beams and control points a command selected."""
+        record["beams"] = len(selection)
+        record["control_points"] = sum(len(cpIndices) for b, beam, cpIndices in selection)
+        record["positions"] = 0
+
+    def countPositions(self, record, positions):
+        """Add the number of leaf or jaw positions a setter edited, as returned by its apply(), to the record of
+        its command. Setters which do not edit positions return None."""
+        if positions:
+            record["positions"] += positions
+
+    def report(self):
+        """Return the timings as a dict."""
+        return {"total_ms": ms(time.perf_counter() - self.start), "phases": dict(self.phases),
+                "parse_ms": dict(self.parsed), "commands": self.commands}
+
+    def dump(self, path):
+        """Write the report as JSON to path, or to a text file object."""
+        if hasattr(path, "write"):
+            json.dump(self.report(), path, indent=2)
+            path.write("\n")
+            return
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+
+class NoTimings:
+    """Stands in for Timings when nothing is being profiled."""
+
+    def phase(self, name, record=None):
+        return nullcontext()
+
+    def parse(self, cmdStr):
+        return parse(cmdStr)
+
+    def command(self, cmd):
+        return None
+
+    def count(self, record, ds, cmd, selection):
+        pass
+
+    def countPositions(self, record, positions):
+        pass
+
+
+NO_TIMINGS = NoTimings()
@@ -0,0 +1,161 @@
+"""variants.py: Generates many mangled variants of a plan that has been read only once."""
+
+# Imports
+import copy
+import shlex
+
+from pydicom.dataelem import DataElement, RawDataElement
+from pydicom.sequence import Sequence
+
+from .command import SETTERS
+from .engine import mangleDataset
+from .index import planIndex
+from .timing import NO_TIMINGS
+
+"""
+Copy on Write
+-------------
+
+A variant starts as a copy of the plan's top level element containers, with every value shared with the
+base plan. Before each command runs, the parts of the plan its setters write to (see the setter scopes in
+setters.py) are copied:
+
+    fraction     - The fraction group sequence is copied.
+    beam         - The selected beams are copied, still sharing their control points.
+    controlpoint - The selected beams are copied, and the selected control points within them, including
+                   their beam limiting device positions. The control point after each selected run is
+                   copied too, as it may need to hold a value it used to inherit (see state.py).
+    plan         - Anything else - the whole plan is copied.
+
+Everything else remains shared, so the cost of a variant scales with the size of its edits rather than
+the size of the plan. The base plan is never modified.
+
+"""
+
+
+def shallowCopy(dataset):
+    """Copy a dataset's data elements, sharing their values with the original."""
+    copied = copy.copy(dataset)
+    copied._dict = {tag: copy.copy(elem) if isinstance(elem, DataElement) else elem
+                    for tag, elem in dataset._dict.items()}
+    return copied
+
+
+def copyControlPoint(cp):
+    """Copy a control point and its beam limiting device positions, sharing the values themselves."""
+    copied = shallowCopy(cp)
+    if "BeamLimitingDevicePositionSequence" in copied:
+        copied.BeamLimitingDevicePositionSequence = Sequence(
+            [shallowCopy(item) for item in copied.BeamLimitingDevicePositionSequence])
+    return copied
+
+
+class CopyOnWrite:
+    """A variant of a base plan which copies the beams and control points it edits on demand."""
+
+    def __init__(self, base):
+        # Decode the sequences and build the index once in the base plan, so variants share the result.
+        base.BeamSequence
+        base.get("FractionGroupSequence")
+        planIndex(base)
+
+        self.base = base
+        self.dataset = shallowCopy(base)
+        if getattr(base, "_modified", None) is not None:
+            # The record of edited elements is the variant's own (see writer.py).
+            self.dataset._modified = set(base._modified)
+        self._beams = None
+        self._copiedBeams = set()
+        self._copiedCps = {}
+        self._copiedFraction = False
+        self._copiedPlan = False
+
+    def beam(self, b):
+        """Return beam b of the variant, copying it first if necessary."""
+        if self._beams is None:
+            self._beams = Sequence(self.dataset.BeamSequence)
+            self.dataset.BeamSequence = self._beams
+        if b not in self._copiedBeams:
+            # Control points are decoded within the copy, leaving the base plan's still encoded.
+            beam = shallowCopy(self._beams[b])
+            beam.ControlPointSequence = Sequence(beam.ControlPointSequence)
+            self._beams[b] = beam
+            self._copiedBeams.add(b)
+            self._copiedCps[b] = set()
+        return self._beams[b]
+
+    def controlPoints(self, b, cpIndices):
+        """Copy the given control points of beam b."""
+        cpSequence = self.beam(b).ControlPointSequence
+        copied = self._copiedCps[b]
+        for i in cpIndices:
+            if i not in copied:
+                cpSequence[i] = copyControlPoint(cpSequence[i])
+                copied.add(i)
+
+    def fraction(self):
+        """Copy the fraction group sequence."""
+        if not self._copiedFraction:
+            self.dataset.FractionGroupSequence = copy.deepcopy(self.dataset.FractionGroupSequence)
+            self._copiedFraction = True
+
+    def prepare(self, cmd, selection):
+        """Copy what the command's setters will write to, returning the selection within the variant."""
+        if self._copiedPlan:
+            return selection
+
+        scopes = set(SETTERS[s.key].scope for s in cmd.setters)
+        if "plan" in scopes:
+            # Nothing is known about this setter - copy everything. Encoded elements, which may be views of a
+            # memory mapped file, cannot be edited, so are shared.
+            memo = {id(elem): elem for elem in self.dataset._dict.values() if isinstance(elem, RawDataElement)}
+            self.dataset._dict = copy.deepcopy(self.dataset._dict, memo)
+            self._copiedPlan = True
+            return [(b, self.dataset.BeamSequence[b], cpIndices) for b, beam, cpIndices in selection]
+
+        if "fraction" in scopes:
+            self.fraction()
+        if "controlpoint" in scopes:
+            nCps = planIndex(self.dataset).nCps
+            for b, beam, cpIndices in selection:
+                selected = set(cpIndices)
+                following = [i + 1 for i in cpIndices if i + 1 not in selected and i + 1 < nCps[b]]
+                self.controlPoints(b, list(cpIndices) + following)
+        if "beam" in scopes or "controlpoint" in scopes:
+            selection = [(b, self.beam(b), cpIndices) for b, beam, cpIndices in selection]
+        return selection
+
+
+def mangleVariant(base, commandStrings, keep_uid=False, verbose=False, timings=NO_TIMINGS, uid=None):
+    """Return a mangled variant of base, which is left unchanged."""
+    variant = CopyOnWrite(base)
+    mangleDataset(variant.dataset, commandStrings, keep_uid, verbose, prepare=variant.prepare, timings=timings,
+                  uid=uid)
+    return variant.dataset
+
+
+def mangleVariants(base, variantCommands, keep_uid=False, verbose=False):
+    """Yield a mangled variant of base for each list of command strings in variantCommands."""
+    for commandStrings in variantCommands:
+        yield mangleVariant(base, commandStrings, keep_uid, verbose)
+
+
+def readVariantFile(path):
+    """Read a variants file - one variant per line, giving the output file then its command strings.
+
+    For example:
+        gantry_plus5.dcm "g=+5"
+        mlc_stuck.dcm "lb1 lp6 pa=-40" "b0 mu=+2%"
+
+    Blank lines and lines starting with # are ignored. Returns a list of (outFile, commandStrings) tuples.
+    """
+    variants = []
+    with open(path) as f:
+        for lineNumber, line in enumerate(f, 1):
+            if not line.strip() or line.lstrip().startswith("#"):
+                continue
+            fields = shlex.split(line)
+            if len(fields) < 2:
+                raise ValueError(path + ", line " + str(lineNumber) + ": expected an output file and at least one command string.")
+            variants.append((fields[0], fields[1:]))
+    return variants
@@ -0,0 +1,170 @@
+"""writer.py: Writes mangled plans to files, file objects or bytes."""
+
+# Imports
+import os
+import tempfile
+from copy import deepcopy
+from io import BytesIO
+
+from pydicom.charset import default_encoding
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_data_element, write_file_meta_info
+from pydicom.tag import Tag
+
+"""
+Delta Writing
+-------------
+
+ds.save_as() encodes every decoded element again, even when a command only changed one beam's meterset.
+Plans read by readPlan() keep the original bytes of their top level elements (see reader.py), so writePlan()
+instead copies each element that has not changed, byte for byte, and only encodes the ones that have.
+Vendor private data is copied unchanged, whatever its length or encoding.
+
+Only elements which are still the undecoded RawDataElement read from the file are copied. Any element which
+has been decoded - the beam and fraction group sequences always are, as readPlan() decodes them straight away
+- or replaced, or whose tag has been marked with markModified(), is encoded again. A decoded value may have
+been edited in place, by mangleDataset() or by anything else holding the dataset, and comparing it with the
+original would cost as much as encoding it, so it is never assumed to be unchanged.
+
+Elements copied from a memory mapped file are read from the map as they are written. Truncating the file
+would take those bytes away, so a mapped plan written over its own file is written to a temporary file
+which then replaces it. If the file has been rewritten in place by anything else since it was mapped, the
+plan is not written at all - reading the map could crash the process - and ValueError is raised instead.
+Replacing the file, or deleting it, leaves the map as it was, so is fine.
+
+The whole plan is written with save_as() instead if it was not read by readPlan(), if its transfer syntax or
+character set has changed, or if markModified() was called without any tags.
+
+"""
+
+
+def markModified(ds, tags=None):
+    """Record that top level elements of a plan have been edited in place, so writePlan() encodes them again.
+    Tags may be keywords. With no tags, the whole plan will be encoded again."""
+    modified = getattr(ds, "_modified", None)
+    if tags is None:
+        ds._modified = None
+    elif modified is not None:
+        modified.update(Tag(tag) for tag in tags)
+
+
+def canWriteDelta(ds):
+    """Return True if the plan still has the source and encoding it was read with, so may be written by delta."""
+    if getattr(ds, "_source", None) is None or getattr(ds, "_modified", None) is None:
+        return False
+    implicit, little = ds.original_encoding
+    syntax = ds.file_meta.get("TransferSyntaxUID")
+    return (syntax is not None and (syntax.is_implicit_VR, syntax.is_little_endian) == (implicit, little)
+            and (ds.is_implicit_VR, ds.is_little_endian) == (implicit, little)
+            and ds.original_character_set == ds._character_set)
+
+
+def deltaChunks(ds):
+    """Yield the bytes of the plan's file in order - the original bytes of unchanged elements, and the new
+    encoding of the rest."""
+    preamble = getattr(ds, "preamble", None)
+    if preamble and len(preamble) != 128:
+        raise ValueError("The preamble must be 128 bytes long.")
+
+    implicit, little = ds.original_encoding
+    buffer = DicomBytesIO()
+    buffer.is_implicit_VR, buffer.is_little_endian = implicit, little
+    if preamble:
+        buffer.write(preamble + b"DICM")
+    if ds.file_meta:
+        write_file_meta_info(buffer, deepcopy(ds.file_meta), enforce_standard=False)
+
+    source = ds._source
+    modified = ds._modified
+    encodings = ds.get("SpecificCharacterSet", default_encoding)
+
+    for tag in sorted(ds.keys()):
+        # As with save_as(), retired group lengths are left out.
+        if tag.element == 0 and tag.group > 6:
+            continue
+        elem = ds.get_item(tag)
+        original = source.get(tag)
+        unchanged = original is not None and tag not in modified and elem is original[0]
+        if unchanged:
+            if buffer.tell():
+                yield buffer.getvalue()
+                buffer = DicomBytesIO()
+                buffer.is_implicit_VR, buffer.is_little_endian = implicit, little
+            raw, header, trailer = original
+            yield header
+            yield raw.value
+            yield trailer
+        else:
+            write_data_element(buffer, elem, encodings)
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def checkMap(ds):
+    """Raise ValueError if the memory mapped file a plan was read from has since been rewritten in place."""
+    mapStat = getattr(ds, "_mapStat", None)
+    if mapStat is None:
+        return
+    try:
+        info = os.stat(ds.filename)
+    except OSError:
+        # The file has been deleted or moved - the map keeps the original.
+        return
+    if (info.st_dev, info.st_ino) == mapStat[:2] and (info.st_size, info.st_mtime_ns) != mapStat[2:]:
+        raise ValueError(ds.filename + " has been changed since the plan was read from it - read it again.")
+
+
+def overwritesMap(ds, destination):
+    """Return True if the path destination is the memory mapped file a plan was read from."""
+    if not getattr(ds, "_mapped", False) or not isinstance(ds.filename, str):
+        return False
+    try:
+        return os.path.samefile(destination, ds.filename)
+    except OSError:
+        return False
+
+
+def writePlan(ds, destination, delta=True):
+    """Write a plan to a path, or to a binary file object such as sys.stdout.buffer or a BytesIO.
+
+    Unless delta is False, elements which have not changed since the plan was read are copied from the
+    original file rather than encoded again. Raises ValueError if the plan was memory mapped from a file which
+    has since been rewritten in place.
+    """
+    checkMap(ds)
+    if not hasattr(destination, "write") and overwritesMap(ds, destination):
+        directory = os.path.dirname(os.path.abspath(destination))
+        fd, temp = tempfile.mkstemp(suffix=".dcm", dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                writePlan(ds, f, delta)
+            os.chmod(temp, os.stat(destination).st_mode & 0o7777)
+            os.replace(temp, destination)
+        except BaseException:
+            os.unlink(temp)
+            raise
+        return
+
+    if delta and canWriteDelta(ds):
+        if hasattr(destination, "write"):
+            for chunk in deltaChunks(ds):
+                destination.write(chunk)
+        else:
+            with open(destination, "wb") as f:
+                for chunk in deltaChunks(ds):
+                    f.write(chunk)
+        return
+
+    if hasattr(destination, "write") and not destination.seekable():
+        # pydicom seeks back while writing, which pipes and sockets cannot do - write through a buffer.
+        destination.write(planBytes(ds, delta))
+        return
+    ds.save_as(destination)
+
+
+def planBytes(ds, delta=True):
+    """Return the bytes of a plan's DICOM file, without writing it anywhere."""
+    buffer = BytesIO()
+    writePlan(ds, buffer, delta)
+    return buffer.getvalue()
@@ -0,0 +1,38 @@
+"""conftest.py: Synthetic plans and helpers shared by the tests."""
+
+# Imports
+import contextlib
+import importlib.util
+import io
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, ROOT)
+
+
+def _synthetic():
+    # benchmarks/ holds scripts rather than a package, so the generator is loaded from its path.
+    spec = importlib.util.spec_from_file_location("synthetic", os.path.join(ROOT, "benchmarks", "synthetic.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+synthetic = _synthetic()
+
+
+def quietly(function, *args, **kwargs):
+    """Call function, hiding the warnings printed for commands which select nothing in a small plan."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function(*args, **kwargs)
+
+
+@pytest.fixture(scope="session")
+def plans(tmp_path_factory):
+    """The path of a plan written for each synthetic preset, by preset name."""
+    directory = tmp_path_factory.mktemp("plans")
+    return {preset: synthetic.writeSynthetic(str(directory / (preset + ".dcm")), preset)
+            for preset in synthetic.PRESETS}
@@ -0,0 +1,80 @@
+"""test_batch.py: Checks a library of plans is found, mangled into a mirrored tree, and bad plans reported."""
+
+# Imports
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT, quietly
+from rtpmangle import mangleVariant, planBytes, readPlan
+from rtpmangle.batch import findPlans, outputVariants, runBatch
+
+
+@pytest.fixture
+def library(plans, tmp_path):
+    """A directory of plans, one of them in a subdirectory and one of them broken."""
+    root = tmp_path / "library"
+    (root / "site2").mkdir(parents=True)
+    shutil.copy(plans["imrt"], str(root / "a.dcm"))
+    shutil.copy(plans["implicit"], str(root / "site2" / "b.dcm"))
+    (root / "site2" / "broken.dcm").write_bytes(b"not a plan")
+    (root / "notes.txt").write_text("not a plan either")
+    return root
+
+
+def test_find_plans(library):
+    plans, root = findPlans(str(library))
+    assert [os.path.relpath(p, str(library)) for p in plans] == ["a.dcm", os.path.join("site2", "b.dcm"),
+                                                                  os.path.join("site2", "broken.dcm")]
+    assert root == str(library)
+
+    plans, root = findPlans(str(library / "**" / "b.dcm"))
+    assert plans == [str(library / "site2" / "b.dcm")] and root == str(library / "site2")
+    assert findPlans(str(library / "*.missing")) == ([], "")
+
+
+def test_output_variants(library, tmp_path):
+    variants = outputVariants(str(library / "site2" / "b.dcm"), str(library), str(tmp_path / "out"), ["g=+{1,2}"])
+    assert variants == [(str(tmp_path / "out" / "site2" / "b_g1.dcm"), ["g=+1"]),
+                        (str(tmp_path / "out" / "site2" / "b_g2.dcm"), ["g=+2"])]
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_run_batch(library, tmp_path, jobs):
+    plans, root = findPlans(str(library))
+    outDir = str(tmp_path / "out")
+    results = {plan: (outFiles, error)
+               for plan, outFiles, seconds, error in quietly(lambda: list(
+                   runBatch(plans, root, outDir, ["c=-5", "b1 mu=+2%"], keep_uid=True, jobs=jobs)))}
+
+    outFiles, error = results[str(library / "site2" / "broken.dcm")]
+    assert outFiles == [] and error
+    for name in ["a.dcm", os.path.join("site2", "b.dcm")]:
+        outFiles, error = results[str(library / name)]
+        assert error is None and outFiles == [os.path.join(outDir, name)]
+        with open(outFiles[0], "rb") as f:
+            expected = quietly(mangleVariant, readPlan(str(library / name)), ["c=-5", "b1 mu=+2%"], keep_uid=True)
+            assert f.read() == planBytes(expected)
+
+
+def test_batch_script(library, tmp_path):
+    summary = str(tmp_path / "summary.json")
+    result = subprocess.run([sys.executable, os.path.join(ROOT, "mangleBatch.py"), str(library), "-o",
+                             str(tmp_path / "out"), "-s", summary, "-j", "1", "b0 g=+5"],
+                            capture_output=True, text=True)
+    # The broken plan fails the batch, without stopping the others.
+    assert result.returncode == 1
+    assert "2 succeeded, 1 failed" in result.stdout
+    with open(summary) as f:
+        assert json.load(f)["failed"] == 1
+    assert (tmp_path / "out" / "site2" / "b.dcm").exists()
+
+    # Mistakes in the command strings are reported before any plan is read.
+    result = subprocess.run([sys.executable, os.path.join(ROOT, "mangleBatch.py"), str(library), "-o",
+                             str(tmp_path / "bad"), "q=+5"], capture_output=True, text=True)
+    assert result.returncode == 2 and "error" in result.stderr
+    assert not (tmp_path / "bad").exists()
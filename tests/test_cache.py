@@ -0,0 +1,65 @@
+"""test_cache.py: Checks outputs are cached by plan and normalised commands, reused, and evicted by age."""
+
+# Imports
+import os
+import subprocess
+import sys
+
+import pydicom
+
+from conftest import ROOT
+from rtpmangle.cache import OutputCache, cacheKey, fileHash
+
+MANGLE = os.path.join(ROOT, "mangle.py")
+
+
+def mangle(arguments):
+    result = subprocess.run([sys.executable, MANGLE] + arguments, capture_output=True, text=True, cwd=ROOT)
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+
+def test_keys_are_normalised(plans):
+    planHash = fileHash(plans["imrt"])[0]
+    assert cacheKey(planHash, ["b0  mu=+10.0"]) == cacheKey(planHash, ["b0 mu=+10"])
+    assert cacheKey(planHash, ["mu=123.4567"]) != cacheKey(planHash, ["mu=123.4571"])
+    assert cacheKey(planHash, ["b0 mu=+10"]) != cacheKey(planHash, ["b0 mu=+10"], keep_uid=True)
+    assert cacheKey(planHash, ["b0 mu=+10"]) != cacheKey(fileHash(plans["vmat"])[0], ["b0 mu=+10"])
+
+
+def test_file_hash(plans):
+    with open(plans["imrt"], "rb") as f:
+        data = f.read()
+    assert fileHash(plans["imrt"]) == fileHash(data) == (fileHash(data)[0], len(data))
+
+
+def test_outputs_are_reused(plans, tmp_path):
+    cacheDir = str(tmp_path / "cache")
+    first, second = str(tmp_path / "first.dcm"), str(tmp_path / "second.dcm")
+    assert "from the cache" not in mangle([plans["imrt"], "-o", first, "--cache", cacheDir, "b0 mu=+10"])
+    assert "from the cache" in mangle([plans["imrt"], "-o", second, "--cache", cacheDir, "b0  mu=+10.0"])
+
+    with open(first, "rb") as f, open(second, "rb") as g:
+        assert f.read() == g.read()
+    # The new UID comes from the key, so the output is the same with or without the cache.
+    third = str(tmp_path / "third.dcm")
+    mangle([plans["imrt"], "-o", third, "--cache", str(tmp_path / "other"), "b0 mu=+10"])
+    assert pydicom.dcmread(third).SOPInstanceUID == pydicom.dcmread(first).SOPInstanceUID
+    assert pydicom.dcmread(first).SOPInstanceUID != pydicom.dcmread(plans["imrt"]).SOPInstanceUID
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    cache = OutputCache(str(tmp_path / "cache"), 250)
+    for i, key in enumerate(["a", "b", "c"]):
+        cache.put(key, bytes([i]) * 100)
+        os.utime(cache.path(key), ns=(i * 10 ** 9, i * 10 ** 9))
+    assert sorted(os.path.basename(path) for path, used, size in cache.entries()) == ["b.dcm", "c.dcm"]
+
+    # Fetching an output marks it as used.
+    destination = str(tmp_path / "b.dcm")
+    assert cache.fetch("b", destination)
+    cache.put("d", b"\3" * 100)
+    assert sorted(os.path.basename(path) for path, used, size in cache.entries()) == ["b.dcm", "d.dcm"]
+    with open(destination, "rb") as f:
+        assert f.read() == b"\1" * 100
+    assert not cache.fetch("a", destination)
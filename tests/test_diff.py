@@ -0,0 +1,86 @@
+"""test_diff.py: Checks plans are compared beam by beam and control point by control point."""
+
+# Imports
+import json
+import os
+import subprocess
+import sys
+
+import pydicom
+import pytest
+
+from conftest import ROOT, quietly
+from rtpmangle import mangleVariant, readPlan, writePlan
+from rtpmangle.diff import diffPlans, formatDiff, planArrays
+
+MANGLE_DIFF = os.path.join(ROOT, "mangleDiff.py")
+
+
+def variant(path, commands):
+    return quietly(mangleVariant, readPlan(path), commands, True)
+
+
+@pytest.mark.parametrize("preset", ["imrt", "vmat", "degenerate"])
+def test_identical_plans(plans, preset):
+    report = diffPlans(readPlan(plans[preset]), readPlan(plans[preset]))
+    assert report["identical"]
+    assert report["beams"] == [] and report["addedBeams"] == [] and report["removedBeams"] == []
+    assert formatDiff(report) == ["No differences."]
+
+
+def test_edits_are_found(plans):
+    report = diffPlans(readPlan(plans["vmat"]), variant(plans["vmat"], ["b0 mu=+10", "b0 g=+5", "b0 lb1 lp6 pa=-40"]))
+    assert not report["identical"]
+    assert [beam["beam"] for beam in report["beams"]] == [0]
+
+    beam = report["beams"][0]
+    assert beam["meterset"]["b"][0] == pytest.approx(beam["meterset"]["a"][0] + 10)
+    gantry = beam["attributes"]["GantryAngle"]
+    assert gantry["controlPoints"] == 178 and gantry["max"] == pytest.approx(5)
+    assert list(beam["devices"]) == ["MLCX"]
+    assert beam["devices"]["MLCX"]["pairs"] == [6]
+    assert all(cp["GantryAngle"] == pytest.approx(5) for cp in beam["controlPoints"])
+
+
+def test_angles_are_compared_the_short_way_round(plans):
+    base = readPlan(plans["vmat"])
+    edited = readPlan(plans["vmat"])
+    edited.BeamSequence[0].ControlPointSequence[0].GantryAngle = \
+        (float(base.BeamSequence[0].ControlPointSequence[0].GantryAngle) + 358) % 360
+    gantry = diffPlans(base, edited)["beams"][0]["attributes"]["GantryAngle"]
+    assert gantry["max"] == pytest.approx(2)
+
+
+def test_tolerance(plans):
+    base = readPlan(plans["vmat"])
+    edited = variant(plans["vmat"], ["b0 g=+0.001"])
+    assert not diffPlans(base, edited)["identical"]
+    assert diffPlans(base, edited, tolerance=0.01)["identical"]
+
+
+def test_encoded_and_decoded_plans_agree(plans):
+    edited = variant(plans["imrt"], ["b1 mu=+2%", "lb1 lp6 pa=-40"])
+    encoded = diffPlans(readPlan(plans["imrt"]), edited)
+    decoded = diffPlans(pydicom.dcmread(plans["imrt"]), edited, arraysB=planArrays(edited))
+    assert encoded["beams"] == decoded["beams"]
+    assert not encoded["identical"]
+
+
+def test_script(plans, tmp_path):
+    same = str(tmp_path / "same.dcm")
+    changed = str(tmp_path / "changed.dcm")
+    writePlan(readPlan(plans["vmat"]), same)
+    writePlan(variant(plans["vmat"], ["b0 g=+5"]), changed)
+    report = str(tmp_path / "diff.json")
+
+    result = subprocess.run([sys.executable, MANGLE_DIFF, plans["vmat"], same], capture_output=True, cwd=ROOT)
+    assert result.returncode == 0
+    assert result.stdout.decode().startswith("SAME")
+
+    result = subprocess.run([sys.executable, MANGLE_DIFF, plans["vmat"], same, changed, "--json", report],
+                            capture_output=True, cwd=ROOT)
+    assert result.returncode == 1
+    assert "1 of 2 plan(s) differ" in result.stdout.decode()
+    with open(report) as f:
+        variants = json.load(f)["variants"]
+    assert variants[same]["identical"] and not variants[changed]["identical"]
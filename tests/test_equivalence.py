@@ -0,0 +1,187 @@
+"""test_equivalence.py: Checks the mangler's output against the original script, and its fast paths against
+the slow ones, on every synthetic plan preset."""
+
+# Imports
+import io
+import os
+import subprocess
+import sys
+
+import pydicom
+import pytest
+
+from conftest import quietly, synthetic
+from rtpmangle import mangleDataset, mangleVariant, planBytes, readPlan
+from rtpmangle.cache import fileHash
+from rtpmangle.command import coalesce, parse
+from rtpmangle.patch import makePatch, materialize, readPatch, writePatch
+
+"""
+Equivalence Checks
+------------------
+
+Each synthetic plan preset (see benchmarks/synthetic.py) is mangled, and the result checked four ways:
+
+    baseline  - Against baseline_mangle.py, the original single file script, run on the same plan. Plans are
+                compared decoded, element by element, so the many ways of encoding the same value do not
+                matter. The only differences allowed are the intended ones: the original script skipped
+                control points which inherit their gantry angle from an earlier one, where the mangler edits
+                them too (see state.py).
+    delta     - Writing only the edited elements, and copying the rest from the input file, gives the same
+                bytes as writing the whole plan again with pydicom.
+    patch     - A patch, saved and materialized against its base plan, gives the same bytes as the variant.
+    coalesce  - Merging consecutive command strings gives the same plan as applying them one at a time. Plans
+                are compared as delivered, inherited values filled in (see diff.py): applying "cp0-1 c=+1"
+                then "cp0-1 c=-1" one at a time leaves control point 2 holding the collimator angle it
+                inherited, where the merged pass edits nothing.
+
+"""
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline_mangle.py")
+SOP_INSTANCE_UID = 0x00080018
+
+# Command strings the original script understands, for plans with a second beam, and with an MLC.
+COMMANDS = ["b0 mu=+10", "j0 jb1 pr=+2", "m='Linac 2'", "c=-5", "cp0 j1 pa=7"]
+BEAM_COMMANDS = ["b1 cp1-3 g=+5"]
+MLC_COMMANDS = ["lb1 lp6 pa=-40", "lb0 lp2-4 pr=-10%"]
+
+# Scripts of consecutive command strings which are merged before they are applied.
+SCRIPTS = [
+    ["b0 g=+5", "b0 g=+5", "b0 c=+1", "b0 g=-10", "b0 mu=+2%", "b0 mu=+3"],
+    ["j0 jb1 pr=+2", "j0 jb1 pr=+2", "jb1 j0 pa=7", "m='A'", "m='B'", "cp0-1 c=+1", "cp0-1 c=-1"],
+    ["ga90-180 g=+5", "ga90-180 g=+5", "cp1-3 g=+5", "cp1-3 g=-5"],
+    ["lb1 lp6-20 pr=+1", "lb1 lp6-20 pr=+0.5", "lp6-20 lb1 pr=-10%", "lb1 lp6-20 pa=3", "lb1 lp6-20 pr=+2"],
+]
+
+
+def commandsFor(preset):
+    shape = synthetic.PRESETS[preset]
+    return COMMANDS + (BEAM_COMMANDS if shape["beams"] > 1 else []) + (MLC_COMMANDS if shape["pairs"] else [])
+
+
+def differences(a, b, path=""):
+    """List the elements of two decoded datasets whose values differ, or which only one of them holds, ignoring
+    the SOP Instance UID."""
+    found = []
+    for tag in sorted(set(a.keys()) | set(b.keys())):
+        if tag == SOP_INSTANCE_UID:
+            continue
+        if tag not in b:
+            found.append(path + a[tag].keyword + " missing")
+            continue
+        if tag not in a:
+            found.append(path + b[tag].keyword + " added")
+            continue
+        elem, other = a[tag], b[tag]
+        if elem.VR == "SQ":
+            if len(elem.value) != len(other.value):
+                found.append(path + elem.keyword + " length")
+            for i, (item, otherItem) in enumerate(zip(elem.value, other.value)):
+                found += differences(item, otherItem, path + elem.keyword + "[" + str(i) + "].")
+        elif not sameValue(elem.value, other.value):
+            found.append(path + elem.keyword)
+    return found
+
+
+def sameValue(a, b):
+    if isinstance(a, (list, pydicom.multival.MultiValue)):
+        return len(a) == len(b) and all(sameValue(x, y) for x, y in zip(a, b))
+    try:
+        return abs(float(a) - float(b)) <= 1e-6
+    except (TypeError, ValueError):
+        return str(a) == str(b)
+
+
+def inheritedEdits(path, commands):
+    """The gantry angles the mangler adds where the original script skipped control points inheriting theirs.
+
+    "b1 cp1-3 g=+5" shifts control points 1 to 3 of beam 1 whether or not they hold their own angle. A control
+    point without its own angle is given one wherever its shifted angle differs from the one it would inherit.
+    """
+    if "b1 cp1-3 g=+5" not in commands:
+        return []
+    beam = pydicom.dcmread(path).BeamSequence[1]
+    cps, angles = beam.ControlPointSequence, shiftedAngles(beam)
+    return ["BeamSequence[1].ControlPointSequence[" + str(i) + "].GantryAngle added" for i in range(1, len(cps))
+            if "GantryAngle" not in cps[i] and angles[i] != angles[i - 1]]
+
+
+def gantryAngles(beam):
+    """The gantry angle of each control point of a beam, filling in inherited ones."""
+    angles = []
+    for cp in beam.ControlPointSequence:
+        angles.append(float(cp.GantryAngle) if "GantryAngle" in cp else angles[-1])
+    return angles
+
+
+def shiftedAngles(beam):
+    """The gantry angles of a beam once "cp1-3 g=+5" has been applied to it."""
+    return [angle + 5 if 1 <= i <= 3 else angle for i, angle in enumerate(gantryAngles(beam))]
+
+
+@pytest.mark.parametrize("preset", sorted(synthetic.PRESETS))
+def test_baseline(plans, preset, tmp_path):
+    commands = commandsFor(preset)
+    reference = str(tmp_path / "reference.dcm")
+    subprocess.run([sys.executable, BASELINE, "-k", plans[preset], "-o", reference] + commands,
+                   check=True, stdout=subprocess.DEVNULL)
+    output = quietly(mangleVariant, readPlan(plans[preset]), commands, keep_uid=True)
+
+    found = differences(pydicom.dcmread(reference), pydicom.dcmread(io.BytesIO(planBytes(output))))
+    assert found == inheritedEdits(plans[preset], commands)
+
+
+def test_baseline_differences_are_found(plans):
+    # The sparse IMRT plan inherits gantry angles, so the original script leaves some of them alone.
+    assert inheritedEdits(plans["imrt"], BEAM_COMMANDS) != []
+
+
+@pytest.mark.parametrize("preset", sorted(p for p in synthetic.PRESETS if synthetic.PRESETS[p]["beams"] > 1))
+def test_inherited_angles(plans, preset):
+    base = readPlan(plans[preset])
+    expected = [shiftedAngles(beam) if b == 1 else gantryAngles(beam) for b, beam in enumerate(base.BeamSequence)]
+
+    output = pydicom.dcmread(io.BytesIO(planBytes(quietly(mangleVariant, base, BEAM_COMMANDS))))
+    for beam, angles in zip(output.BeamSequence, expected):
+        assert gantryAngles(beam) == pytest.approx(angles)
+
+
+@pytest.mark.parametrize("preset", sorted(synthetic.PRESETS))
+@pytest.mark.parametrize("variant", [False, True])
+def test_delta_write(plans, preset, variant):
+    ds = readPlan(plans[preset])
+    if variant:
+        ds = quietly(mangleVariant, ds, commandsFor(preset))
+    else:
+        quietly(mangleDataset, ds, commandsFor(preset))
+
+    assert planBytes(ds) == planBytes(ds, delta=False)
+
+
+@pytest.mark.parametrize("preset", sorted(synthetic.PRESETS))
+def test_patch_round_trip(plans, preset, tmp_path):
+    commands = commandsFor(preset)
+    base = readPlan(plans[preset])
+    variant = quietly(mangleVariant, base, commands)
+    patchFile = str(tmp_path / "variant.rtpatch")
+    writePatch(makePatch(base, variant, commands, False, fileHash(plans[preset]), plans[preset]), patchFile)
+
+    patch = readPatch(patchFile)
+    assert patch["commands"] == commands
+    assert planBytes(materialize(patch)) == planBytes(variant)
+
+
+@pytest.mark.parametrize("preset", sorted(synthetic.PRESETS))
+@pytest.mark.parametrize("script", SCRIPTS, ids=["beam", "jaws", "ranges", "leaves"])
+def test_coalesce(plans, preset, script):
+    if "lb" in script[0] and synthetic.PRESETS[preset]["pairs"] == 0:
+        pytest.skip("the plan has no MLC")
+    diffPlans = pytest.importorskip("rtpmangle.diff").diffPlans
+    assert len(coalesce([parse(c) for c in script])) < len(script)
+
+    merged = quietly(mangleDataset, readPlan(plans[preset]), script, keep_uid=True)
+    sequential = readPlan(plans[preset])
+    for cmdStr in script:
+        quietly(mangleDataset, sequential, [cmdStr], keep_uid=True)
+
+    assert diffPlans(merged, sequential, tolerance=0)["identical"]
@@ -0,0 +1,140 @@
+"""test_jobs.py: Checks the background job queue runs, orders and cancels mangles."""
+
+# Imports
+import threading
+import time
+
+import pytest
+
+from rtpmangle import JobQueue, LoadedPlan
+from rtpmangle.command import CommandError
+
+
+@pytest.fixture
+def jobs():
+    queue = JobQueue(workers=2)
+    yield queue
+    queue.shutdown()
+
+
+def wait(job, timeout=10):
+    deadline = time.perf_counter() + timeout
+    while not job.isFinished:
+        assert time.perf_counter() < deadline, "job " + job.description + " did not finish"
+        time.sleep(0.005)
+
+
+def blocking(event):
+    """A job which runs until event is set."""
+    def run(timings):
+        assert event.wait(10)
+    return run
+
+
+def test_waiting_jobs_do_not_hold_up_workers(jobs):
+    # Three jobs on a busy plan, with two workers, must not keep a job on another plan waiting.
+    release = threading.Event()
+    busy = [jobs.submit("a" + str(i), blocking(release), key="a") for i in range(3)]
+    other = jobs.submit("b", lambda timings: None, key="b")
+
+    wait(other, timeout=2)
+    assert not busy[0].isFinished
+    assert [job.stage for job in busy[1:]] == ["queued", "queued"]
+    release.set()
+    for job in busy:
+        wait(job)
+    assert [job.stage for job in busy] == ["done"] * 3
+
+
+def test_jobs_on_a_key_run_in_order(jobs):
+    order = []
+    lock = threading.Lock()
+
+    def record(i):
+        def run(timings):
+            with lock:
+                order.append(i)
+            time.sleep(0.01)
+        return run
+
+    submitted = [jobs.submit(str(i), record(i), key="plan") for i in range(6)]
+    for job in submitted:
+        wait(job)
+    assert order == list(range(6))
+    # Keys are let go of once their jobs are done.
+    assert jobs._waiting == {}
+
+
+def test_unhashable_keys_are_refused(jobs):
+    with pytest.raises(TypeError, match="hashable"):
+        jobs.submit("list", lambda timings: None, key=["plan.dcm"])
+    assert jobs.jobs == []
+
+
+def test_invalid_commands_are_refused(jobs):
+    with pytest.raises(CommandError):
+        jobs.submit("bad", lambda timings: None, ["q=+5"], key="plan")
+    assert jobs.jobs == []
+
+
+def test_cancel_waiting_job(jobs):
+    release = threading.Event()
+    first = jobs.submit("first", blocking(release), key="plan")
+    waiting = jobs.submit("waiting", lambda timings: pytest.fail("a cancelled job ran"), key="plan")
+    last = jobs.submit("last", lambda timings: None, key="plan")
+
+    waiting.cancel()
+    assert waiting.stage == "cancelled"
+    release.set()
+    wait(first)
+    wait(last)
+    assert (first.stage, last.stage) == ("done", "done")
+
+
+def test_cancel_running_job(plans, tmp_path, jobs):
+    plan = LoadedPlan(plans["vmat"])
+    started = threading.Event()
+    release = threading.Event()
+
+    def run(timings):
+        started.set()
+        release.wait(10)
+        plan.mangle(str(tmp_path / "out.dcm"), ["g=+5"], timings=timings)
+
+    job = jobs.submit("out.dcm", run, ["g=+5"], plan)
+    assert started.wait(10)
+    job.cancel()
+    release.set()
+    wait(job)
+    assert job.stage == "cancelled"
+    assert not (tmp_path / "out.dcm").exists()
+
+
+def test_failed_job_frees_its_key(jobs):
+    def fail(timings):
+        raise ValueError("broken plan")
+
+    failed = jobs.submit("failed", fail, key="plan")
+    after = jobs.submit("after", lambda timings: None, key="plan")
+    wait(failed)
+    wait(after)
+    assert failed.stage == "failed" and str(failed.error) == "broken plan"
+    assert after.stage == "done"
+
+
+def test_progress_of_a_mangle(plans, tmp_path, jobs):
+    plan = LoadedPlan(plans["vmat"])
+    updates = []
+    jobs.notify = lambda job: updates.append((job.stage, job.applied))
+    commands = ["b0 g=+5", "b0 g=+5", "b1 mu=+2%"]
+    job = jobs.submit("out.dcm", lambda timings: plan.mangle(str(tmp_path / "out.dcm"), commands, timings=timings),
+                      commands, plan)
+    wait(job)
+
+    assert job.total == 2
+    assert (job.stage, job.applied, job.progress()) == ("done", 2, 1.0)
+    stages = [stage for stage, applied in updates]
+    assert stages[0] == "queued" and stages[-1] == "done"
+    assert stages.index("read") < stages.index("apply") < stages.index("write")
+    # A finished job lets go of its plan.
+    assert job.run is None and job.key is None
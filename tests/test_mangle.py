@@ -0,0 +1,69 @@
+"""test_mangle.py: Checks mangle.py streams plans through stdin and stdout, and reads them from buffers."""
+
+# Imports
+import io
+import os
+import subprocess
+import sys
+
+import pydicom
+import pytest
+
+from conftest import ROOT
+from rtpmangle import mangleVariant, planBytes, readPlan, writePlan
+
+MANGLE = os.path.join(ROOT, "mangle.py")
+
+
+def mangle(arguments, data=None):
+    """Run mangle.py, returning its exit status, stdout bytes and stderr text."""
+    result = subprocess.run([sys.executable, MANGLE] + arguments, input=data, capture_output=True, cwd=ROOT)
+    return result.returncode, result.stdout, result.stderr.decode()
+
+
+def expected(path, commands):
+    return planBytes(mangleVariant(readPlan(path), commands, keep_uid=True))
+
+
+def test_stdin_to_stdout(plans):
+    with open(plans["imrt"], "rb") as f:
+        status, output, messages = mangle(["-", "-o", "-", "-k", "b0 mu=+10", "b9 g=+5"], f.read())
+    assert status == 0, messages
+    assert output == expected(plans["imrt"], ["b0 mu=+10", "b9 g=+5"])
+    # Warnings go to stderr, out of the plan.
+    assert "WARNING" in messages
+
+
+def test_file_to_stdout(plans):
+    status, output, messages = mangle([plans["vmat"], "-o", "-", "-k", "g=+5"])
+    assert status == 0, messages
+    assert output == expected(plans["vmat"], ["g=+5"])
+
+
+def test_stdin_to_file(plans, tmp_path):
+    outFile = str(tmp_path / "out.dcm")
+    with open(plans["implicit"], "rb") as f:
+        status, _, messages = mangle(["-", "-o", outFile, "-k", "c=-5"], f.read())
+    assert status == 0, messages
+    with open(outFile, "rb") as f:
+        assert f.read() == expected(plans["implicit"], ["c=-5"])
+
+
+@pytest.mark.parametrize("arguments", [
+    ["-o", "-", "b0 g=+{1,2}"],
+    ["-o", "out.dcm", "--patch", "g=+5"],
+])
+def test_stdio_refusals(arguments):
+    status, output, messages = mangle(["-"] + arguments, b"")
+    assert status == 2 and output == b""
+    assert "stdout" in messages or "--patch" in messages
+
+
+def test_buffers(plans):
+    with open(plans["imrt"], "rb") as f:
+        ds = readPlan(io.BytesIO(f.read()))
+    buffer = io.BytesIO()
+    writePlan(ds, buffer)
+    assert pydicom.dcmread(io.BytesIO(buffer.getvalue())).SOPInstanceUID == ds.SOPInstanceUID
+    with open(plans["imrt"], "rb") as f:
+        assert buffer.getvalue() == f.read()
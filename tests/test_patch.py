@@ -0,0 +1,76 @@
+"""test_patch.py: Checks patches rebuild their variants byte for byte, and that a campaign's base plan is only
+read once and never changed."""
+
+# Imports
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT, quietly
+from rtpmangle import mangleVariant, planBytes, readPlan
+from rtpmangle.cache import fileHash
+from rtpmangle.patch import PatchBases, makePatch, materialize, patchVariant, readPatch, writePatch
+
+CAMPAIGN = [
+    ["b0 g=+5"],
+    ["b0 g=-5", "b1 mu=+2%"],
+    ["lb1 lp6 pa=-40", "m='Linac 2'"],
+    ["cp0 j1 pa=7", "b2 cp3-5 c=+1"],
+]
+
+
+@pytest.fixture
+def campaign(plans, tmp_path):
+    """Write a patch of each variant of the VMAT plan, returning [(patch file, variant bytes)]."""
+    base = readPlan(plans["vmat"])
+    baseHash = fileHash(plans["vmat"])
+    written = []
+    for i, commands in enumerate(CAMPAIGN):
+        variant = quietly(mangleVariant, base, commands, keep_uid=True)
+        patchFile = str(tmp_path / ("variant" + str(i) + ".rtpatch"))
+        writePatch(makePatch(base, variant, commands, True, baseHash, plans["vmat"]), patchFile)
+        written.append((patchFile, planBytes(variant)))
+    return written
+
+
+def test_campaign_shares_its_base(plans, campaign):
+    bases = PatchBases()
+    for patchFile, expected in campaign:
+        assert planBytes(materialize(readPatch(patchFile), bases=bases)) == expected
+    assert len(bases) == 1
+
+    # The base plan is patched as variants, so is left as it was read.
+    baseHash, base = bases.plan(plans["vmat"])
+    assert baseHash == fileHash(plans["vmat"])[0]
+    with open(plans["vmat"], "rb") as f:
+        assert planBytes(base) == f.read()
+
+
+def test_patch_variant_in_any_order(plans, campaign):
+    base = readPlan(plans["vmat"])
+    patches = [(readPatch(patchFile), expected) for patchFile, expected in campaign]
+    variants = [(patchVariant(base, patch), expected) for patch, expected in reversed(patches)]
+    for variant, expected in variants:
+        assert planBytes(variant) == expected
+
+
+def test_wrong_base_is_refused(plans, campaign):
+    patch = readPatch(campaign[0][0])
+    with pytest.raises(ValueError, match="not the one the patch was made from"):
+        materialize(patch, plans["imrt"], PatchBases())
+    with pytest.raises(ValueError, match="not the one the patch was made from"):
+        materialize(patch, plans["imrt"])
+
+
+def test_materialize_script(campaign, tmp_path):
+    outDir = str(tmp_path / "plans")
+    result = subprocess.run([sys.executable, os.path.join(ROOT, "mangleMaterialize.py"), "-d", outDir]
+                            + [patchFile for patchFile, expected in campaign], capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "4 plan(s) rebuilt, 0 failed" in result.stdout
+    for patchFile, expected in campaign:
+        name = os.path.basename(patchFile)[:-len(".rtpatch")] + ".dcm"
+        with open(os.path.join(outDir, name), "rb") as f:
+            assert f.read() == expected
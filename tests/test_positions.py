@@ -0,0 +1,93 @@
+"""test_positions.py: Checks jaw and leaf positions are edited in place in encoded control points, and match
+those edited in decoded ones."""
+
+# Imports
+import io
+import sys
+
+import pydicom
+import pytest
+
+from conftest import quietly, synthetic
+from rtpmangle import mangleDataset, planBytes, readPlan
+from rtpmangle.index import CONTROL_POINT_SEQUENCE
+from rtpmangle.positions import readPositions
+from rtpmangle.reader import sequenceItems
+
+COMMANDS = [["lb1 lp6 pa=-40"], ["lb1 cp10 lp6 pa=-40"], ["cp5-8 j1 pa=7", "j0 pr=+2"], ["lb0 lp2-4 pr=-10%"]]
+
+
+def decode(ds):
+    return pydicom.dcmread(io.BytesIO(planBytes(ds)))
+
+
+def positions(ds):
+    """The LeafJawPositions of every control point of every beam, by device type."""
+    return [[{item.RTBeamLimitingDeviceType: [float(v) for v in item.LeafJawPositions]
+              for item in cp.get("BeamLimitingDevicePositionSequence") or []}
+             for cp in beam.ControlPointSequence] for beam in ds.BeamSequence]
+
+
+@pytest.mark.parametrize("preset", ["imrt", "vmat", "implicit"])
+@pytest.mark.parametrize("commands", COMMANDS, ids=["leaves", "one", "jaws", "percent"])
+def test_encoded_matches_decoded(plans, preset, commands):
+    encoded = readPlan(plans[preset])
+    quietly(mangleDataset, encoded, commands, keep_uid=True)
+    decoded = readPlan(plans[preset])
+    for beam in decoded.BeamSequence:
+        beam.ControlPointSequence
+    quietly(mangleDataset, decoded, commands, keep_uid=True)
+
+    assert all(beam.get_item(CONTROL_POINT_SEQUENCE).is_raw for beam in encoded.BeamSequence)
+    assert positions(decode(encoded)) == positions(decode(decoded))
+    assert positions(decode(encoded)) != positions(readPlan(plans[preset]))
+
+
+def test_only_selected_control_points_change(plans):
+    ds = readPlan(plans["vmat"])
+    original = bytes(ds.BeamSequence[2].get_item(CONTROL_POINT_SEQUENCE).value)
+    quietly(mangleDataset, ds, ["b2 cp10 lb1 lp6 pa=-40"], keep_uid=True)
+    edited = bytes(ds.BeamSequence[2].get_item(CONTROL_POINT_SEQUENCE).value)
+
+    # Every other control point is copied byte for byte.
+    items = list(sequenceItems(original, False, "<"))
+    before, after = items[10][0] - 8, items[11][0] - 8
+    assert edited[:before] == original[:before]
+    assert edited[len(edited) - len(original) + after:] == original[after:]
+    output = decode(ds).BeamSequence[2].ControlPointSequence[10]
+    assert float(output.BeamLimitingDevicePositionSequence[2].LeafJawPositions[66]) == -40
+
+
+def test_undefined_length_items(tmp_path):
+    plan = synthetic.makePlan(beams=1, cps=6, pairs=10)
+    for cp in plan.BeamSequence[0].ControlPointSequence:
+        cp.is_undefined_length_sequence_item = True
+        cp.BeamLimitingDevicePositionSequence.is_undefined_length = True
+    path = str(tmp_path / "undefined.dcm")
+    plan.save_as(path, enforce_file_format=True)
+
+    ds = quietly(mangleDataset, readPlan(path), ["cp1-2 lb0 pa=3", "j0 pr=+2"], keep_uid=True)
+    output = decode(ds).BeamSequence[0].ControlPointSequence
+    assert [float(v) for v in output[1].BeamLimitingDevicePositionSequence[2].LeafJawPositions[:10]] == [3] * 10
+    assert float(output[3].BeamLimitingDevicePositionSequence[0].LeafJawPositions[1]) == \
+        float(plan.BeamSequence[0].ControlPointSequence[3].BeamLimitingDevicePositionSequence[0].LeafJawPositions[1]) + 2
+
+
+@pytest.mark.parametrize("decoded", [False, True])
+@pytest.mark.parametrize("numpy", [True, False])
+def test_empty_positions_are_skipped(tmp_path, monkeypatch, decoded, numpy):
+    if not numpy:
+        # Without NumPy, positions are edited as lists (see setters.py).
+        monkeypatch.setitem(sys.modules, "rtpmangle.positions", None)
+    plan = synthetic.makePlan(beams=1, cps=4, pairs=10)
+    plan.BeamSequence[0].ControlPointSequence[2].BeamLimitingDevicePositionSequence[2].LeafJawPositions = ""
+    path = str(tmp_path / "empty.dcm")
+    plan.save_as(path, enforce_file_format=True)
+
+    ds = readPlan(path)
+    if decoded:
+        assert readPositions(ds.BeamSequence[0].ControlPointSequence[2].BeamLimitingDevicePositionSequence[2]) is None
+    quietly(mangleDataset, ds, ["lb1 pa=5"], keep_uid=True)
+    output = decode(ds).BeamSequence[0].ControlPointSequence
+    assert output[2].BeamLimitingDevicePositionSequence[2].LeafJawPositions in ("", None)
+    assert [float(v) for v in output[3].BeamLimitingDevicePositionSequence[2].LeafJawPositions[10:]] == [5] * 10
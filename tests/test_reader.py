@@ -0,0 +1,127 @@
+"""test_reader.py: Checks plans are read in each encoding, from files, maps and streams, and that maps are used
+safely."""
+
+# Imports
+import io
+import os
+import shutil
+import subprocess
+import sys
+import textwrap
+
+import pydicom
+import pytest
+
+from conftest import ROOT, quietly, synthetic
+from rtpmangle import LoadedPlan, mangleDataset, planBytes, readPlan
+from rtpmangle.server import PlanService
+
+
+def encoded(plan, transferSyntax):
+    """The bytes of a plan encoded with any explicit VR transfer syntax, big endian and deflated included."""
+    plan.file_meta.TransferSyntaxUID = transferSyntax
+    buffer = io.BytesIO()
+    pydicom.dcmwrite(buffer, plan, implicit_vr=False, little_endian=transferSyntax.is_little_endian,
+                     force_encoding=True)
+    return buffer.getvalue()
+
+
+def angles(ds):
+    return [[float(cp.GantryAngle) for cp in beam.ControlPointSequence if "GantryAngle" in cp]
+            for beam in ds.BeamSequence]
+
+
+@pytest.mark.parametrize("transferSyntax", [pydicom.uid.ExplicitVRBigEndian,
+                                            pydicom.uid.DeflatedExplicitVRLittleEndian])
+def test_other_transfer_syntaxes(transferSyntax):
+    # Big endian plans are scanned like little endian ones, while deflated plans are left to pydicom.
+    data = encoded(synthetic.makePlan(beams=2, cps=10, pairs=10), transferSyntax)
+    reference = pydicom.dcmread(io.BytesIO(data))
+    ds = readPlan(data)
+    assert angles(ds) == angles(reference)
+
+    quietly(mangleDataset, ds, ["b0 g=+5"], keep_uid=True)
+    output = pydicom.dcmread(io.BytesIO(planBytes(ds)))
+    assert output.file_meta.TransferSyntaxUID == transferSyntax
+    assert angles(output)[0] == pytest.approx([(angle + 5) % 360 for angle in angles(reference)[0]])
+    assert angles(output)[1] == angles(reference)[1]
+
+
+def test_undefined_length_sequences(tmp_path):
+    plan = synthetic.makePlan(beams=2, cps=10, pairs=10)
+    plan["BeamSequence"].is_undefined_length = True
+    plan.BeamSequence[1].ControlPointSequence.is_undefined_length = True
+    plan.BeamSequence[1].ControlPointSequence[0].BeamLimitingDevicePositionSequence.is_undefined_length = True
+    path = str(tmp_path / "undefined.dcm")
+    plan.save_as(path, enforce_file_format=True)
+
+    ds = readPlan(path)
+    reference = pydicom.dcmread(path)
+    assert angles(ds) == angles(reference)
+    assert ds.BeamSequence[1].ControlPointSequence[0].BeamLimitingDevicePositionSequence[0].LeafJawPositions == \
+        reference.BeamSequence[1].ControlPointSequence[0].BeamLimitingDevicePositionSequence[0].LeafJawPositions
+    with open(path, "rb") as f:
+        assert planBytes(ds) == f.read()
+
+
+def rewriteInPlace(path, data):
+    """Overwrite a file without replacing it, as an editor or a copy over the old file would."""
+    with open(path, "r+b") as f:
+        f.truncate(0)
+        f.write(data)
+
+
+def test_rewritten_map_is_refused(plans, tmp_path):
+    # Reading the map of a truncated file kills the process, so this runs in one of its own.
+    path = synthetic.writeSynthetic(str(tmp_path / "plan.dcm"), "vmat-vendor")
+    script = textwrap.dedent("""
+        import sys
+        from rtpmangle import readPlan, writePlan
+        ds = readPlan(sys.argv[1], mapped=True)
+        with open(sys.argv[2], "rb") as f:
+            data = f.read()
+        with open(sys.argv[1], "r+b") as f:
+            f.truncate(0)
+            f.write(data)
+        try:
+            writePlan(ds, sys.argv[1] + ".out")
+        except ValueError as e:
+            print("refused:", e)
+    """)
+    result = subprocess.run([sys.executable, "-c", script, path, plans["degenerate"]], cwd=ROOT,
+                            capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.startswith("refused:") and "read it again" in result.stdout
+
+
+def test_replaced_map_is_kept(tmp_path):
+    path = synthetic.writeSynthetic(str(tmp_path / "plan.dcm"), "vmat-vendor")
+    ds = readPlan(path, mapped=True)
+    expected = planBytes(ds, delta=False)
+    shutil.copy(path, str(tmp_path / "copy.dcm"))
+    os.replace(str(tmp_path / "copy.dcm"), path)
+    assert planBytes(ds) == expected
+
+
+def test_long_held_plans_are_not_mapped(plans, tmp_path):
+    path = synthetic.writeSynthetic(str(tmp_path / "plan.dcm"), "vmat-vendor")
+    loaded = LoadedPlan(path).dataset()
+    service = PlanService()
+    service.setUp(1 << 30, str(tmp_path))
+    cached = service.plan(path)
+    assert not getattr(loaded, "_mapped", False) and not getattr(cached, "_mapped", False)
+    expected = planBytes(loaded)
+
+    with open(plans["degenerate"], "rb") as f:
+        rewriteInPlace(path, f.read())
+    assert planBytes(loaded) == expected
+    assert planBytes(cached) == expected
+
+
+@pytest.mark.parametrize("mapped", [None, False, True])
+def test_mapping(tmp_path, mapped):
+    path = synthetic.writeSynthetic(str(tmp_path / "plan.dcm"), "vmat-vendor")
+    ds = readPlan(path, mapped=mapped)
+    assert bool(getattr(ds, "_mapped", False)) == (mapped is not False and (mapped or os.path.getsize(path) >= (1 << 20)))
+    with open(path, "rb") as f:
+        assert planBytes(ds) == f.read()
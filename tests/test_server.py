@@ -0,0 +1,151 @@
+"""test_server.py: Checks the mangle service's requests, path checks and plan cache."""
+
+# Imports
+import io
+import json
+import os
+import shutil
+import threading
+import urllib.error
+import urllib.request
+from urllib.parse import urlencode
+
+import pydicom
+import pytest
+
+from rtpmangle.server import MangleServer, PlanCache
+
+
+@pytest.fixture
+def root(plans, tmp_path):
+    directory = tmp_path / "root"
+    directory.mkdir()
+    shutil.copy(plans["imrt"], str(directory / "plan.dcm"))
+    return directory
+
+
+def serve(root=None, cacheBytes=1 << 30):
+    server = MangleServer(("127.0.0.1", 0), cacheBytes, None if root is None else str(root))
+    threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def server(root):
+    server = serve(root)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def openServer():
+    server = serve()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post(server, body, contentType, query=None):
+    """POST to /mangle, returning (status, contentType, body)."""
+    url = "http://127.0.0.1:" + str(server.server_address[1]) + "/mangle"
+    if query:
+        url += "?" + urlencode(query, doseq=True)
+    if contentType == "application/json" and not isinstance(body, bytes):
+        body = json.dumps(body).encode("utf-8")
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": contentType}, method="POST")
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.headers.get_content_type(), response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers.get_content_type(), e.read()
+
+
+def test_path_request(server, root):
+    status, _, body = post(server, {"path": "plan.dcm", "commands": ["b0 mu=+10"], "outFile": "out.dcm"},
+                           "application/json")
+    assert status == 200
+    assert json.loads(body)["outFile"] == os.path.realpath(str(root / "out.dcm"))
+    assert (root / "out.dcm").exists()
+
+
+def test_upload(openServer, plans):
+    with open(plans["imrt"], "rb") as f:
+        data = f.read()
+    status, contentType, body = post(openServer, data, "application/dicom", {"command": ["m='Linac 2'"], "keep_uid": 1})
+    assert (status, contentType) == (200, "application/dicom")
+    output = pydicom.dcmread(io.BytesIO(body))
+    assert output.BeamSequence[0].TreatmentMachineName == "Linac 2"
+    assert output.SOPInstanceUID == pydicom.dcmread(plans["imrt"]).SOPInstanceUID
+
+
+def test_plans_are_cached(server):
+    for i in range(3):
+        assert post(server, {"path": "plan.dcm", "commands": ["b0 g=+" + str(i + 1)]}, "application/json")[0] == 200
+    assert server.cache.status()["misses"] == 1
+    assert server.cache.status()["hits"] == 2
+
+
+@pytest.mark.parametrize("contentType", ["text/plain", "application/x-www-form-urlencoded", "multipart/form-data"])
+def test_simple_content_types_are_refused(server, root, plans, contentType):
+    with open(plans["imrt"], "rb") as f:
+        status, _, _ = post(server, f.read(), contentType, {"command": ["g=+5"], "outFile": "written.dcm"})
+    assert status == 415
+    assert not (root / "written.dcm").exists()
+
+
+@pytest.mark.parametrize("request_", [
+    {"path": "../outside.dcm", "commands": ["g=+5"]},
+    {"path": "plan.dcm", "commands": ["g=+5"], "outFile": "/tmp/outside.dcm"},
+    {"path": "plan.dcm", "commands": ["g=+5"], "outFile": "link/outside.dcm"},
+])
+def test_paths_outside_the_root_are_refused(server, root, tmp_path, request_):
+    (tmp_path / "outside.dcm").write_bytes((root / "plan.dcm").read_bytes())
+    os.symlink(str(tmp_path), str(root / "link"))
+    mtime = (tmp_path / "outside.dcm").stat().st_mtime_ns
+
+    assert post(server, request_, "application/json")[0] == 403
+    assert (tmp_path / "outside.dcm").stat().st_mtime_ns == mtime
+    assert server.cache.status()["misses"] == 0
+
+
+def test_paths_need_a_root(openServer, plans, tmp_path):
+    status, _, body = post(openServer, {"path": plans["imrt"], "commands": ["g=+5"]}, "application/json")
+    assert status == 403
+    assert "--root" in json.loads(body)["error"]
+
+    with open(plans["imrt"], "rb") as f:
+        query = {"command": ["g=+5"], "outFile": str(tmp_path / "out.dcm")}
+        assert post(openServer, f.read(), "application/dicom", query)[0] == 403
+    assert not (tmp_path / "out.dcm").exists()
+
+
+@pytest.mark.parametrize("body, status", [
+    (b"{not json", 400),
+    (b"[1, 2]", 400),
+    (json.dumps({"path": "plan.dcm"}).encode(), 400),
+    (json.dumps({"path": "plan.dcm", "commands": "g=+5"}).encode(), 400),
+    (json.dumps({"path": "plan.dcm", "commands": ["q=+5"]}).encode(), 400),
+    (json.dumps({"path": "missing.dcm", "commands": ["g=+5"]}).encode(), 404),
+])
+def test_bad_requests(server, body, status):
+    response = post(server, body, "application/json")
+    assert response[0] == status
+    assert "error" in json.loads(response[2])
+
+
+def test_upload_not_dicom(openServer):
+    assert post(openServer, b"not a plan", "application/dicom", {"command": ["g=+5"]})[0] == 400
+
+
+def test_cache_evicts_least_recently_used():
+    cache = PlanCache(100)
+    cache.get("a", lambda: ("A", 40))
+    cache.get("b", lambda: ("B", 40))
+    cache.get("a", lambda: pytest.fail("a should be cached"))
+    cache.get("c", lambda: ("C", 40))
+
+    assert len(cache) == 2
+    assert cache.get("a", lambda: ("A2", 40)) == "A"
+    assert cache.get("b", lambda: ("B2", 40)) == "B2"
+    assert cache.status()["bytes"] <= 100
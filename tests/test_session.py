@@ -0,0 +1,98 @@
+"""test_session.py: Checks plans kept in memory, and the undo and redo of their edits."""
+
+# Imports
+import os
+import shutil
+
+import pydicom
+import pytest
+
+from rtpmangle import CommandError, EditHistory, JobQueue, LoadedPlan, mangleVariant, planBytes, readPlan
+
+
+def gantry(ds, b=0, cp=0):
+    return float(ds.BeamSequence[b].ControlPointSequence[cp].GantryAngle)
+
+
+def test_undo_and_redo(plans):
+    base = readPlan(plans["vmat"])
+    start = gantry(base)
+    history = EditHistory(base, "state 0")
+    assert not history.canUndo() and not history.canRedo()
+
+    history.apply(["b0 cp0 g=+5"], "state 1")
+    history.apply(["b0 cp0 g=+5"], "state 2")
+    assert gantry(history.dataset) == pytest.approx(start + 10)
+    assert gantry(base) == start
+
+    assert history.undo() == "state 1"
+    assert gantry(history.dataset) == pytest.approx(start + 5)
+    assert history.undo() == "state 0"
+    assert history.dataset is base
+    assert history.redo() == "state 1"
+    assert history.canRedo()
+
+    # A new edit forgets the steps undone.
+    history.apply(["m='Linac 2'"], "state 3")
+    assert not history.canRedo()
+    assert history.commands == ("b0 cp0 g=+5", "m='Linac 2'")
+
+
+def test_failed_edit_leaves_history_unchanged(plans):
+    history = EditHistory(readPlan(plans["vmat"]))
+    history.apply(["g=+5"])
+    with pytest.raises(CommandError):
+        history.apply(["q=+5"])
+    assert history.position == 1 and len(history.steps) == 2
+
+
+def test_matches(plans):
+    history = EditHistory(readPlan(plans["vmat"]))
+    history.apply(["b0  mu=+1.50", "g=+5"])
+    assert history.matches(["b0 mu=+1.5", "g=+5.0"])
+    assert not history.matches(["b0 mu=+1.5001", "g=+5"])
+    assert not history.matches(["b0 mu=+1.5"])
+
+
+def test_write_matches_mangle(plans, tmp_path):
+    base = readPlan(plans["imrt"])
+    history = EditHistory(base)
+    for cmdStr in ["b0 g=+5", "b1 mu=+2%", "lb1 lp6 pa=-40"]:
+        history.apply([cmdStr])
+    outFile = str(tmp_path / "out.dcm")
+    history.write(outFile, keep_uid=True)
+
+    with open(outFile, "rb") as f:
+        assert f.read() == planBytes(mangleVariant(base, ["b0 g=+5", "b1 mu=+2%", "lb1 lp6 pa=-40"], True))
+    assert history.write(outFile).SOPInstanceUID != base.SOPInstanceUID
+
+
+def test_edit_as_a_job(plans):
+    # The GUI applies each edit as a job on its plan, after the jobs already queued on it.
+    history = EditHistory(readPlan(plans["vmat"]))
+    jobs = JobQueue(workers=2)
+    job = jobs.submit("Edit: b0 g=+5", lambda timings: history.apply(["b0 g=+5"], "edited", False, timings),
+                      ["b0 g=+5"], history)
+    job._future.result()
+    assert job.stage == "done" and job.applied == 1
+    assert history.state == "edited"
+    jobs.shutdown()
+
+
+def test_loaded_plan_is_read_once(plans, tmp_path):
+    path = str(tmp_path / "plan.dcm")
+    shutil.copy(plans["imrt"], path)
+    plan = LoadedPlan(path)
+    first = plan.dataset()
+    assert plan.dataset() is first
+
+    outFile = str(tmp_path / "out.dcm")
+    plan.mangle(outFile, ["m='Linac 2'"], keep_uid=True)
+    assert pydicom.dcmread(outFile).BeamSequence[0].TreatmentMachineName == "Linac 2"
+    assert first.BeamSequence[0].TreatmentMachineName == "Linac 1"
+
+    # A plan changed on disk is read again.
+    shutil.copy(plans["vmat"], path)
+    os.utime(path, ns=(0, 0))
+    assert plan.dataset() is not first
+    assert len(plan.dataset().BeamSequence) == len(pydicom.dcmread(plans["vmat"]).BeamSequence)
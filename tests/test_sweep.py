@@ -0,0 +1,56 @@
+"""test_sweep.py: Checks sweeps expand into named variants, and that the variants are generated correctly on
+a process pool."""
+
+# Imports
+import os
+
+import pytest
+
+from conftest import quietly
+from rtpmangle import mangleVariant, planBytes, readPlan
+from rtpmangle.sweep import expandSweep, expandValues, expandVariants, labelledName, runVariants
+
+
+@pytest.mark.parametrize("text, values", [
+    ("-3,-2,1", ["-3", "-2", "1"]),
+    ("-2..2", ["-2", "-1", "0", "1", "2"]),
+    ("0..1 step 0.25", ["0", "0.25", "0.5", "0.75", "1"]),
+    ("0.3..0 step 0.1", ["0.3", "0.2", "0.1", "0"]),
+    ("'Linac 1', 'Linac 2'", ["'Linac 1'", "'Linac 2'"]),
+])
+def test_values(text, values):
+    assert expandValues(text) == values
+
+
+@pytest.mark.parametrize("text", ["1,,2", "", "0..1 step 0", "0..1 step -1"])
+def test_bad_values(text):
+    with pytest.raises(ValueError):
+        expandValues(text)
+
+
+def test_every_combination():
+    expanded = expandSweep(["b0 g=+{-1..1}", "lb1 lp{10,20} pr=+1"])
+    assert len(expanded) == 6
+    assert expanded[0] == ("g-1_lp10", ["b0 g=-1", "lb1 lp10 pr=+1"])
+    assert expanded[-1] == ("g1_lp20", ["b0 g=+1", "lb1 lp20 pr=+1"])
+    assert expandSweep(["b0 g=+5"]) == [("", ["b0 g=+5"])]
+
+
+def test_names():
+    assert labelledName("out.dcm", "") == "out.dcm"
+    assert labelledName("plans/out.dcm", "mu+2%") == "plans/out_mu+2pct.dcm"
+    names = [outFile for outFile, cmds in expandVariants([("a.dcm", ["g={1,2}"]), ("b.dcm", ["c=+3"])])]
+    assert names == ["a_g1.dcm", "a_g2.dcm", "b.dcm"]
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_variants_on_a_pool(plans, tmp_path, jobs):
+    variants = expandVariants([(str(tmp_path / "out.dcm"), ["b0 g=+{-2..2}", "lb1 lp6 pa=-40"])])
+    written = quietly(lambda: list(runVariants(plans["imrt"], variants, keep_uid=True, jobs=jobs)))
+
+    assert sorted(written) == sorted(outFile for outFile, cmds in variants)
+    base = readPlan(plans["imrt"])
+    for outFile, cmds in variants:
+        with open(outFile, "rb") as f:
+            assert f.read() == planBytes(quietly(mangleVariant, base, cmds, keep_uid=True))
+    assert os.path.exists(str(tmp_path / "out_g-2.dcm"))
@@ -0,0 +1,56 @@
+"""test_timing.py: Checks the profile counts what each command selected and edited."""
+
+# Imports
+import io
+import json
+
+import pydicom
+
+from conftest import quietly
+from rtpmangle import mangleDataset, readPlan
+from rtpmangle.timing import Timings
+
+
+def profile(path, commands):
+    timings = Timings()
+    quietly(mangleDataset, readPlan(path), commands, keep_uid=True, timings=timings)
+    return {record["command"]: record for record in timings.report()["commands"]}
+
+
+def holding(path, deviceType, beams=None):
+    """The number of control points holding positions of a device type."""
+    ds = pydicom.dcmread(path)
+    return sum(1 for b, beam in enumerate(ds.BeamSequence) if beams is None or b in beams
+               for cp in beam.ControlPointSequence
+               if any(item.RTBeamLimitingDeviceType == deviceType
+                      for item in cp.get("BeamLimitingDevicePositionSequence") or []))
+
+
+def test_counts_positions_edited(plans):
+    records = profile(plans["imrt"], ["j0 jb1 pr=+2", "b1 lb1 lp6-9 pa=-40", "b0 mu=+10"])
+
+    # The sparse plan only holds positions where they change, so fewer are edited than selected.
+    jaws = records["j0 jb1 pr=+2"]
+    assert jaws["control_points"] == 7 * 20
+    assert jaws["positions"] == holding(plans["imrt"], "ASYMX") < jaws["control_points"]
+
+    leaves = records["b1 lb1 lp6-9 pa=-40"]
+    assert (leaves["beams"], leaves["positions"]) == (1, 4 * holding(plans["imrt"], "MLCX", [1]))
+    assert records["b0 mu=+10"]["positions"] == 0
+
+
+def test_counts_nothing_for_missing_devices(plans):
+    # The degenerate plan has jaws but no MLC.
+    records = profile(plans["degenerate"], ["lb1 pa=-40", "j1 pr=+1"])
+    assert records["lb1 pa=-40"]["positions"] == 0
+    assert records["j1 pr=+1"]["positions"] == 2 * holding(plans["degenerate"], "ASYMY")
+
+
+def test_report_is_json(plans):
+    timings = Timings()
+    quietly(mangleDataset, readPlan(plans["vmat"]), ["lb0 pr=+1"], timings=timings)
+    buffer = io.StringIO()
+    timings.dump(buffer)
+    report = json.loads(buffer.getvalue())
+    assert set(report) == {"total_ms", "phases", "parse_ms", "commands"}
+    assert report["commands"][0]["positions"] == 60 * holding(plans["vmat"], "MLCX")
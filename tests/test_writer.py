@@ -0,0 +1,84 @@
+"""test_writer.py: Checks delta writing keeps every edit, and copies everything else byte for byte."""
+
+# Imports
+import io
+
+import pydicom
+import pytest
+
+from conftest import quietly, synthetic
+from rtpmangle import mangleDataset, markModified, planBytes, readPlan, writePlan
+from rtpmangle.writer import canWriteDelta
+
+VENDOR_SEQUENCE = 0x00991002
+
+
+def decode(data):
+    return pydicom.dcmread(io.BytesIO(data))
+
+
+@pytest.mark.parametrize("preset", ["vmat", "vmat-vendor", "implicit"])
+def test_unedited_plan_is_copied(plans, preset):
+    with open(plans[preset], "rb") as f:
+        assert planBytes(readPlan(plans[preset])) == f.read()
+
+
+@pytest.mark.parametrize("preset", ["vmat", "implicit"])
+def test_in_place_edits_are_written(plans, preset):
+    ds = readPlan(plans[preset])
+    ds.BeamSequence[0].BeamName = "EDITED"
+    ds.BeamSequence[1].ControlPointSequence[3].GantryAngle = 12.5
+    ds.FractionGroupSequence[0].NumberOfFractionsPlanned = 5
+    ds.PatientName = "Edited^Patient"
+    assert canWriteDelta(ds)
+
+    output = decode(planBytes(ds))
+    assert output.BeamSequence[0].BeamName == "EDITED"
+    assert output.BeamSequence[1].ControlPointSequence[3].GantryAngle == 12.5
+    assert output.FractionGroupSequence[0].NumberOfFractionsPlanned == 5
+    assert output.PatientName == "Edited^Patient"
+    assert planBytes(ds) == planBytes(ds, delta=False)
+
+
+def test_vendor_data_is_copied(plans):
+    ds = quietly(mangleDataset, readPlan(plans["vmat-vendor"]), ["b0 mu=+10", "lb1 lp6 pa=-40"])
+    original = readPlan(plans["vmat-vendor"])._source[pydicom.tag.Tag(VENDOR_SEQUENCE)]
+    data = planBytes(ds)
+
+    assert original[1] + bytes(original[0].value) + original[2] in data
+    assert decode(data)[VENDOR_SEQUENCE].is_undefined_length
+
+
+def test_undefined_length_sequences(tmp_path):
+    plan = synthetic.makePlan(beams=2, cps=10, pairs=10)
+    plan.BeamSequence[0].ControlPointSequence.is_undefined_length = True
+    plan["BeamSequence"].is_undefined_length = True
+    path = str(tmp_path / "undefined.dcm")
+    plan.save_as(path, enforce_file_format=True)
+
+    ds = quietly(mangleDataset, readPlan(path), ["b0 g=+5"], keep_uid=True)
+    assert planBytes(ds) == planBytes(ds, delta=False)
+    assert decode(planBytes(ds)).BeamSequence[0].ControlPointSequence[0].GantryAngle == \
+        pytest.approx((float(plan.BeamSequence[0].ControlPointSequence[0].GantryAngle) + 5) % 360)
+
+
+def test_falls_back_to_full_write(plans):
+    ds = readPlan(plans["vmat"])
+    markModified(ds)
+    assert not canWriteDelta(ds)
+
+    ds = readPlan(plans["vmat"])
+    ds.file_meta.TransferSyntaxUID = pydicom.uid.ImplicitVRLittleEndian
+    assert not canWriteDelta(ds)
+    assert decode(planBytes(ds)).file_meta.TransferSyntaxUID == pydicom.uid.ImplicitVRLittleEndian
+
+
+def test_overwrites_own_mapped_file(tmp_path):
+    path = synthetic.writeSynthetic(str(tmp_path / "plan.dcm"), "vmat-vendor")
+    ds = readPlan(path, mapped=True)
+    quietly(mangleDataset, ds, ["b0 mu=+10"], keep_uid=True)
+    expected = planBytes(ds)
+
+    writePlan(ds, path)
+    with open(path, "rb") as f:
+        assert f.read() == expected